@@ -0,0 +1,112 @@
+import argparse
+import multiprocessing
+import resource
+import time
+import polars as pl
+import main
+
+
+def eager_delays(df: pl.DataFrame) -> pl.DataFrame:
+    """calculate_delays as it was before the lazy plan, as reference"""
+    df = df.filter(~pl.all(pl.col("^.*Time.*$").is_null()))
+    df = df.with_columns(
+        pl.col("^.*Time.*$").str.strptime(pl.Datetime, fmt="%+").cast(pl.Datetime)
+    )
+    df = df.with_columns(
+        [
+            (pl.col("arrivalTimeEstimated") - pl.col("arrivalTimePlanned"))
+            .dt.seconds()
+            .alias("arrivalDelay"),
+            (pl.col("departureTimeEstimated") - pl.col("departureTimePlanned"))
+            .dt.seconds()
+            .alias("departureDelay"),
+        ]
+    )
+    df = df.with_columns(
+        [
+            pl.col("arrivalDelay").fill_null(strategy="zero"),
+            pl.col("departureDelay").fill_null(strategy="zero"),
+        ]
+    )
+    return df.with_columns(
+        pl.when(pl.col("departureDelay") > pl.col("arrivalDelay"))
+        .then(pl.col("departureDelay"))
+        .otherwise(pl.col("arrivalDelay"))
+        .alias("delay")
+    )
+
+
+def eager_date(df: pl.DataFrame, file_name: str) -> pl.DataFrame:
+    """calulate_date as it was before the lazy plan, as reference"""
+    date = main.pathlib.PurePath(file_name).stem.removesuffix(".db")
+    df = df.with_columns(
+        pl.when(pl.col("departureTimePlanned") > pl.col("arrivalTimePlanned"))
+        .then(pl.col("departureTimePlanned"))
+        .otherwise(pl.col("arrivalTimePlanned"))
+        .alias("date")
+    )
+    df = df.with_columns(pl.col("date").fill_null(pl.lit(date)))
+    return df.drop(["departureTimePlanned", "arrivalTimePlanned"])
+
+
+def run(variant: str, mode: main.Mode, source, elem: str, batch_size: int) -> dict:
+    """Time one variant, meant to run in a fresh process to measure its peak RSS"""
+    start = time.perf_counter()
+    if variant == "eager":
+        df = main.read_db_to_df(mode, source)
+        if mode is not main.Mode.STATION_INFO:
+            df = df.filter(
+                ~pl.all(pl.col("transportation_name").str.contains("Stadtbahn"))
+            )
+        if mode is main.Mode.STATION_DELAY:
+            df = eager_delays(df)
+        else:
+            df = eager_date(df, elem)
+    elif variant == "lazy":
+        df = main.extract_mode(mode, source, elem)
+    else:
+        df = main.extract_mode(mode, source, elem, batch_size=batch_size)
+    elapsed = time.perf_counter() - start
+    return {
+        "variant": variant,
+        "rows": len(df),
+        "seconds": round(elapsed, 2),
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare time and peak memory of the eager and lazy transforms"
+    )
+    parser.add_argument("archive", type=str)
+    parser.add_argument(
+        "-m",
+        dest="mode",
+        default="STATION_DELAY",
+        choices={"STATION_DELAY", "TRAIN_INCIDENT", "STATION_INFO"},
+    )
+    parser.add_argument("--batch-size", type=int, default=main.BATCH_SIZE)
+    parser.add_argument("variants", nargs="*", default=["eager", "lazy", "streaming"])
+    args = parser.parse_args()
+    source = main.decompress(args.archive)
+    main.create_indexes(source)
+    context = multiprocessing.get_context("spawn")
+    try:
+        for variant in args.variants:
+            with context.Pool(1) as process:
+                print(
+                    process.apply(
+                        run,
+                        (
+                            variant,
+                            main.Mode[args.mode],
+                            source,
+                            args.archive,
+                            args.batch_size,
+                        ),
+                    )
+                )
+    finally:
+        main.release(source)
@@ -1,10 +1,22 @@
 import argparse
+import collections
+import datetime
+import functools
+import hashlib
+import io
+import multiprocessing
+import shutil
+import sqlite3
+import tempfile
+import time
 import zstandard
 import pathlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from psycopg2 import sql
-import psycopg2.extras
+import psycopg2.pool
 import polars as pl
 from enum import Enum
+import stations
 
 
 class Mode(Enum):
@@ -13,6 +25,17 @@ class Mode(Enum):
     STATION_INFO = 3
 
 
+# rows read from the source db at once with --batch-size, bounds the raw text
+# held in memory. Slower than reading the whole result, only for hosts short
+# of memory.
+BATCH_SIZE = 100_000
+# the miner's station file, if both are checked out side by side
+STATION_FILE = (
+    pathlib.Path(__file__).resolve().parent.parent
+    / "mining"
+    / "vvs_sbahn_haltestellen_2022.csv"
+)
+
 parser = argparse.ArgumentParser(
     prog="DB_Extraction_tool",
     description="Construct single Database from one or more sources",
@@ -46,95 +69,743 @@ parser.add_argument(
     "-m",
     dest="mode",
     type=str,
-    default="STATION_DELAY",
+    action="append",
     choices={"STATION_DELAY", "TRAIN_INCIDENT", "STATION_INFO"},
-    help="In which mode the program should run",
+    help="In which mode the program should run. Can be passed multiple times, "
+    "all modes share one decompression of every file",
+)
+parser.add_argument(
+    "--no-indexes",
+    dest="indexes",
+    action="store_false",
+    help="Query the source db without building indexes first, to compare timings",
+)
+parser.add_argument(
+    "-j",
+    "--jobs",
+    dest="jobs",
+    type=int,
+    default=1,
+    help="Number of files decompressed, queried and transformed in parallel",
+)
+parser.add_argument(
+    "--connections",
+    dest="connections",
+    type=int,
+    default=2,
+    help="Maximum number of PostgreSQL connections used for writing",
+)
+parser.add_argument(
+    "--in-memory",
+    dest="in_memory",
+    action="store_true",
+    help="Decompress into an in-memory SQLite database instead of a temp file",
+)
+parser.add_argument(
+    "--temp-dir",
+    dest="temp_dir",
+    type=str,
+    default=None,
+    help="Directory for decompressed files, e.g. a tmpfs like /dev/shm",
+)
+parser.add_argument(
+    "--force",
+    dest="force",
+    action="store_true",
+    help="Reload files even if the manifest lists them as already loaded",
+)
+parser.add_argument(
+    "--batch-size",
+    dest="batch_size",
+    type=int,
+    default=0,
+    help="Rows read and transformed at once, e.g. 100000 on hosts short of "
+    "memory. 0 reads the whole result at once, which is faster",
+)
+parser.add_argument(
+    "--delay-source",
+    dest="delay_source",
+    choices=["trips", "departures"],
+    default="trips",
+    help="Compute STATION_DELAY from the trip sweep or from the departure boards",
+)
+parser.add_argument(
+    "--stations",
+    dest="stations",
+    type=str,
+    default=str(STATION_FILE),
+    help="VVS station file the infos of STATION_INFO are matched against",
 )
 parser.add_argument(
     "dblist",
     type=str,
     nargs="+",
-    help="Name of the DB which should be used. Can be passed multiple times",
+    help="Name of the DB which should be used. Can be passed multiple times. "
+    "Directories are expanded to the .zst and columnar archives they contain",
 )
 
 
-def zstd_to_temp(input_file):
+def zstd_to_temp(input_file, output_path=pathlib.Path("temp.db")):
     input_file = pathlib.Path(input_file)
     with open(input_file, "rb") as compressed:
         decomp = zstandard.ZstdDecompressor()
-        output_path = pathlib.Path("temp.db")
         with open(output_path, "wb") as destination:
             decomp.copy_stream(compressed, destination)
 
 
-def read_db_to_df(mode: Mode) -> pl.DataFrame:
-    conn = f"sqlite://{pathlib.Path('temp.db')}"
-    if mode is Mode.STATION_DELAY:
-        query = """
-        SELECT DISTINCT
-        stops.name, legs.transportation_name,
-        legs.transportation_properties_trainNumber, stops.arrivalTimePlanned,
-        stops.arrivalTimeEstimated, stops.departureTimePlanned,
-        stops.departureTimeEstimated
-        FROM trips
-        INNER JOIN legs
-        ON trips.data_id=legs.data_trip_id
-        INNER JOIN stops
-        on legs.data_id=stops.data_leg_id
+def zstd_to_memory(input_file) -> sqlite3.Connection:
+    """Decompress an archive into an in-memory SQLite database"""
+    with open(input_file, "rb") as compressed:
+        decomp = zstandard.ZstdDecompressor()
+        data = decomp.stream_reader(compressed).readall()
+    # may be decompressed in a prefetch thread and queried in another one
+    conn = sqlite3.connect(":memory:", check_same_thread=False)
+    conn.deserialize(data)
+    return conn
+
+
+def is_columnar(path) -> bool:
+    """Whether path is a columnar archive written by the miner's columnar.py"""
+    if isinstance(path, sqlite3.Connection):
+        return False
+    return (pathlib.Path(path) / "trips.parquet").is_file()
+
+
+def decompress(input_file, in_memory: bool = False, temp_dir=None):
+    """Decompressed source db, either a connection or a file in a fresh temp dir.
+
+    Columnar archives are read in place and returned as they are.
+    """
+    if is_columnar(input_file):
+        return pathlib.Path(input_file)
+    if in_memory:
+        return zstd_to_memory(input_file)
+    db_path = pathlib.Path(tempfile.mkdtemp(prefix="extraction-", dir=temp_dir))
+    db_path = db_path / "temp.db"
+    zstd_to_temp(input_file, db_path)
+    return db_path
+
+
+def release(source):
+    if isinstance(source, sqlite3.Connection):
+        source.close()
+    elif not is_columnar(source):
+        shutil.rmtree(pathlib.Path(source).parent)
+
+
+# Covering indexes for the joins and groupings of the extraction queries. The
+# miner does not create them to keep its write path cheap.
+INDEXES = [
+    """CREATE INDEX IF NOT EXISTS ix_legs_trip ON legs (
+        data_trip_id, data_id, transportation_properties_trainNumber,
+        transportation_name
+    )""",
+    """CREATE INDEX IF NOT EXISTS ix_stops_leg ON stops (
+        data_leg_id, name, arrivalTimePlanned, arrivalTimeEstimated,
+        departureTimePlanned, departureTimeEstimated
+    )""",
+    "CREATE INDEX IF NOT EXISTS ix_hints_leg ON hints (data_leg_id, type, content)",
+    "CREATE INDEX IF NOT EXISTS ix_infos_id ON infos (id, data_leg_id)",
+]
+
+
+def create_indexes(source):
+    if isinstance(source, sqlite3.Connection):
+        conn = source
+    else:
+        conn = sqlite3.connect(source)
+    for statement in INDEXES:
+        conn.execute(statement)
+    conn.execute("ANALYZE")
+    conn.commit()
+    if conn is not source:
+        conn.close()
+
+
+def frame_from_rows(rows: list, columns: list[str]) -> pl.DataFrame:
+    if not rows:
+        return pl.DataFrame(schema={name: pl.Utf8 for name in columns})
+    # building columns first is several times faster than orient="row"
+    df = pl.DataFrame(dict(zip(columns, map(list, zip(*rows)))))
+    # columns without any value come back untyped or as floats, they are all
+    # text columns
+    return df.with_columns(
+        [
+            pl.col(name).cast(pl.Utf8)
+            for name in df.columns
+            if df[name].null_count() == len(df)
+        ]
+    )
+
+
+def read_sqlite_connection(query: str, conn: sqlite3.Connection) -> pl.DataFrame:
+    cur = conn.execute(query)
+    columns = [description[0] for description in cur.description]
+    return frame_from_rows(cur.fetchall(), columns)
+
+
+# Join of the trips, legs and stops tables shared by the STATION_DELAY and
+# TRAIN_INCIDENT queries. A single mode inlines it as a CTE. Several modes
+# materialize it once in the decompressed copy and query the table.
+BASE_QUERY = """
+SELECT
+legs.data_id AS data_leg_id, stops.data_id AS data_stop_id, stops.name,
+legs.transportation_name,
+legs.transportation_properties_trainNumber, stops.arrivalTimePlanned,
+stops.arrivalTimeEstimated, stops.departureTimePlanned,
+stops.departureTimeEstimated
+FROM trips
+INNER JOIN legs
+ON trips.data_id=legs.data_trip_id
+INNER JOIN stops
+on legs.data_id=stops.data_leg_id
+"""
+
+# A group is represented by its first stored row, the one with the lowest
+# data_id: the bare columns of a SQLite GROUP BY come from the row of its min()
+# and first_per_group picks the same row of a columnar archive. Both sort the
+# groups by their keys.
+QUERIES = {
+    Mode.STATION_DELAY: """
+    SELECT
+    name, transportation_name,
+    transportation_properties_trainNumber, arrivalTimePlanned,
+    arrivalTimeEstimated, departureTimePlanned,
+    departureTimeEstimated
+    FROM (
+        SELECT *, min(data_stop_id) FROM base
         GROUP BY transportation_properties_trainNumber, name
-        """
-    elif mode is Mode.TRAIN_INCIDENT:
-        query = """
-        SELECT
-        stops.name, legs.transportation_name,
-        legs.transportation_properties_trainNumber,
-        hints.content, stops.arrivalTimePlanned, stops.departureTimePlanned
-        FROM trips
-        INNER JOIN legs
-        ON trips.data_id=legs.data_trip_id
-        INNER JOIN stops
-        on legs.data_id=stops.data_leg_id
+    )
+    ORDER BY transportation_properties_trainNumber, name
+    """,
+    Mode.TRAIN_INCIDENT: """
+    SELECT
+    name, transportation_name, transportation_properties_trainNumber,
+    content, arrivalTimePlanned, departureTimePlanned
+    FROM (
+        SELECT base.*, hints.content, min(hints.data_id)
+        FROM base
         INNER JOIN hints
-        on legs.data_id=hints.data_leg_id
+        on base.data_leg_id=hints.data_leg_id
         WHERE hints.type like("%incident%")
-        GROUP BY legs.transportation_properties_trainNumber, stops.name
-        """
-    elif mode is Mode.STATION_INFO:
-        query = """
-        SELECT tmp.data_leg_id, tmp.id, stops.name, tmp.type, tmp.urlText, tmp.content,
-        stops.arrivalTimePlanned, stops.departureTimePlanned
-        FROM (SELECT data_leg_id,id, type, urlText, content FROM infos GROUP BY id)
-        as tmp
-        INNER JOIN stops ON tmp.data_leg_id = stops.data_leg_id
-        WHERE tmp.content LIKE ("%" || stops.name || "%")
-        """
+        GROUP BY base.transportation_properties_trainNumber, base.name
+    )
+    ORDER BY transportation_properties_trainNumber, name
+    """,
+    # every stop of the leg of an info, match_station_infos keeps the stops
+    # the info mentions
+    Mode.STATION_INFO: """
+    SELECT tmp.data_leg_id, tmp.id, stops.name, tmp.type, tmp.urlText, tmp.content,
+    stops.arrivalTimePlanned, stops.departureTimePlanned,
+    stops.id AS stop_id, stops.parent_id AS stop_parent_id
+    FROM (
+        SELECT data_leg_id, id, type, urlText, content, min(data_id)
+        FROM infos GROUP BY id
+    ) as tmp
+    INNER JOIN stops ON tmp.data_leg_id = stops.data_leg_id
+    ORDER BY tmp.id, stops.data_id
+    """,
+}
+
+# modes whose query reads the shared base join
+BASE_MODES = {Mode.STATION_DELAY, Mode.TRAIN_INCIDENT}
+
+# STATION_DELAY from the departure boards the miner stores since its departures
+# table exists. One row per departure, the arrival times are added as empty
+# columns by calculate_delays.
+DEPARTURE_DELAY_QUERY = """
+SELECT
+stop_name AS name, transportation_name,
+train_number AS transportation_properties_trainNumber,
+departureTimePlanned, departureTimeEstimated
+FROM departures
+"""
+
+
+def mode_query(mode: Mode, base_table: bool = False, departures: bool = False):
+    if departures and mode is Mode.STATION_DELAY:
+        return DEPARTURE_DELAY_QUERY
+    query = QUERIES[mode]
+    if mode in BASE_MODES and not base_table:
+        query = f"WITH base AS ({BASE_QUERY}) {query}"
+    return query
+
+
+def has_table(source, table: str) -> bool:
+    if is_columnar(source):
+        return (pathlib.Path(source) / f"{table}.parquet").is_file()
+    if isinstance(source, sqlite3.Connection):
+        conn = source
+    else:
+        conn = sqlite3.connect(source)
+    try:
+        row = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+        ).fetchone()
+    finally:
+        if conn is not source:
+            conn.close()
+    return row is not None
+
+
+def create_base_table(source):
+    """Materialize the shared join in the decompressed copy of the archive"""
+    if isinstance(source, sqlite3.Connection):
+        conn = source
     else:
-        query = ""
+        conn = sqlite3.connect(source)
+    conn.execute(f"CREATE TABLE IF NOT EXISTS base AS {BASE_QUERY}")
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_base_leg ON base (data_leg_id)")
+    conn.commit()
+    if conn is not source:
+        conn.close()
+
 
+def read_db_to_df(
+    mode: Mode,
+    source=pathlib.Path("temp.db"),
+    base_table: bool = False,
+    departures: bool = False,
+) -> pl.DataFrame:
+    query = mode_query(mode, base_table, departures)
+
+    if isinstance(source, sqlite3.Connection):
+        return read_sqlite_connection(query, source)
+    conn = f"sqlite://{pathlib.Path(source).absolute()}"
     df = pl.read_sql(query, conn)
     return df
 
 
-def write_df_to_db(mode: Mode, df: pl.DataFrame):
-    columns = sql.SQL(",").join(sql.Identifier(name.lower()) for name in df.columns)
-    values = sql.SQL(",").join([sql.Placeholder() for _ in df.columns])
-    table_name = mode.name.lower()
-    insert_stmt = sql.SQL("INSERT INTO {} ({}) VALUES({});").format(
-        sql.Identifier(table_name), columns, values
+def read_db_batches(
+    mode: Mode,
+    source,
+    base_table: bool = False,
+    batch_size: int = BATCH_SIZE,
+    departures: bool = False,
+):
+    """Query result in frames of at most batch_size rows.
+
+    At least one frame is yielded, so an empty result still has its columns.
+    """
+    query = mode_query(mode, base_table, departures)
+    if isinstance(source, sqlite3.Connection):
+        conn = source
+    else:
+        conn = sqlite3.connect(source)
+    try:
+        cur = conn.execute(query)
+        columns = [description[0] for description in cur.description]
+        rows = cur.fetchmany(batch_size)
+        yield frame_from_rows(rows, columns)
+        while len(rows) == batch_size:
+            rows = cur.fetchmany(batch_size)
+            if rows:
+                yield frame_from_rows(rows, columns)
+    finally:
+        if conn is not source:
+            conn.close()
+
+
+# time columns of the stops table, UTC timestamps in a columnar archive
+TIME_COLUMNS = [
+    "arrivalTimePlanned",
+    "arrivalTimeEstimated",
+    "departureTimePlanned",
+    "departureTimeEstimated",
+]
+
+
+def scan_table(archive, table: str, columns: list[str]) -> pl.LazyFrame:
+    lf = pl.scan_parquet(pathlib.Path(archive) / f"{table}.parquet").select(columns)
+    # naive UTC, like the times parsed from the text of a SQLite archive
+    return lf.with_columns(
+        [
+            pl.col(name).cast(pl.Datetime("us"))
+            for name in TIME_COLUMNS
+            if name in columns
+        ]
+    )
+
+
+def scan_base(archive) -> pl.LazyFrame:
+    """BASE_QUERY over a columnar archive"""
+    trips = scan_table(archive, "trips", ["data_id"]).rename(
+        {"data_id": "data_trip_id"}
+    )
+    legs = (
+        scan_table(
+            archive,
+            "legs",
+            [
+                "data_id",
+                "data_trip_id",
+                "transportation_name",
+                "transportation_properties_trainNumber",
+            ],
+        )
+        .join(trips, on="data_trip_id", how="semi")
+        .drop("data_trip_id")
+        .rename({"data_id": "data_leg_id"})
+    )
+    stops = scan_table(
+        archive, "stops", ["data_id", "data_leg_id", "name"] + TIME_COLUMNS
+    ).rename({"data_id": "data_stop_id"})
+    return stops.join(legs, on="data_leg_id")
+
+
+def first_per_group(
+    lf: pl.LazyFrame, keys: list[str], columns: list[str], order: str
+) -> pl.LazyFrame:
+    """GROUP BY keys with the bare columns of the row of min(order), sorted"""
+    values = [name for name in columns if name not in keys]
+    return (
+        lf.groupby(keys)
+        .agg([pl.col(name).sort_by(order).first() for name in values])
+        .sort(keys)
+        .select(columns)
+    )
+
+
+def scan_departure_delays(archive) -> pl.LazyFrame:
+    """DEPARTURE_DELAY_QUERY over a columnar archive"""
+    return scan_table(
+        archive,
+        "departures",
+        [
+            "stop_name",
+            "transportation_name",
+            "train_number",
+            "departureTimePlanned",
+            "departureTimeEstimated",
+        ],
+    ).select(
+        [
+            pl.col("stop_name").alias("name"),
+            pl.col("transportation_name"),
+            pl.col("train_number").alias("transportation_properties_trainNumber"),
+            pl.col("departureTimePlanned"),
+            pl.col("departureTimeEstimated"),
+        ]
+    )
+
+
+def scan_columnar(mode: Mode, archive, departures: bool = False) -> pl.LazyFrame:
+    """QUERIES[mode] over a columnar archive, reading only the needed columns"""
+    group = ["transportation_properties_trainNumber", "name"]
+    if departures and mode is Mode.STATION_DELAY:
+        return scan_departure_delays(archive)
+    if mode is Mode.STATION_DELAY:
+        columns = [
+            "name",
+            "transportation_name",
+            "transportation_properties_trainNumber",
+        ] + TIME_COLUMNS
+        return first_per_group(scan_base(archive), group, columns, "data_stop_id")
+    if mode is Mode.TRAIN_INCIDENT:
+        hints = (
+            scan_table(archive, "hints", ["data_id", "data_leg_id", "type", "content"])
+            .filter(pl.col("type").str.to_lowercase().str.contains("incident"))
+            .drop("type")
+            .rename({"data_id": "data_hint_id"})
+        )
+        columns = [
+            "name",
+            "transportation_name",
+            "transportation_properties_trainNumber",
+            "content",
+            "arrivalTimePlanned",
+            "departureTimePlanned",
+        ]
+        return first_per_group(
+            scan_base(archive).join(hints, on="data_leg_id"),
+            group,
+            columns,
+            "data_hint_id",
+        )
+    infos = first_per_group(
+        scan_table(
+            archive,
+            "infos",
+            ["data_id", "data_leg_id", "id", "type", "urlText", "content"],
+        ),
+        ["id"],
+        ["data_leg_id", "id", "type", "urlText", "content"],
+        "data_id",
+    )
+    stops = scan_table(
+        archive,
+        "stops",
+        [
+            "data_id",
+            "data_leg_id",
+            "name",
+            "arrivalTimePlanned",
+            "departureTimePlanned",
+            "id",
+            "parent_id",
+        ],
+    ).rename(
+        {"data_id": "data_stop_id", "id": "stop_id", "parent_id": "stop_parent_id"}
     )
-    conn = psycopg2.connect(
+    return (
+        infos.join(stops, on="data_leg_id")
+        .sort(["id", "data_stop_id"])
+        .select(
+            [
+                "data_leg_id",
+                "id",
+                "name",
+                "type",
+                "urlText",
+                "content",
+                "arrivalTimePlanned",
+                "departureTimePlanned",
+                "stop_id",
+                "stop_parent_id",
+            ]
+        )
+    )
+
+
+def connect(args) -> psycopg2.pool.ThreadedConnectionPool:
+    """Pool bounding the number of connections all writers share"""
+    return psycopg2.pool.ThreadedConnectionPool(
+        1,
+        args.connections,
         database=args.psql_db,
         user=args.psql_user,
         password=args.psql_pass,
         host=args.psql_host,
         port=args.psql_port,
     )
-    create_psql_table(mode, conn)
+
+
+# rows written to CSV at a time while COPY reads a frame
+COPY_CHUNK_ROWS = 50_000
+
+
+class CopyStream:
+    """File-like CSV of a frame as COPY reads it, written chunk by chunk.
+
+    Only COPY_CHUNK_ROWS rows are held as CSV at a time. Missing values are
+    unquoted empty fields, which the csv format of COPY reads as NULL, while
+    polars quotes empty strings. No string value can be read as NULL.
+    """
+
+    def __init__(self, df: pl.DataFrame, chunk_rows: int = COPY_CHUNK_ROWS):
+        self.chunks = (
+            df.slice(offset, chunk_rows) for offset in range(0, len(df), chunk_rows)
+        )
+        self.buffer = b""
+        self.offset = 0
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0:
+            return b"".join(iter(lambda: self.read(1 << 20), b""))
+        while self.offset >= len(self.buffer):
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return b""
+            csv = io.BytesIO()
+            chunk.write_csv(csv, has_header=False, null_value="")
+            self.buffer = csv.getvalue()
+            self.offset = 0
+        start = self.offset
+        self.offset = end = start + size
+        return self.buffer[start:end]
+
+
+def write_df_to_db(
+    mode: Mode,
+    df: pl.DataFrame,
+    conn,
+    source_file: str = None,
+    checksum: str = None,
+    stat: tuple[int, float] = (None, None),
+):
+    """Stream the frame into PostgreSQL with COPY.
+
+    With a source_file, rows previously loaded from that file are deleted and
+    replaced in the same transaction that updates the manifest entry with the
+    checksum and the (size, mtime) stat of the file, so
+    loading the same file twice does not duplicate rows. There is no staging
+    table, the delete makes a comparison with the loaded rows unnecessary.
+    """
+    if source_file is not None:
+        df = df.with_columns(pl.lit(source_file).alias("source_file"))
+    columns = sql.SQL(",").join(sql.Identifier(name.lower()) for name in df.columns)
+    table = sql.Identifier(mode.name.lower())
     cur = conn.cursor()
-    psycopg2.extras.execute_batch(cur, insert_stmt, df.rows())
+    if source_file is not None:
+        cur.execute(
+            sql.SQL("DELETE FROM {} WHERE source_file = %s").format(table),
+            (source_file,),
+        )
+    cur.copy_expert(
+        sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv)")
+        .format(table, columns)
+        .as_string(conn),
+        CopyStream(df),
+    )
+    if checksum is not None:
+        cur.execute(
+            """INSERT INTO extraction_manifest
+            (file, mode, checksum, size, mtime, row_count, loaded_at)
+            VALUES (%s, %s, %s, %s, %s, %s, now())
+            ON CONFLICT (file, mode) DO UPDATE SET
+            checksum = EXCLUDED.checksum,
+            size = EXCLUDED.size,
+            mtime = EXCLUDED.mtime,
+            row_count = EXCLUDED.row_count,
+            loaded_at = EXCLUDED.loaded_at""",
+            (source_file, mode.name, checksum, *stat, len(df)),
+        )
     conn.commit()
 
 
+def create_manifest_table(c):
+    # file is the resolved path of an archive, as in the source_file column
+    cur = c.cursor()
+    cur.execute(
+        """CREATE TABLE IF NOT EXISTS extraction_manifest (
+                    file text,
+                    mode text,
+                    checksum text,
+                    row_count integer,
+                    loaded_at timestamp,
+                    PRIMARY KEY (file, mode)
+                    )"""
+    )
+    # size and mtime of the file when it was loaded, NULL in older manifests
+    cur.execute("ALTER TABLE extraction_manifest ADD COLUMN IF NOT EXISTS size bigint")
+    cur.execute(
+        "ALTER TABLE extraction_manifest "
+        "ADD COLUMN IF NOT EXISTS mtime double precision"
+    )
+    c.commit()
+
+
+def loaded_files(mode: Mode, c) -> dict[str, tuple[str, int, float]]:
+    """(checksum, size, mtime) of every file the manifest lists for a mode"""
+    cur = c.cursor()
+    cur.execute(
+        "SELECT file, checksum, size, mtime FROM extraction_manifest WHERE mode = %s",
+        (mode.name,),
+    )
+    return {file: tuple(entry) for file, *entry in cur.fetchall()}
+
+
+def restamp_manifest(c, file: str, modes: list[Mode], stat: tuple[int, float]):
+    """Record the stat of a file whose content is unchanged, e.g. after a copy"""
+    cur = c.cursor()
+    cur.execute(
+        "UPDATE extraction_manifest SET size = %s, mtime = %s "
+        "WHERE file = %s AND mode = ANY(%s)",
+        (*stat, file, [mode.name for mode in modes]),
+    )
+    c.commit()
+
+
+def file_stat(path) -> tuple[int, float]:
+    """(size, mtime) of an archive, over all its table files if it is columnar"""
+    path = pathlib.Path(path)
+    files = sorted(path.glob("*.parquet")) if path.is_dir() else [path]
+    stats = [file.stat() for file in files]
+    return (
+        sum(stat.st_size for stat in stats),
+        max((stat.st_mtime for stat in stats), default=0.0),
+    )
+
+
+def file_checksum(path) -> str:
+    """Checksum of an archive, over all its table files if it is columnar"""
+    digest = hashlib.sha256()
+    path = pathlib.Path(path)
+    files = sorted(path.glob("*.parquet")) if path.is_dir() else [path]
+    for file in files:
+        if path.is_dir():
+            digest.update(file.name.encode())
+        with open(file, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def stale_modes(
+    path, modes: list[Mode], loaded: dict[Mode, dict], force: bool = False
+) -> tuple[list[Mode], str, tuple[int, float], list[Mode]]:
+    """Modes an archive has to be loaded for, by comparing it with the manifest.
+
+    A file with the size and mtime the manifest lists is taken as unchanged
+    without reading it. Otherwise it is hashed, and if only its stat changed,
+    e.g. after a copy, the manifest entry just needs the new stat.
+
+    Returns the stale modes, the checksum if it was computed, the stat and the
+    modes whose manifest entries need the new stat.
+    """
+    stat = file_stat(path)
+    checksum = None
+    stale = []
+    restamp = []
+    for mode in modes:
+        entry = loaded[mode].get(str(path))
+        if not force and entry is not None and entry[1:] == stat:
+            continue
+        if checksum is None:
+            checksum = file_checksum(path)
+        if force or entry is None or entry[0] != checksum:
+            stale.append(mode)
+        else:
+            restamp.append(mode)
+    return stale, checksum, stat, restamp
+
+
+def archive_day(path: pathlib.Path) -> str:
+    """Day of an archive, e.g. 2022-11-01 of 2022-11-01.db.zst or 2022-11-01/"""
+    return path.name.removesuffix(".zst").removesuffix(".db")
+
+
+def is_daily(path: pathlib.Path) -> bool:
+    """Whether an archive is named after its day, the date rows fall back to"""
+    try:
+        datetime.date.fromisoformat(archive_day(path))
+    except ValueError:
+        return False
+    return True
+
+
+def archive_files(dblist: list[str]) -> list[pathlib.Path]:
+    """Expand directories in dblist to the archives they contain, resolved.
+
+    These are zstd archives and columnar archives, i.e. directories of
+    Parquet files. A day archived in both formats is only read from its
+    columnar archive, the one read faster. Archives not named after their day
+    are skipped with a warning.
+    """
+    files = []
+    for elem in dblist:
+        path = pathlib.Path(elem)
+        if path.is_dir() and not is_columnar(path):
+            files.extend(
+                sorted(
+                    child
+                    for child in path.iterdir()
+                    if child.suffix == ".zst" or is_columnar(child)
+                )
+            )
+        else:
+            files.append(path)
+    days = {}
+    for path in files:
+        if not is_daily(path):
+            print(f"Skipping {path}, its name is not a date like 2022-11-01.db.zst")
+            continue
+        day = archive_day(path)
+        if day not in days or (is_columnar(path) and not is_columnar(days[day])):
+            days[day] = path.resolve()
+    return list(days.values())
+
+
 def create_psql_table(mode: Mode, c):
     cur = c.cursor()
     if mode is Mode.STATION_DELAY:
@@ -177,73 +848,323 @@ def create_psql_table(mode: Mode, c):
                         )"""
         )
         c.commit()
+    # rows loaded before the manifest existed keep a NULL source_file
+    cur.execute(f"ALTER TABLE {mode.name} ADD COLUMN IF NOT EXISTS source_file text")
+    cur.execute(
+        f"""CREATE INDEX IF NOT EXISTS {mode.name}_source_file
+        ON {mode.name} (source_file)"""
+    )
+    c.commit()
 
 
-def calculate_delays(df: pl.DataFrame) -> pl.DataFrame:
-    df = df.filter(~pl.all(pl.col("^.*Time.*$").is_null()))
-    df = df.with_columns(
-        pl.col("^.*Time.*$").str.strptime(pl.Datetime, fmt="%+").cast(pl.Datetime)
+def parse_times(lf: pl.LazyFrame) -> pl.LazyFrame:
+    """Parse the time columns read as text, columnar archives hold parsed ones"""
+    text_times = [
+        name for name, dtype in lf.schema.items() if "Time" in name and dtype == pl.Utf8
+    ]
+    return lf.with_columns(
+        pl.col(text_times).str.strptime(pl.Datetime, fmt="%+").cast(pl.Datetime("us"))
     )
-    df = df.with_columns(
-        [
-            (pl.col("arrivalTimeEstimated") - pl.col("arrivalTimePlanned"))
-            .dt.seconds()
-            .alias("arrivalDelay"),
-            (pl.col("departureTimeEstimated") - pl.col("departureTimePlanned"))
-            .dt.seconds()
-            .alias("departureDelay"),
-        ]
+
+
+def calculate_delays(lf: pl.LazyFrame) -> pl.LazyFrame:
+    arrival_delay = (
+        (pl.col("arrivalTimeEstimated") - pl.col("arrivalTimePlanned"))
+        .dt.seconds()
+        .fill_null(0)
     )
-    df = df.with_columns(
-        [
-            pl.col("arrivalDelay").fill_null(strategy="zero"),
-            pl.col("departureDelay").fill_null(strategy="zero"),
-        ]
+    departure_delay = (
+        (pl.col("departureTimeEstimated") - pl.col("departureTimePlanned"))
+        .dt.seconds()
+        .fill_null(0)
     )
-    df = df.with_columns(
-        [
+    # departure boards have no arrival times
+    missing = [
+        pl.lit(None).cast(pl.Datetime("us")).alias(name)
+        for name in TIME_COLUMNS
+        if name not in lf.columns
+    ]
+    if missing:
+        lf = lf.with_columns(missing).select(
+            ["name", "transportation_name", "transportation_properties_trainNumber"]
+            + TIME_COLUMNS
+        )
+    return (
+        parse_times(lf.filter(~pl.all(pl.col("^.*Time.*$").is_null())))
+        .with_columns(
+            [
+                arrival_delay.alias("arrivalDelay"),
+                departure_delay.alias("departureDelay"),
+            ]
+        )
+        .with_columns(
             pl.when(pl.col("departureDelay") > pl.col("arrivalDelay"))
             .then(pl.col("departureDelay"))
             .otherwise(pl.col("arrivalDelay"))
-            .alias("delay"),
-        ]
+            .alias("delay")
+        )
     )
-    return df
 
 
-def calulate_date(df: pl.DataFrame, file_name: str) -> pl.DataFrame:
-    full_path = pathlib.PurePath(file_name).stem
-    date = full_path.removesuffix(".db")
-    df = df.with_columns(
-        [
+def calulate_date(lf: pl.LazyFrame, file_name: str) -> pl.LazyFrame:
+    date = datetime.datetime.fromisoformat(archive_day(pathlib.Path(file_name)))
+    # a timestamp whether the archive held text or parsed times
+    return (
+        parse_times(lf)
+        .with_columns(
             pl.when(pl.col("departureTimePlanned") > pl.col("arrivalTimePlanned"))
             .then(pl.col("departureTimePlanned"))
             .otherwise(pl.col("arrivalTimePlanned"))
-            .alias("date"),
-        ]
+            .fill_null(pl.lit(date))
+            .cast(pl.Datetime("us"))
+            .alias("date")
+        )
+        .drop(["departureTimePlanned", "arrivalTimePlanned"])
+    )
+
+
+def match_station_infos(
+    lf: pl.LazyFrame, registry: stations.StationRegistry
+) -> pl.LazyFrame:
+    """Keep the stops of an info's leg that its content mentions.
+
+    Stops resolve to a station of the registry by their id or name, and an
+    info mentions the stations whose names occur in it as whole words, so
+    "Nord" does not match "Nordbahnhof". Stops that are no station of the
+    registry match by their own name, as whole words as well.
+    """
+    resolve = functools.lru_cache(maxsize=None)(registry.resolve)
+    mentioned = functools.lru_cache(maxsize=None)(registry.mentioned)
+    words = functools.lru_cache(maxsize=None)(
+        lambda text: f" {stations.normalize_name(text or '')} "
     )
-    df = df.with_columns(pl.col("date").fill_null(pl.lit(date)))
-    df = df.drop("departureTimePlanned")
-    df = df.drop("arrivalTimePlanned")
-    return df
+
+    def mentions(row: dict) -> bool:
+        station = resolve((row["stop_parent_id"], row["stop_id"]), row["name"])
+        if station is not None:
+            return station in mentioned(row["content"])
+        name = words(row["name"])
+        return name.strip() != "" and name in words(row["content"])
+
+    return lf.filter(
+        pl.struct(["content", "name", "stop_id", "stop_parent_id"]).apply(
+            mentions, return_dtype=pl.Boolean
+        )
+    ).drop(["stop_id", "stop_parent_id"])
+
+
+def transform(
+    mode: Mode, lf: pl.LazyFrame, elem: str, station_file=STATION_FILE
+) -> pl.LazyFrame:
+    """Filtering and calculations of one mode as a single lazy plan"""
+    if mode is Mode.STATION_INFO:
+        lf = match_station_infos(lf, stations.load_stations(str(station_file)))
+    if mode is not Mode.STATION_INFO:
+        lf = lf.filter(~pl.all(pl.col("transportation_name").str.contains("Stadtbahn")))
+    if mode is Mode.STATION_DELAY:
+        lf = calculate_delays(lf)
+    if mode is not Mode.STATION_DELAY:
+        lf = calulate_date(lf, elem)
+    return lf
+
+
+def extract_mode(
+    mode: Mode,
+    source,
+    elem: str,
+    base_table: bool = False,
+    batch_size: int = 0,
+    departures: bool = False,
+    station_file=STATION_FILE,
+) -> pl.DataFrame:
+    """Query and transform one mode, batch by batch if batch_size is set.
+
+    Every batch is parsed and reduced by the streaming engine before the next
+    one is read, so only one batch of raw text is held in memory at a time.
+    Columnar archives are scanned directly, reading only the needed columns.
+    The streaming engine of polars 0.15 cannot run their joins yet.
+    """
+    if is_columnar(source):
+        lf = scan_columnar(mode, source, departures)
+        return transform(mode, lf, elem, station_file).collect()
+    if not batch_size:
+        df = read_db_to_df(mode, source, base_table, departures)
+        return transform(mode, df.lazy(), elem, station_file).collect()
+    batches = read_db_batches(mode, source, base_table, batch_size, departures)
+    return pl.concat(
+        [
+            transform(mode, batch.lazy(), elem, station_file).collect(streaming=True)
+            for batch in batches
+        ],
+        rechunk=True,
+    )
+
+
+def process_file(
+    elem: str,
+    modes: list[Mode],
+    indexes: bool,
+    in_memory: bool = False,
+    temp_dir=None,
+    source=None,
+    batch_size: int = 0,
+    departures: bool = False,
+    station_file=STATION_FILE,
+) -> dict[Mode, pl.DataFrame]:
+    """Query and transform one archive for every mode, decompressing it once.
+
+    If more than one mode reads the trips, legs and stops join, the join is
+    built once and shared by their queries. With departures, STATION_DELAY is
+    computed from the departure boards, archives from before the departures
+    table fall back to the trips.
+    """
+    frames = {}
+    try:
+        if source is None:
+            print(f"Extracting {elem}...")
+            source = decompress(elem, in_memory, temp_dir)
+        if departures and not has_table(source, "departures"):
+            print(f"{elem} has no departures, using its trips")
+            departures = False
+        modes_sharing_base = BASE_MODES.intersection(modes)
+        if departures:
+            modes_sharing_base.discard(Mode.STATION_DELAY)
+        if is_columnar(source):
+            # no indexes or shared join, only the scanned columns are read
+            indexes = False
+            modes_sharing_base = set()
+        if indexes and not has_table(source, "stops"):
+            # normalized layout, stops is a view over tables the miner indexes
+            indexes = False
+        if indexes:
+            print("Building indexes...")
+            start = time.perf_counter()
+            create_indexes(source)
+            print(f"Building indexes took {time.perf_counter() - start:.2f}s")
+        base_table = len(modes_sharing_base) > 1
+        if base_table:
+            print("Building shared join...")
+            start = time.perf_counter()
+            create_base_table(source)
+            print(f"Building shared join took {time.perf_counter() - start:.2f}s")
+        for mode in modes:
+            print(f"Reading and transforming {mode.name}...")
+            start = time.perf_counter()
+            frames[mode] = extract_mode(
+                mode, source, elem, base_table, batch_size, departures, station_file
+            )
+            print(f"{mode.name} took {time.perf_counter() - start:.2f}s")
+    finally:
+        if source is not None:
+            release(source)
+    return frames
+
+
+def extract_sequential(args, files: dict[str, list[Mode]]):
+    """Process files one by one, decompressing the next file in the background"""
+    names = list(files)
+    with ThreadPoolExecutor(max_workers=1) as prefetcher:
+        pending = None
+        try:
+            for i, elem in enumerate(names):
+                if pending is None:
+                    print(f"Extracting {elem}...")
+                    pending = prefetcher.submit(
+                        decompress, elem, args.in_memory, args.temp_dir
+                    )
+                source = pending.result()
+                pending = None
+                if i + 1 < len(names):
+                    print(f"Extracting {names[i + 1]}...")
+                    pending = prefetcher.submit(
+                        decompress, names[i + 1], args.in_memory, args.temp_dir
+                    )
+                yield elem, process_file(
+                    elem,
+                    files[elem],
+                    args.indexes,
+                    source=source,
+                    batch_size=args.batch_size,
+                    departures=args.delay_source == "departures",
+                    station_file=args.stations,
+                )
+        finally:
+            # the next archive is decompressed even if this one failed
+            if pending is not None and pending.exception() is None:
+                release(pending.result())
+
+
+def extract_parallel(args, files: dict[str, list[Mode]]):
+    # spawn instead of fork, forking after polars started its threads can hang
+    with ProcessPoolExecutor(
+        max_workers=args.jobs, mp_context=multiprocessing.get_context("spawn")
+    ) as processes:
+        futures = {
+            processes.submit(
+                process_file,
+                elem,
+                modes,
+                args.indexes,
+                args.in_memory,
+                args.temp_dir,
+                None,
+                args.batch_size,
+                args.delay_source == "departures",
+                args.stations,
+            ): elem
+            for elem, modes in files.items()
+        }
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+def write_pooled(
+    pool, mode: Mode, df: pl.DataFrame, elem: str, checksum: str, stat: tuple
+):
+    conn = pool.getconn()
+    try:
+        write_df_to_db(mode, df, conn, elem, checksum, stat)
+    finally:
+        pool.putconn(conn)
+    print(f"Wrote {mode.name} of {elem}")
 
 
 if __name__ == "__main__":
     args = parser.parse_args()
-    run_mode = Mode[args.mode]
-    for elem in args.dblist:
-        print(f"Extracting {elem}...")
-        zstd_to_temp(elem)
-        print("Reading source db...")
-        df = read_db_to_df(run_mode)
-        pathlib.Path("temp.db").unlink()
-        if run_mode is not Mode.STATION_INFO:
-            df = df.filter(
-                ~pl.all(pl.col("transportation_name").str.contains("Stadtbahn"))
-            )
-        print("Calculating and filtering...")
-        if run_mode is Mode.STATION_DELAY:
-            df = calculate_delays(df)
-        if run_mode is not Mode.STATION_DELAY:
-            df = calulate_date(df, elem)
-        write_df_to_db(run_mode, df)
+    run_modes = [Mode[name] for name in dict.fromkeys(args.mode or ["STATION_DELAY"])]
+    pool = connect(args)
+    conn = pool.getconn()
+    create_manifest_table(conn)
+    loaded = {}
+    for mode in run_modes:
+        create_psql_table(mode, conn)
+        loaded[mode] = loaded_files(mode, conn)
+    versions = {}
+    files = {}
+    for elem in archive_files(args.dblist):
+        modes, checksum, stat, restamp = stale_modes(
+            elem, run_modes, loaded, args.force
+        )
+        if restamp:
+            restamp_manifest(conn, str(elem), restamp, stat)
+        if not modes:
+            print(f"Skipping {elem}, already loaded")
+            continue
+        versions[str(elem)] = (checksum, stat)
+        files[str(elem)] = modes
+    pool.putconn(conn)
+    extract = extract_sequential if args.jobs == 1 else extract_parallel
+    with ThreadPoolExecutor(max_workers=args.connections) as writers:
+        # frames waiting for a connection are held in memory, wait for the
+        # oldest write once every connection has one queued
+        writes = collections.deque()
+        for elem, frames in extract(args, files):
+            for mode, df in frames.items():
+                writes.append(
+                    writers.submit(write_pooled, pool, mode, df, elem, *versions[elem])
+                )
+                while len(writes) > 2 * args.connections:
+                    writes.popleft().result()
+        for write in writes:
+            write.result()
+    pool.closeall()
@@ -0,0 +1,166 @@
+# main.py is a script run from extraction/, its tests import it by name. The
+# archive fixture is a small daily database of the wide layout, with the
+# columnar copy the miner writes of it, so the tests need the miner's source.
+import sqlite3
+import sys
+import zstandard
+
+from pathlib import Path
+
+import pytest
+
+EXTRACTION_DIR = Path(__file__).resolve().parent.parent
+MINING_DIR = EXTRACTION_DIR.parent / "mining"
+sys.path.insert(0, str(EXTRACTION_DIR))
+sys.path.append(str(MINING_DIR))
+
+import columnar  # noqa: E402
+
+DAY = "2022-11-01"
+
+SCHEMA = [
+    "CREATE TABLE trips (data_id INTEGER PRIMARY KEY)",
+    """CREATE TABLE legs (
+        data_id INTEGER PRIMARY KEY, data_trip_id INTEGER,
+        transportation_name VARCHAR, transportation_properties_trainNumber VARCHAR
+    )""",
+    """CREATE TABLE stops (
+        data_id INTEGER PRIMARY KEY, data_leg_id INTEGER, id VARCHAR,
+        parent_id VARCHAR, name VARCHAR, arrivalTimePlanned VARCHAR,
+        arrivalTimeEstimated VARCHAR, departureTimePlanned VARCHAR,
+        departureTimeEstimated VARCHAR
+    )""",
+    """CREATE TABLE hints (
+        data_id INTEGER PRIMARY KEY, data_leg_id INTEGER, content VARCHAR,
+        type VARCHAR
+    )""",
+    """CREATE TABLE infos (
+        data_id INTEGER PRIMARY KEY, data_leg_id INTEGER, id VARCHAR,
+        type VARCHAR, urlText VARCHAR, content VARCHAR
+    )""",
+]
+
+# (name, global id) of the stations in the station file of the fixture
+STATIONS = [
+    ("Nord", "de:08111:1"),
+    ("Nordbahnhof", "de:08111:2"),
+    ("Wernau (N)", "de:08116:3"),
+]
+# (leg, train number) of the legs, the last is a later crawl of the first train
+LEGS = [(1, "8001"), (2, "8002"), (3, "8003"), (4, "8001")]
+# (id, parent id, name) of the stops of every leg, the last is no station
+STOPS = [
+    ("de:08111:1:1:1", "de:08111:1", "Nord"),
+    ("de:08111:2:1:1", "de:08111:2", "Nordbahnhof"),
+    ("de:08116:3:2:2", "de:08116:3", "Wernau (N)"),
+    ("de:08111:77:1:1", "de:08111:77", "Station X"),
+]
+
+
+def write_station_file(path: Path):
+    lines = []
+    for name, station_id in STATIONS:
+        row = [""] * 16
+        row[0] = row[1] = name
+        row[3] = station_id
+        row[10] = "S1"
+        row[14], row[15] = "9,2", "48,8"
+        lines.append(";".join(row))
+    path.write_text("\n".join(lines) + "\n")
+
+
+def write_database(path: Path):
+    conn = sqlite3.connect(path)
+    for statement in SCHEMA:
+        conn.execute(statement)
+    for leg, train_number in LEGS:
+        conn.execute("INSERT INTO trips VALUES (?)", (leg,))
+        conn.execute(
+            "INSERT INTO legs VALUES (?, ?, ?, ?)",
+            (leg, leg, "S-Bahn S1", train_number),
+        )
+        for i, (stop_id, parent_id, name) in enumerate(STOPS):
+            planned = f"{DAY}T10:{10 * i + leg:02d}:00Z"
+            estimated = f"{DAY}T10:{10 * i + 2 * leg:02d}:00Z"
+            # the first stop has no arrival, the last no departure
+            conn.execute(
+                "INSERT INTO stops (data_leg_id, id, parent_id, name, "
+                "arrivalTimePlanned, arrivalTimeEstimated, departureTimePlanned, "
+                "departureTimeEstimated) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    leg,
+                    stop_id,
+                    parent_id,
+                    name,
+                    planned if i else None,
+                    estimated if i else None,
+                    planned if i < len(STOPS) - 1 else None,
+                    estimated if i < len(STOPS) - 1 else None,
+                ),
+            )
+    hints = [
+        (1, "Störung durch Notarzteinsatz", "RTIncident"),
+        (1, "Fahrradmitnahme", "Timetable"),
+        (3, "Verspätung wegen Bauarbeiten", "RTIncident"),
+        (3, "Verspätung wegen Weichenstörung", "RTIncident"),
+        (4, "Störung behoben", "RTIncident"),
+    ]
+    conn.executemany(
+        "INSERT INTO hints (data_leg_id, content, type) VALUES (?, ?, ?)", hints
+    )
+    infos = [
+        (1, "info-1", "stopInfo", "Aufzug", "Aufzug in Stuttgart Nordbahnhof defekt"),
+        (2, "info-2", "stopInfo", "Halt", "Halt in Station X entfällt"),
+        (2, "info-3", "lineInfo", "Bau", "Bauarbeiten zwischen Wernau (N) und Nord"),
+        # seen again on a later leg, the first one is kept
+        (4, "info-1", "stopInfo", "Aufzug", "Aufzug in Nord defekt"),
+    ]
+    conn.executemany(
+        "INSERT INTO infos (data_leg_id, id, type, urlText, content) "
+        "VALUES (?, ?, ?, ?, ?)",
+        infos,
+    )
+    conn.commit()
+    conn.close()
+
+
+@pytest.fixture(scope="session")
+def archive(tmp_path_factory):
+    """(daily database, its columnar archive, station file)"""
+    directory = tmp_path_factory.mktemp("archive")
+    db_path = directory / f"{DAY}.db"
+    write_database(db_path)
+    station_file = directory / "stations.csv"
+    write_station_file(station_file)
+    archive = columnar.write_archive(db_path, directory / "parquet")
+    return db_path, archive, station_file
+
+
+@pytest.fixture(scope="session")
+def compressed(archive, tmp_path_factory):
+    """zstd archives of the fixture database, as the miner writes them"""
+    db_path, _, _ = archive
+    directory = tmp_path_factory.mktemp("zst")
+    compressor = zstandard.ZstdCompressor()
+    paths = []
+    for day in (DAY, "2022-11-02"):
+        path = directory / f"{day}.db.zst"
+        path.write_bytes(compressor.compress(db_path.read_bytes()))
+        paths.append(path)
+    return paths
+
+
+@pytest.fixture
+def sources(archive):
+    """Every kind of source extract_mode reads, as (kind, source, batch_size)"""
+    db_path, columnar_archive, _ = archive
+    memory = sqlite3.connect(":memory:")
+    with sqlite3.connect(db_path) as conn:
+        conn.backup(memory)
+    yield [
+        ("file", db_path, 0),
+        ("memory", memory, 0),
+        ("batches", db_path, 2),
+        ("columnar", columnar_archive, 0),
+    ]
+    memory.close()
@@ -0,0 +1,80 @@
+import main
+
+
+def columnar_archive(path):
+    path.mkdir()
+    (path / "trips.parquet").write_bytes(b"")
+    return path
+
+
+def test_each_day_is_read_from_one_archive(tmp_path):
+    db_dir = tmp_path / "db"
+    parquet_dir = tmp_path / "parquet"
+    db_dir.mkdir()
+    parquet_dir.mkdir()
+    for day in ("2022-11-01", "2022-11-02"):
+        (db_dir / f"{day}.db.zst").write_bytes(b"")
+    (db_dir / "notes.txt").write_text("")
+    columnar = columnar_archive(parquet_dir / "2022-11-02")
+    files = main.archive_files([str(db_dir), str(parquet_dir)])
+    assert files == [(db_dir / "2022-11-01.db.zst").resolve(), columnar.resolve()]
+    # the preferred format does not depend on the order of the arguments
+    assert main.archive_files([str(parquet_dir), str(db_dir)]) == [
+        columnar.resolve(),
+        (db_dir / "2022-11-01.db.zst").resolve(),
+    ]
+
+
+def test_archives_are_keyed_by_their_resolved_path(tmp_path, monkeypatch):
+    archive = tmp_path / "a" / "2022-11-01.db.zst"
+    archive.parent.mkdir()
+    archive.write_bytes(b"")
+    monkeypatch.chdir(archive.parent)
+    assert main.archive_files(["2022-11-01.db.zst"]) == [archive.resolve()]
+    assert main.archive_files(["../a/2022-11-01.db.zst", str(archive)]) == [
+        archive.resolve()
+    ]
+
+
+def test_archives_not_named_after_their_day_are_skipped(tmp_path, capsys):
+    for name in ("2022-11-01.db.zst", "backup.db.zst", "2022-11-01-old.db.zst"):
+        (tmp_path / name).write_bytes(b"")
+    assert main.archive_files([str(tmp_path)]) == [
+        (tmp_path / "2022-11-01.db.zst").resolve()
+    ]
+    assert capsys.readouterr().out.count("Skipping") == 2
+
+
+def test_unchanged_archives_are_not_hashed(tmp_path, monkeypatch):
+    archive = tmp_path / "2022-11-01.db.zst"
+    archive.write_bytes(b"archive")
+    hashed = []
+    file_checksum = main.file_checksum
+    monkeypatch.setattr(
+        main, "file_checksum", lambda path: hashed.append(path) or file_checksum(path)
+    )
+    modes = [main.Mode.STATION_DELAY, main.Mode.STATION_INFO]
+    checksum, stat = file_checksum(archive), main.file_stat(archive)
+    loaded = {
+        main.Mode.STATION_DELAY: {str(archive): (checksum, *stat)},
+        main.Mode.STATION_INFO: {},
+    }
+    assert main.stale_modes(archive, modes[:1], loaded) == ([], None, stat, [])
+    assert hashed == []
+    # a mode not loaded yet needs the checksum for its manifest entry
+    stale = main.stale_modes(archive, modes, loaded)
+    assert stale == ([main.Mode.STATION_INFO], checksum, stat, [])
+    assert len(hashed) == 1
+
+    # the same content with a new mtime only needs the new stat
+    loaded[main.Mode.STATION_DELAY][str(archive)] = (checksum, stat[0], 0.0)
+    assert main.stale_modes(archive, modes[:1], loaded) == (
+        [],
+        checksum,
+        stat,
+        [main.Mode.STATION_DELAY],
+    )
+    archive.write_bytes(b"changed")
+    stale, changed, *_ = main.stale_modes(archive, modes[:1], loaded)
+    assert stale == modes[:1] and changed != checksum
+    assert main.stale_modes(archive, modes[:1], loaded, force=True)[0] == modes[:1]
@@ -0,0 +1,29 @@
+import polars as pl
+import main
+
+
+def test_copy_keeps_empty_strings_apart_from_null():
+    df = pl.DataFrame(
+        {
+            "name": ["", None, "Nord", "\\N"],
+            "trainNumber": [1, None, 3, 4],
+            "date": [None, None, None, None],
+        },
+        schema={"name": pl.Utf8, "trainNumber": pl.Int64, "date": pl.Datetime("us")},
+    )
+    lines = main.CopyStream(df).read().decode().splitlines()
+    # COPY reads an unquoted empty field as NULL, a quoted "" as an empty
+    # string and any other text, even \N, as it is
+    assert lines == ['"",1,', ",,", "Nord,3,", "\\N,4,"]
+
+
+def test_copy_streams_the_frame_in_chunks():
+    df = pl.DataFrame({"name": [f"stop {i}" for i in range(10)], "number": range(10)})
+    whole = main.CopyStream(df).read()
+    stream = main.CopyStream(df, chunk_rows=3)
+    # only one chunk is held as CSV, reads never cross into the next one
+    reads = list(iter(lambda: stream.read(8), b""))
+    assert b"".join(reads) == whole
+    assert all(len(data) <= 8 for data in reads)
+    assert len(stream.buffer) == len(b"".join(whole.splitlines(True)[9:]))
+    assert main.CopyStream(df.head(0)).read(8) == b""
@@ -0,0 +1,35 @@
+import shutil
+import sqlite3
+import main
+
+
+def test_indexes_serve_the_queries_without_changing_them(archive, tmp_path):
+    db_path, _, station_file = archive
+    copy = tmp_path / db_path.name
+    shutil.copy(db_path, copy)
+    before = {
+        mode: main.extract_mode(mode, copy, str(copy), station_file=station_file)
+        for mode in main.Mode
+    }
+    main.create_indexes(copy)
+    conn = sqlite3.connect(copy)
+    try:
+        names = {
+            name
+            for (name,) in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index'"
+            )
+        }
+        plan = " ".join(
+            row[-1]
+            for row in conn.execute(
+                "EXPLAIN QUERY PLAN " + main.mode_query(main.Mode.STATION_DELAY)
+            )
+        )
+    finally:
+        conn.close()
+    assert {"ix_legs_trip", "ix_stops_leg", "ix_hints_leg", "ix_infos_id"} <= names
+    assert "ix_stops_leg" in plan
+    for mode, expected in before.items():
+        df = main.extract_mode(mode, copy, str(copy), station_file=station_file)
+        assert df.frame_equal(expected, null_equal=True), mode
@@ -0,0 +1,117 @@
+import argparse
+import main
+import sqlite3
+
+
+def expected_frames(archive) -> dict:
+    db_path, _, station_file = archive
+    return {
+        mode: main.extract_mode(mode, db_path, str(db_path), station_file=station_file)
+        for mode in main.Mode
+    }
+
+
+def assert_frames(frames: dict, expected: dict):
+    assert list(frames) == list(expected)
+    for mode, df in frames.items():
+        assert df.frame_equal(expected[mode], null_equal=True), mode
+
+
+def test_archives_decompress_in_memory_or_to_a_temp_dir(archive, compressed, tmp_path):
+    _, _, station_file = archive
+    expected = expected_frames(archive)
+    for in_memory in (False, True):
+        frames = main.process_file(
+            str(compressed[0]),
+            list(main.Mode),
+            True,
+            in_memory,
+            tmp_path,
+            station_file=station_file,
+        )
+        assert_frames(frames, expected)
+        # the decompressed copy is removed once the archive is done
+        assert list(tmp_path.iterdir()) == []
+
+
+def memory_copy(db_path) -> sqlite3.Connection:
+    memory = sqlite3.connect(":memory:")
+    with sqlite3.connect(db_path) as conn:
+        conn.backup(memory)
+    return memory
+
+
+def test_modes_sharing_the_base_join_match_single_modes(archive, monkeypatch):
+    db_path, _, station_file = archive
+    built = []
+    create_base_table = main.create_base_table
+    monkeypatch.setattr(
+        main,
+        "create_base_table",
+        lambda source: built.append(source) or create_base_table(source),
+    )
+    single = {}
+    for mode in main.Mode:
+        single.update(
+            main.process_file(
+                str(db_path),
+                [mode],
+                False,
+                source=memory_copy(db_path),
+                station_file=station_file,
+            )
+        )
+    assert built == []
+    frames = main.process_file(
+        str(db_path),
+        list(main.Mode),
+        False,
+        source=memory_copy(db_path),
+        station_file=station_file,
+    )
+    assert len(built) == 1
+    assert_frames(frames, single)
+
+
+def test_parallel_extraction_matches_sequential(archive, compressed, tmp_path):
+    _, _, station_file = archive
+    args = argparse.Namespace(
+        jobs=2,
+        in_memory=False,
+        temp_dir=tmp_path,
+        indexes=True,
+        batch_size=main.BATCH_SIZE,
+        delay_source="trips",
+        stations=station_file,
+    )
+    files = {str(path): list(main.Mode) for path in compressed}
+    sequential = dict(main.extract_sequential(args, files))
+    parallel = dict(main.extract_parallel(args, files))
+    assert sorted(parallel) == sorted(sequential) == sorted(files)
+    for elem, frames in parallel.items():
+        assert_frames(frames, sequential[elem])
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_a_failed_archive_releases_the_prefetched_one(
+    compressed, tmp_path, monkeypatch
+):
+    def fail(*args, **kwargs):
+        raise ValueError
+
+    monkeypatch.setattr(main, "extract_mode", fail)
+    args = argparse.Namespace(
+        in_memory=False,
+        temp_dir=tmp_path,
+        indexes=False,
+        batch_size=0,
+        delay_source="trips",
+        stations=None,
+    )
+    files = {str(path): [main.Mode.STATION_DELAY] for path in compressed}
+    try:
+        list(main.extract_sequential(args, files))
+    except ValueError:
+        pass
+    # neither the failed archive nor the next one are left decompressed
+    assert list(tmp_path.iterdir()) == []
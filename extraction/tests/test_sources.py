@@ -0,0 +1,83 @@
+import sqlite3
+import polars as pl
+import main
+
+DAY = "2022-11-01"
+
+
+def extract(mode: main.Mode, source, batch_size: int, station_file) -> pl.DataFrame:
+    return main.extract_mode(
+        mode, source, f"{DAY}.db.zst", batch_size=batch_size, station_file=station_file
+    )
+
+
+def test_every_source_gives_the_same_frames(archive, sources):
+    _, _, station_file = archive
+    for mode in main.Mode:
+        expected = extract(mode, sources[0][1], 0, station_file)
+        assert len(expected), mode
+        for kind, source, batch_size in sources[1:]:
+            df = extract(mode, source, batch_size, station_file)
+            assert df.schema == expected.schema, (mode, kind)
+            assert df.frame_equal(expected, null_equal=True), (mode, kind)
+
+
+def test_dates_are_timestamps(archive, sources):
+    _, _, station_file = archive
+    for kind, source, batch_size in sources:
+        for mode in (main.Mode.TRAIN_INCIDENT, main.Mode.STATION_INFO):
+            df = extract(mode, source, batch_size, station_file)
+            assert df.schema["date"] == pl.Datetime("us"), (mode, kind)
+
+
+def test_groups_keep_their_first_row(archive, sources):
+    _, _, station_file = archive
+    for kind, source, batch_size in sources:
+        incidents = extract(main.Mode.TRAIN_INCIDENT, source, batch_size, station_file)
+        # train 8001 is seen on legs 1 and 4, train 8003 has two incidents
+        by_train = {
+            train: set(contents)
+            for train, contents in incidents.groupby(
+                "transportation_properties_trainNumber"
+            )
+            .agg(pl.col("content"))
+            .rows()
+        }
+        assert by_train == {
+            "8001": {"Störung durch Notarzteinsatz"},
+            "8003": {"Verspätung wegen Bauarbeiten"},
+        }, kind
+        assert incidents["transportation_properties_trainNumber"].is_sorted(), kind
+        delays = extract(main.Mode.STATION_DELAY, source, batch_size, station_file)
+        first = delays.filter(
+            (pl.col("transportation_properties_trainNumber") == "8001")
+            & (pl.col("name") == "Nordbahnhof")
+        )
+        assert first["departureDelay"].to_list() == [60], kind
+
+
+def test_batch_sizes_give_the_same_frames(archive):
+    db_path, _, station_file = archive
+    for mode in main.Mode:
+        expected = extract(mode, db_path, 0, station_file)
+        for batch_size in (1, 3, len(expected), 10_000):
+            df = extract(mode, db_path, batch_size, station_file)
+            assert df.frame_equal(expected, null_equal=True), (mode, batch_size)
+
+
+def test_empty_results_keep_their_columns(archive):
+    db_path, _, station_file = archive
+    empty = sqlite3.connect(":memory:")
+    with sqlite3.connect(db_path) as conn:
+        conn.backup(empty)
+    empty.execute("DELETE FROM hints")
+    empty.execute("DELETE FROM infos")
+    for mode in (main.Mode.TRAIN_INCIDENT, main.Mode.STATION_INFO):
+        batches = list(main.read_db_batches(mode, empty, batch_size=2))
+        whole = main.read_db_to_df(mode, empty)
+        assert len(batches) == 1 and batches[0].is_empty(), mode
+        assert batches[0].columns == whole.columns, mode
+        df = extract(mode, empty, 2, station_file)
+        assert df.is_empty(), mode
+        assert df.columns == extract(mode, empty, 0, station_file).columns, mode
+    empty.close()
@@ -0,0 +1,57 @@
+import pathlib
+import polars as pl
+import main
+import stations
+
+
+def station_infos(source, batch_size: int, station_file) -> set[tuple[str, str]]:
+    df = main.extract_mode(
+        main.Mode.STATION_INFO,
+        source,
+        "2022-11-01.db.zst",
+        batch_size=batch_size,
+        station_file=station_file,
+    )
+    return set(zip(df["id"], df["name"]))
+
+
+def test_infos_match_the_stations_they_mention(archive, sources):
+    _, _, station_file = archive
+    expected = {
+        ("info-1", "Nordbahnhof"),
+        # no station of the registry, matched by its own name
+        ("info-2", "Station X"),
+        ("info-3", "Wernau (N)"),
+        ("info-3", "Nord"),
+    }
+    for kind, source, batch_size in sources:
+        assert station_infos(source, batch_size, station_file) == expected, kind
+
+
+def test_short_names_do_not_match_longer_ones():
+    registry = stations.StationRegistry(
+        [
+            [name, name, "", station_id] + [""] * 12
+            for name, station_id in (("Nord", "de:08111:1"), ("Nordbahnhof", "x:2"))
+        ]
+    )
+    lf = pl.DataFrame(
+        {
+            "content": ["Sperrung Nordbahnhof", "Sperrung Nord", "Halt in Nordheim"],
+            "name": ["Nord", "Nord", "Nord"],
+            "stop_id": ["de:08111:1:1:1", None, None],
+            "stop_parent_id": [None, None, None],
+        }
+    ).lazy()
+    df = main.match_station_infos(lf, registry).collect()
+    assert df["content"].to_list() == ["Sperrung Nord"]
+    assert df.columns == ["content", "name"]
+
+
+def test_the_registry_is_the_miners():
+    # extraction/stations.py is a copy, kept so main.py does not import the
+    # miner's source tree
+    copy = pathlib.Path(stations.__file__)
+    assert copy.parent == pathlib.Path(main.__file__).parent
+    miners = copy.parent.parent / "mining" / "stations.py"
+    assert copy.read_text() == miners.read_text()
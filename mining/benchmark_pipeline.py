@@ -0,0 +1,158 @@
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import socket
+import tempfile
+import time
+import urllib.request
+
+from datetime import datetime
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(fixture: str, port: int, options: dict) -> multiprocessing.Process:
+    """Stand-in endpoint in its own process, so it does not compete for the GIL"""
+    import replay
+
+    context = multiprocessing.get_context("spawn")
+    server = context.Process(
+        target=replay.serve, args=(fixture, port), kwargs=options, daemon=True
+    )
+    server.start()
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            server_stats(port)
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError("stand-in server did not start")
+
+
+def server_stats(port: int) -> dict:
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/stats", timeout=5) as r:
+        return json.load(r)
+
+
+def recorded_coverage(entries: list[dict], station_rows: list[list[str]]) -> dict:
+    """planner.recorded_coverage of the successful responses of a fixture"""
+    import planner
+    import stations
+
+    responses = {
+        (entry["origin"], entry["destination"]): entry["response"].get("journeys", [])
+        for entry in entries
+        if entry.get("status", 200) == 200
+    }
+    return planner.recorded_coverage(responses, stations.StationRegistry(station_rows))
+
+
+def run(args) -> dict:
+    """Crawl all planned queries against the stand-in into a temporary daily db"""
+    # configuration is read from the environment when the modules are imported
+    os.environ["USE_PROXIES"] = "0"
+    os.environ["RESPONSE_CACHE_MODE"] = "off"
+    os.environ["QUERY_PLANNER"] = "1" if args.planner else "0"
+    os.environ["BULK_INSERT"] = "0" if args.orm else "1"
+    os.environ["STORAGE_PROFILE"] = args.profile
+    os.environ["STORAGE_LAYOUT"] = args.layout
+    os.environ["MAX_CONCURRENT_REQUESTS"] = str(args.concurrency)
+    os.environ["REQUESTS_PER_SECOND"] = str(args.rate)
+    os.environ["FLUSH_SIZE"] = str(args.flush_size)
+    import crawler
+    import db
+    import download
+    import metrics
+    import replay
+    import utils
+
+    stations = utils.read_station_ids_csv("vvs_sbahn_haltestellen_2022.csv")
+    stations = stations[: args.stations]
+    coverage = recorded_coverage(
+        replay.read_fixture(args.fixture),
+        [utils.registry.by_id[station] for station in stations],
+    )
+
+    port = free_port()
+    server = start_server(
+        args.fixture,
+        port,
+        {
+            "latency": args.latency,
+            "jitter": args.jitter,
+            "failure_rate": args.failure_rate,
+            "timeout_rate": args.timeout_rate,
+        },
+    )
+    crawler.TRIP_API_URL = f"http://127.0.0.1:{port}{replay.TRIP_PATH}"
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            engine = db.create_sqlite_engine(os.path.join(directory, "benchmark.db"))
+            db.create_tables(engine)
+            db.ENGINE = engine
+            db.SESSION = db.sessionmaker(bind=engine)()
+            start = time.perf_counter()
+            trips = download.get_all_trips(stations, datetime.now())
+            elapsed = time.perf_counter() - start
+            with engine.connect() as connection:
+                rows = {
+                    table: connection.exec_driver_sql(
+                        f"SELECT count(*) FROM {table}"
+                    ).scalar()
+                    for table in db.layout_tables()
+                }
+            db.SESSION.close()
+            engine.dispose()
+        stats = server_stats(port)
+    finally:
+        server.terminate()
+    return {
+        "requests": stats["requests"],
+        "requests/s": round(stats["requests"] / elapsed, 1),
+        "trips": trips,
+        "trips/s": round(trips / elapsed, 1),
+        "rows/s": round(sum(rows.values()) / elapsed, 1),
+        "rows": rows,
+        "seconds": round(elapsed, 2),
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024),
+        "injected_failures": stats["failures"],
+        # planned against full sweep, both answered from the fixture
+        "planner": coverage,
+        "injected_timeouts": stats["timeouts"],
+        # where the time went, summed over all requests and flushes
+        "stage_seconds": {
+            series: histogram["sum"]
+            for series, histogram in metrics.REGISTRY.report()["histograms"].items()
+        },
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Throughput of get_all_trips and the trip writer against "
+        "recorded responses, without network access"
+    )
+    parser.add_argument("fixture", help="Fixture written by replay.py")
+    parser.add_argument("--stations", type=int, default=30)
+    parser.add_argument("--planner", action="store_true", help="Use the query planner")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--rate", type=float, default=0, help="0 for no rate cap")
+    parser.add_argument("--flush-size", type=int, default=500)
+    parser.add_argument("--orm", action="store_true", help="Insert through the ORM")
+    parser.add_argument("--profile", default="fast")
+    parser.add_argument("--layout", choices=["wide", "normalized"], default="wide")
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--timeout-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    print(json.dumps(run(args), indent=2))
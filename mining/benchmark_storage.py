@@ -0,0 +1,168 @@
+import argparse
+import os
+import tempfile
+import time
+import db
+
+
+def synthetic_trip(number: int, delay: int = 0) -> dict:
+    """Trip dict shaped like an EFA rapidJSON journey with one S-Bahn leg.
+
+    The estimated times are delay minutes, at most 20, after the planned ones.
+    """
+    stops = []
+    for i in range(12):
+        time = f"2022-11-01T10:{i * 3:02d}:00Z"
+        estimated = f"2022-11-01T10:{i * 3 + min(delay, 20):02d}:00Z"
+        stops.append(
+            {
+                "isGlobalId": True,
+                "id": f"de:08111:{6000 + i}:1:1",
+                "name": f"Station {i}",
+                "disassembledName": "Gleis 1",
+                "type": "platform",
+                "pointType": "Gleis",
+                "coord": [48.7 + i / 100, 9.1 + i / 100],
+                "niveau": 0,
+                "parent": {
+                    "isGlobalId": True,
+                    "id": f"de:08111:{6000 + i}",
+                    "name": f"Station {i}",
+                    "type": "stop",
+                    "parent": {
+                        "id": "8111000",
+                        "name": "Stuttgart",
+                        "type": "locality",
+                    },
+                    "properties": {"stopId": str(5006000 + i)},
+                    "coord": [48.7 + i / 100, 9.1 + i / 100],
+                },
+                "productClasses": [1, 3, 5],
+                "arrivalTimePlanned": time,
+                "arrivalTimeEstimated": estimated,
+                "departureTimePlanned": time,
+                "departureTimeEstimated": estimated,
+                "properties": {
+                    "AREA_NIVEAU_DIVA": "0",
+                    "stoppingPointPlanned": "1",
+                    "areaGid": f"de:08111:{6000 + i}:1",
+                    "area": "1",
+                    "platform": "1",
+                    "platformName": "1",
+                },
+            }
+        )
+    return {
+        "rating": 0,
+        "interchanges": 0,
+        "legs": [
+            {
+                "duration": 2160,
+                "isRealtimeControlled": True,
+                "realtimeStatus": ["MONITORED"],
+                "transportation": {
+                    "id": "ddb:10001: :H:j22",
+                    "name": "S-Bahn S1",
+                    "disassembledName": "S1",
+                    "number": "S1",
+                    "product": {"id": 0, "class": 1, "name": "S-Bahn", "iconId": 2},
+                    "operator": {"code": "DB", "id": "DB", "name": "DB Regio"},
+                    "destination": {"id": "5006002", "name": "Herrenberg"},
+                    "properties": {
+                        "trainType": "S",
+                        "trainNumber": str(8000 + number % 500),
+                        "tripCode": number,
+                    },
+                },
+                "hints": [{"content": "Fahrradmitnahme", "type": "Timetable"}],
+                "stopSequence": stops,
+                "infos": [],
+            }
+        ],
+    }
+
+
+def synthetic_sweeps(trips: int, trains: int, sweeps: int) -> list[dict]:
+    """Trips of repeated sweeps that observe the same trains again.
+
+    Every train is returned for trips / trains requests per sweep, like an
+    S-Bahn shared by many station pairs. Every third train runs a minute later
+    on every other sweep.
+    """
+    return [
+        synthetic_trip(number % trains, sweep // 2 if number % trains % 3 == 0 else 0)
+        for sweep in range(sweeps)
+        for number in range(trips)
+    ]
+
+
+def run(
+    profile: str,
+    trips: int,
+    batch: int,
+    layout: str = "wide",
+    trains: int = 0,
+    sweeps: int = 1,
+) -> dict:
+    """Insert trips in batches of one transaction each, like the trip writer.
+
+    Without trains every trip is a train of its own, seen by a single sweep.
+    """
+    if trains:
+        observed = synthetic_sweeps(trips, trains, sweeps)
+    else:
+        observed = [synthetic_trip(i) for i in range(trips)]
+    batches = []
+    for start in range(0, len(observed), batch):
+        end = start + batch
+        batches.append(observed[start:end])
+    insert = db.insert_bulk if layout == "wide" else db.insert_normalized
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "benchmark.db")
+        engine = db.create_sqlite_engine(path, profile)
+        db.create_tables(engine, layout)
+        start = time.perf_counter()
+        for trip_batch in batches:
+            # parsing is part of the work the pipeline does per trip
+            insert(engine, db.parse_trips(trip_batch))
+        elapsed = time.perf_counter() - start
+        with engine.connect() as connection:
+            rows = sum(
+                connection.exec_driver_sql(f'SELECT count(*) FROM "{table}"').scalar()
+                for table in db.layout_tables(layout)
+            )
+        db.compact(engine)
+        return {
+            "profile": profile,
+            "layout": layout,
+            "trips/s": round(len(observed) / elapsed),
+            "seconds": round(elapsed, 2),
+            "rows": rows,
+            "size_mb": round(os.path.getsize(path) / 2**20, 1),
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare trip insert throughput of the SQLite storage profiles "
+        "and layouts"
+    )
+    parser.add_argument("--trips", type=int, default=20000)
+    parser.add_argument("--batch", type=int, default=500)
+    parser.add_argument(
+        "--layout", choices=["wide", "normalized"], action="append", dest="layouts"
+    )
+    parser.add_argument(
+        "--trains",
+        type=int,
+        default=0,
+        help="Distinct trains the trips of a sweep share, 0 for one train per trip",
+    )
+    parser.add_argument("--sweeps", type=int, default=1, help="Sweeps with --trains")
+    parser.add_argument("profiles", nargs="*", default=list(db.STORAGE_PROFILES.keys()))
+    args = parser.parse_args()
+    for layout in args.layouts or ["wide"]:
+        for profile in args.profiles:
+            print(
+                run(profile, args.trips, args.batch, layout, args.trains, args.sweeps)
+            )
@@ -0,0 +1,244 @@
+import asyncio
+import concurrent.futures
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import zlib
+import crawler
+
+from datetime import datetime
+
+# "on" reads fresh responses and stores new ones, "replay" only reads and
+# never goes upstream, "off" disables the cache
+RESPONSE_CACHE_MODE = os.environ.get("RESPONSE_CACHE_MODE", "on")
+RESPONSE_CACHE = os.environ.get("RESPONSE_CACHE", "/data/responses.db")
+# query times are rounded down to buckets of that many seconds
+CACHE_BUCKET = int(os.environ.get("CACHE_BUCKET", 300))
+# a response answers identical queries for that long, replay ignores it
+CACHE_TTL = int(os.environ.get("CACHE_TTL", 600))
+# older responses are evicted, then the least recently used ones until the
+# cache is below CACHE_MAX_MB
+CACHE_MAX_AGE = int(os.environ.get("CACHE_MAX_AGE", 7 * 24 * 3600))
+CACHE_MAX_MB = int(os.environ.get("CACHE_MAX_MB", 512))
+# puts per transaction, the cache is written from the event loop
+CACHE_COMMIT_EVERY = 200
+# destination under which the departure board of a station is recorded
+DEPARTURE_BOARD = ""
+
+
+def time_bucket(time: datetime, bucket: int = CACHE_BUCKET) -> datetime:
+    timestamp = int(time.timestamp())
+    return datetime.fromtimestamp(timestamp - timestamp % bucket)
+
+
+def request_key(origin: str, destination: str, time: datetime) -> str:
+    """Hash of the request parameters, with the time rounded to its bucket"""
+    if destination == DEPARTURE_BOARD:
+        params = crawler.departure_params(
+            origin, time_bucket(time), crawler.DEPARTURE_LIMIT
+        )
+    else:
+        params = crawler.trip_params(origin, destination, time_bucket(time))
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+class ResponseCache:
+    """Trip and departure responses by request, stored once per distinct content.
+
+    Requests map to the hash of their response, so the many identical
+    responses, e.g. empty ones, are stored once. Bodies are zlib compressed
+    JSON of the journeys returned by Crawler.get_trips, or of the departures
+    returned by Crawler.get_departures for the DEPARTURE_BOARD destination.
+
+    The crawler calls lookup and store, which run the sqlite calls on a
+    thread of the cache instead of blocking the event loop. The plain methods
+    are for callers outside of the event loop.
+    """
+
+    def __init__(self, path: str = RESPONSE_CACHE, replay: bool = False):
+        self.replay = replay
+        self.hits = 0
+        self.misses = 0
+        self.pending = 0
+        # one thread, so the connection is never used by two at a time
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS requests (
+                key TEXT PRIMARY KEY,
+                origin TEXT,
+                destination TEXT,
+                bucket INTEGER,
+                digest TEXT,
+                created REAL,
+                accessed REAL
+            )"""
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS ix_requests_pair "
+            "ON requests (origin, destination, bucket)"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS ix_requests_accessed ON requests (accessed)"
+        )
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS bodies (
+                digest TEXT PRIMARY KEY,
+                body BLOB,
+                size INTEGER
+            )"""
+        )
+        self.conn.commit()
+
+    def get(self, origin: str, destination: str, time: datetime) -> list[dict]:
+        """Cached journeys, None on a miss.
+
+        When replaying, the TTL is ignored and a pair without a response in
+        the time bucket falls back to its response nearest in time.
+        """
+        row = self.conn.execute(
+            """SELECT requests.key, requests.created, bodies.body FROM requests
+            JOIN bodies ON requests.digest = bodies.digest
+            WHERE requests.key = ?""",
+            (request_key(origin, destination, time),),
+        ).fetchone()
+        if row is None and self.replay:
+            row = self.conn.execute(
+                """SELECT requests.key, requests.created, bodies.body FROM requests
+                JOIN bodies ON requests.digest = bodies.digest
+                WHERE requests.origin = ? AND requests.destination = ?
+                ORDER BY abs(requests.bucket - ?) LIMIT 1""",
+                (origin, destination, int(time_bucket(time).timestamp())),
+            ).fetchone()
+        if row is None or (not self.replay and row[1] < _now() - CACHE_TTL):
+            self.misses += 1
+            return None
+        self.hits += 1
+        if not self.replay:
+            self.conn.execute(
+                "UPDATE requests SET accessed = ? WHERE key = ?", (_now(), row[0])
+            )
+            self._written()
+        return json.loads(zlib.decompress(row[2]))
+
+    async def lookup(self, origin: str, destination: str, time: datetime) -> list[dict]:
+        """get, run on the thread of the cache"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, self.get, origin, destination, time
+        )
+
+    async def store(
+        self, origin: str, destination: str, time: datetime, trips: list[dict]
+    ):
+        """put, run on the thread of the cache"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            self.executor, self.put, origin, destination, time, trips
+        )
+
+    def put(self, origin: str, destination: str, time: datetime, trips: list[dict]):
+        body = zlib.compress(json.dumps(trips).encode())
+        digest = hashlib.sha256(body).hexdigest()
+        now = _now()
+        self.conn.execute(
+            "INSERT OR IGNORE INTO bodies (digest, body, size) VALUES (?, ?, ?)",
+            (digest, body, len(body)),
+        )
+        self.conn.execute(
+            """INSERT OR REPLACE INTO requests
+            (key, origin, destination, bucket, digest, created, accessed)
+            VALUES (?, ?, ?, ?, ?, ?, ?)""",
+            (
+                request_key(origin, destination, time),
+                origin,
+                destination,
+                int(time_bucket(time).timestamp()),
+                digest,
+                now,
+                now,
+            ),
+        )
+        self._written()
+
+    def _written(self):
+        self.pending += 1
+        if self.pending >= CACHE_COMMIT_EVERY:
+            self.conn.commit()
+            self.pending = 0
+
+    def latest_trips(self) -> dict[tuple[str, str], list[dict]]:
+        """Journeys of the latest recorded response of every trip pair"""
+        # SQLite takes the bare columns from the row of the max()
+        rows = self.conn.execute(
+            """SELECT latest.origin, latest.destination, bodies.body FROM (
+                SELECT origin, destination, digest, max(bucket) FROM requests
+                WHERE destination != ? GROUP BY origin, destination
+            ) AS latest JOIN bodies ON latest.digest = bodies.digest""",
+            (DEPARTURE_BOARD,),
+        )
+        return {
+            (origin, destination): json.loads(zlib.decompress(body))
+            for origin, destination, body in rows
+        }
+
+    def evict(self, max_age: int = CACHE_MAX_AGE, max_mb: int = CACHE_MAX_MB):
+        """Drop old responses, then least recently used ones above the size"""
+        self.conn.execute("DELETE FROM requests WHERE created < ?", (_now() - max_age,))
+        self._delete_orphans()
+        size = self.conn.execute("SELECT coalesce(sum(size), 0) FROM bodies").fetchone()
+        excess = size[0] - max_mb * 2**20
+        if excess > 0:
+            # requests sharing a body keep it alive, drop the oldest in chunks
+            while excess > 0:
+                deleted = self.conn.execute(
+                    """DELETE FROM requests WHERE key IN (
+                    SELECT key FROM requests ORDER BY accessed LIMIT 1000)"""
+                ).rowcount
+                freed = self._delete_orphans()
+                excess -= freed
+                if not deleted:
+                    break
+        self.conn.commit()
+
+    def _delete_orphans(self) -> int:
+        """Delete bodies no request refers to, returns the bytes freed"""
+        freed = self.conn.execute(
+            """SELECT coalesce(sum(size), 0) FROM bodies WHERE digest NOT IN
+            (SELECT digest FROM requests)"""
+        ).fetchone()[0]
+        self.conn.execute(
+            "DELETE FROM bodies WHERE digest NOT IN (SELECT digest FROM requests)"
+        )
+        return freed
+
+    def report(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        # lookups and stores still queued finish first
+        self.executor.shutdown()
+        if not self.replay:
+            self.evict()
+        self.conn.commit()
+        self.conn.close()
+
+
+def _now() -> float:
+    return time.time()
+
+
+def open_cache() -> ResponseCache:
+    """Cache configured by RESPONSE_CACHE_MODE, None if it is off"""
+    if RESPONSE_CACHE_MODE == "off":
+        return None
+    return ResponseCache(replay=RESPONSE_CACHE_MODE == "replay")
@@ -0,0 +1,172 @@
+# Columnar copies of the daily databases, one Parquet file per table:
+#
+#   /data/parquet/2022-11-06/trips.parquet, legs.parquet, stops.parquet, ...
+#
+# Columns are typed from the declared SQLite types. The ISO time strings become
+# UTC timestamps and the stringified coordinate lists become lists of floats.
+# Text columns are dictionary encoded by the Parquet writer and every file is
+# zstd compressed, so a reader decompresses only the columns it scans. Views are
+# written like tables, a normalized database gets its wide views materialized.
+import argparse
+import datetime
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from pathlib import Path
+
+# write a columnar archive of every finished daily database
+COLUMNAR_ARCHIVE = os.environ.get("COLUMNAR_ARCHIVE", "1") == "1"
+COLUMNAR_DIR = os.environ.get("COLUMNAR_DIR", "/data/parquet")
+# rows per Parquet row group, also the rows held in memory while converting
+ROW_GROUP_SIZE = 100_000
+COMPRESSION = "zstd"
+
+SQLITE_TYPES = {
+    "INTEGER": pa.int64(),
+    "BOOLEAN": pa.bool_(),
+    "VARCHAR": pa.string(),
+}
+TIME_TYPE = pa.timestamp("s", tz="UTC")
+COORD_TYPE = pa.list_(pa.float64())
+# columns holding str() of a coordinate or a list of coordinates
+COORD_TYPES = {
+    "coord": COORD_TYPE,
+    "parent_coord": COORD_TYPE,
+    "interchange_coords": pa.list_(COORD_TYPE),
+}
+SKIPPED_TABLES = {"sqlite_stat1", "sqlite_sequence"}
+# errors of write_archive, an archive that failed is retried by the next run
+ARCHIVE_ERRORS = (OSError, sqlite3.Error, pa.ArrowException)
+
+
+def column_type(name: str, declared: str) -> pa.DataType:
+    if name in COORD_TYPES:
+        return COORD_TYPES[name]
+    if declared == "VARCHAR" and name.endswith(("TimePlanned", "TimeEstimated")):
+        return TIME_TYPE
+    return SQLITE_TYPES.get(declared.upper(), pa.string())
+
+
+def table_schema(conn: sqlite3.Connection, table: str) -> pa.Schema:
+    columns = conn.execute(f'PRAGMA table_info("{table}")').fetchall()
+    return pa.schema(
+        [(name, column_type(name, declared)) for _, name, declared, *_ in columns]
+    )
+
+
+def parse_time(value: str):
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_coords(value: str):
+    try:
+        return json.loads(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def fit_coords(coords, type: pa.DataType):
+    """coords if they convert to type, otherwise None"""
+    try:
+        pa.array([coords], type)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return None
+    return coords
+
+
+def to_array(values: list, type: pa.DataType) -> pa.Array:
+    if type == TIME_TYPE:
+        text = pa.array(values, pa.string())
+        try:
+            return pc.cast(text, TIME_TYPE)
+        except pa.ArrowInvalid:
+            # not every value is in the EFA format, parse them one by one
+            return pa.array([parse_time(value) for value in values], TIME_TYPE)
+    if type in COORD_TYPES.values():
+        coords = [parse_coords(value) for value in values]
+        try:
+            return pa.array(coords, type)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            # not every value has the declared shape, check them one by one
+            return pa.array([fit_coords(value, type) for value in coords], type)
+    if type == pa.bool_():
+        # SQLite stores booleans as 0 and 1
+        return pc.cast(pa.array(values, pa.int64()), type)
+    return pa.array(values, type)
+
+
+def write_table(conn: sqlite3.Connection, table: str, path: Path) -> int:
+    """Copy a table into a Parquet file, ROW_GROUP_SIZE rows at a time"""
+    schema = table_schema(conn, table)
+    columns = ", ".join(f'"{name}"' for name in schema.names)
+    cur = conn.execute(f'SELECT {columns} FROM "{table}"')
+    count = 0
+    with pq.ParquetWriter(path, schema, compression=COMPRESSION) as writer:
+        while True:
+            rows = cur.fetchmany(ROW_GROUP_SIZE)
+            if not rows:
+                break
+            arrays = [
+                to_array(list(values), field.type)
+                for values, field in zip(zip(*rows), schema)
+            ]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            count += len(rows)
+    return count
+
+
+def write_archive(db_path, out_dir=COLUMNAR_DIR) -> Path:
+    """Columnar archive of a daily database, named after the database file.
+
+    The files are written to a temporary directory next to the archive and
+    moved in place once all tables are written, so readers never see a partial
+    archive.
+    """
+    db_path = Path(db_path)
+    target = Path(out_dir) / db_path.name.removesuffix(".db")
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp_dir = Path(tempfile.mkdtemp(prefix=f".{target.name}-", dir=target.parent))
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        tables = [
+            name
+            for (name,) in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type IN ('table', 'view')"
+            )
+            if name not in SKIPPED_TABLES
+        ]
+        for table in tables:
+            write_table(conn, table, tmp_dir / f"{table}.parquet")
+        # mkdtemp creates the directory readable by the owner only
+        tmp_dir.chmod(0o755)
+        if target.exists():
+            shutil.rmtree(target)
+        os.replace(tmp_dir, target)
+    finally:
+        conn.close()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return target
+
+
+def has_archive(db_path, out_dir=COLUMNAR_DIR) -> bool:
+    return (Path(out_dir) / Path(db_path).name.removesuffix(".db")).is_dir()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert daily databases into columnar archives"
+    )
+    parser.add_argument("databases", nargs="+", help="Decompressed daily databases")
+    parser.add_argument("--out", default=COLUMNAR_DIR)
+    args = parser.parse_args()
+    for database in args.databases:
+        print(write_archive(database, args.out))
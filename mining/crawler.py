@@ -0,0 +1,302 @@
+import asyncio
+import os
+import time
+import aiohttp
+import discord_logging
+import metrics
+import proxies
+import scheduler
+
+from datetime import datetime
+
+TRIP_API_URL = "https://www3.vvs.de/mngvvs/XML_TRIP_REQUEST2"
+DEPARTURE_API_URL = "https://www3.vvs.de/vvs/widget/XML_DM_REQUEST"
+# departures requested per station, a departure board covers about two hours
+DEPARTURE_LIMIT = int(os.environ.get("DEPARTURE_LIMIT", 100))
+
+# upper bound of requests in flight, independent of the number of stations. The
+# actual limit is adapted to timeouts and throttling by the scheduler.
+MAX_CONCURRENT_REQUESTS = int(os.environ.get("MAX_CONCURRENT_REQUESTS", 32))
+# keep-alive connections kept open per (host, proxy) pair
+MAX_CONNECTIONS_PER_HOST = int(os.environ.get("MAX_CONNECTIONS_PER_HOST", 16))
+# idle keep-alive connections, one pool per proxy, stay open that many seconds
+KEEPALIVE_TIMEOUT = 60
+
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(sock_connect=3.05, sock_read=6.1)
+RETRY_TRIES = int(os.environ.get("RETRY_TRIES", 5))
+# base and cap of the jittered exponential backoff between tries, in seconds
+RETRY_DELAY = 1
+RETRY_MAX_DELAY = 30
+
+
+def trip_params(origin: str, destination: str, time: datetime) -> dict:
+    """Query parameters of an EFA trip request, mirroring vvspy.get_trips"""
+    return {
+        "SpEncId": "0",
+        "calcOneDirection": "1",
+        "changeSpeed": "normal",
+        "computationType": "sequence",
+        "coordOutputFormat": "EPSG:4326",
+        "cycleSpeed": "14",
+        "deleteAssignedStops": "0",
+        "deleteITPTWalk": "0",
+        "descWithElev": "1",
+        "illumTransfer": "on",
+        "imparedOptionsActive": "1",
+        "itOptionsActive": "1",
+        "itdDate": time.strftime("%Y%m%d"),
+        "itdTime": time.strftime("%H%M"),
+        "language": "de",
+        "locationServerActive": "1",
+        "macroWebTrip": "true",
+        "name_destination": destination,
+        "name_origin": origin,
+        "noElevationProfile": "1",
+        "noElevationSummary": "1",
+        "outputFormat": "rapidJSON",
+        "outputOptionsActive": "1",
+        "ptOptionsActive": "1",
+        "routeType": "leasttime",
+        "searchLimitMinutes": "360",
+        "securityOptionsActive": "1",
+        "serverInfo": "1",
+        "showInterchanges": "1",
+        "trITArrMOT": "100",
+        "trITArrMOTvalue": "15",
+        "trITDepMOT": "100",
+        "trITDepMOTvalue": "15",
+        "tryToFindLocalityStops": "1",
+        "type_destination": "any",
+        "type_origin": "any",
+        "useElevationData": "1",
+        "useLocalityMainStop": "0",
+        "useRealtime": "1",
+        "useUT": "1",
+        "version": "10.2.10.139",
+        "w_objPrefAl": "12",
+        "w_regPrefAm": "1",
+    }
+
+
+def departure_params(station: str, time: datetime, limit: int) -> dict:
+    """Query parameters of an EFA departure request, mirroring vvspy.get_departures"""
+    return {
+        "locationServerActive": "1",
+        "lsShowTrainsExplicit": "1",
+        "stateless": "1",
+        "language": "de",
+        "SpEncId": "0",
+        "anySigWhenPerfectNoOtherMatches": "1",
+        "limit": str(limit),
+        "depArr": "departure",
+        "type_dm": "any",
+        "anyObjFilter_dm": "2",
+        "deleteAssignedStops": "1",
+        "name_dm": station,
+        "mode": "direct",
+        "dmLineSelectionAll": "1",
+        "useRealtime": "1",
+        "outputFormat": "json",
+        "coordOutputFormat": "WGS84[DD.ddddd]",
+        "itdDateYear": time.strftime("%Y"),
+        "itdDateMonth": time.strftime("%m"),
+        "itdDateDay": time.strftime("%d"),
+        "itdTimeHour": time.strftime("%H"),
+        "itdTimeMinute": time.strftime("%M"),
+    }
+
+
+def request_outcome(err: Exception) -> str:
+    """Metrics label of a failed request"""
+    if isinstance(err, asyncio.TimeoutError):
+        return "timeout"
+    status = getattr(err, "status", None)
+    if status == 429:
+        return "throttled"
+    if status is not None and status >= 500:
+        return "server_error"
+    if isinstance(err, ValueError):
+        return "invalid_response"
+    return "error"
+
+
+class Crawler:
+    """Shared aiohttp session with a global limit on requests in flight.
+
+    All requests go through one connection pool, so connections to the EFA
+    endpoint are kept alive and reused across origin stations instead of
+    every station opening its own session in its own thread.
+
+    Requests without an explicit proxy take one from the proxy pool, if any,
+    and report back how it did.
+
+    Trip requests are scheduled adaptively: a token bucket caps the rate, the
+    number of requests in flight follows AIMD driven by timeouts, 429 and 5xx
+    answers, and a circuit breaker pauses all requests while the endpoint is
+    overloaded.
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int = MAX_CONCURRENT_REQUESTS,
+        limit_per_host: int = MAX_CONNECTIONS_PER_HOST,
+        proxy_pool: proxies.ProxyPool = None,
+    ):
+        self.max_concurrent = max_concurrent
+        self.limit_per_host = limit_per_host
+        self.proxy_pool = proxy_pool
+        self.limiter = scheduler.AdaptiveLimiter(
+            min(scheduler.MIN_CONCURRENT_REQUESTS, max_concurrent), max_concurrent
+        )
+        self.bucket = scheduler.TokenBucket()
+        self.breaker = scheduler.CircuitBreaker()
+        self.retries = 0
+        self.failed = 0
+        self.session: aiohttp.ClientSession = None
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(
+            limit=self.max_concurrent,
+            limit_per_host=self.limit_per_host,
+            ttl_dns_cache=300,
+            keepalive_timeout=KEEPALIVE_TIMEOUT,
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector, timeout=REQUEST_TIMEOUT
+        )
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.session.close()
+
+    async def get_json(self, url: str, params: dict, proxy: str = None) -> dict:
+        if proxy is not None or self.proxy_pool is None:
+            return await self.fetch_json(url, params, proxy)
+        proxy = self.proxy_pool.acquire()
+        started = time.monotonic()
+        ok = None
+        try:
+            result = await self.fetch_json(url, params, proxy)
+            ok = True
+            return result
+        except Exception:
+            ok = False
+            raise
+        finally:
+            if proxy is not None:
+                self.proxy_pool.release(proxy, time.monotonic() - started, ok)
+
+    async def fetch_json(self, url: str, params: dict, proxy: str = None) -> dict:
+        """Unscheduled request, for probes that must not count as trip traffic"""
+        async with self.session.get(url, params=params, proxy=proxy) as r:
+            r.raise_for_status()
+            return await r.json(content_type=None, encoding="UTF-8")
+
+    def record_failure(self, err: Exception, sent: float, probe: bool) -> float:
+        """Feed a failed try to the scheduler, returns the Retry-After in seconds.
+
+        Timeouts and 5xx answers count against the endpoint's health. A 429 only
+        throttles the concurrency, the endpoint is fine but asks us to slow down.
+        """
+        status = getattr(err, "status", None)
+        overloaded = isinstance(err, asyncio.TimeoutError) or (
+            isinstance(err, aiohttp.ClientResponseError) and status >= 500
+        )
+        if overloaded or status == 429:
+            self.limiter.on_congestion(sent)
+        if overloaded:
+            self.breaker.on_congestion(probe)
+        else:
+            self.breaker.on_error(probe)
+        headers = getattr(err, "headers", None) or {}
+        try:
+            return float(headers.get("Retry-After", 0))
+        except ValueError:
+            return 0
+
+    async def attempt(
+        self, url: str, params: dict, proxy: str, probe: bool
+    ) -> tuple[dict, float]:
+        """One try, (result, 0) on success or (None, Retry-After) on failure"""
+        loop = asyncio.get_running_loop()
+        await self.bucket.acquire()
+        # the loop clock is time.monotonic, the scheduler uses it as well
+        sent = loop.time()
+        try:
+            result = await self.get_json(url, params, proxy)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as err:
+            discord_logging.warning(err)
+            outcome = request_outcome(err)
+            metrics.observe(
+                "mining_request_seconds", loop.time() - sent, outcome=outcome
+            )
+            metrics.inc("mining_requests_total", outcome=outcome)
+            return None, self.record_failure(err, sent, probe)
+        metrics.observe("mining_request_seconds", loop.time() - sent, outcome="ok")
+        metrics.inc("mining_requests_total", outcome="ok")
+        self.limiter.on_success()
+        self.breaker.on_success()
+        return result or {}, 0
+
+    async def get_scheduled(self, url: str, params: dict, proxy: str = None) -> dict:
+        """Scheduled request with retries, None if every try failed"""
+        for attempt in range(RETRY_TRIES):
+            async with self.limiter:
+                # checked once a slot is free, queued requests may be stale
+                probe = await self.breaker.wait()
+                try:
+                    result, retry_after = await self.attempt(url, params, proxy, probe)
+                finally:
+                    # a probe ended by anything else, e.g. a cancellation, must
+                    # not keep every other request waiting for its outcome
+                    if probe:
+                        self.breaker.probing = False
+            if result is not None:
+                return result
+            if attempt < RETRY_TRIES - 1:
+                self.retries += 1
+                metrics.inc("mining_retries_total")
+                delay = scheduler.backoff_delay(attempt, RETRY_DELAY, RETRY_MAX_DELAY)
+                await asyncio.sleep(max(delay, retry_after))
+        self.failed += 1
+        metrics.inc("mining_failed_queries_total")
+        return None
+
+    async def get_trips(
+        self,
+        start: str,
+        destination: str,
+        time: datetime,
+        proxy: str = None,
+        limit: int = 5,
+    ) -> list[dict]:
+        """Raw journeys between two stations, None if every try failed"""
+        params = trip_params(start, destination, time)
+        result = await self.get_scheduled(TRIP_API_URL, params, proxy)
+        if result is None:
+            discord_logging.info("trips was null in retry function")
+            return None
+        return (result.get("journeys") or [])[:limit]
+
+    async def get_departures(
+        self, station: str, time: datetime, limit: int = DEPARTURE_LIMIT
+    ) -> list[dict]:
+        """Raw departures of a station, None if every try failed"""
+        params = departure_params(station, time, limit)
+        result = await self.get_scheduled(DEPARTURE_API_URL, params)
+        if result is None:
+            return None
+        departures = result.get("departureList") or []
+        # a single departure is not wrapped in a list
+        if isinstance(departures, dict):
+            departures = [departures["departure"]]
+        return departures
+
+    def report(self) -> dict:
+        return {
+            "concurrency": round(self.limiter.limit, 1),
+            "concurrency_decreases": self.limiter.decreases,
+            "breaker_openings": self.breaker.openings,
+            "retries": self.retries,
+            "failed_queries": self.failed,
+        }
@@ -0,0 +1,224 @@
+# Long-running miner. Instead of a process per hour started by the timer, one
+# process keeps the proxy pool, the HTTP session, the response cache and the
+# database engine open and polls on its own cadence:
+#
+#   departure boards of all stations   every DEPARTURE_INTERVAL seconds
+#   trip sweep over the query plan     every TRIP_INTERVAL seconds
+#   compaction of past daily databases every COMPACT_INTERVAL seconds
+#
+# A trip sweep skips pairs whose last response is still current: the departures
+# its journeys start with are still ahead and the latest departure board of the
+# origin shows the estimates the response had, so the request would return the
+# same journeys. Every pair is fetched again once its response is older than
+# TRIP_MAX_AGE. The daily database rolls over at midnight through db.daily_db,
+# the finished one is compacted and archived in the background afterwards.
+import asyncio
+import concurrent.futures
+import os
+import signal
+import time
+import cache
+import crawler
+import db
+import discord_logging
+import download
+import metrics
+import proxies
+import utils
+
+from datetime import datetime, timezone
+
+DEPARTURE_INTERVAL = float(os.environ.get("DEPARTURE_INTERVAL", 1800))
+TRIP_INTERVAL = float(os.environ.get("TRIP_INTERVAL", 3600))
+COMPACT_INTERVAL = float(os.environ.get("COMPACT_INTERVAL", 3600))
+# a pair is fetched at least that often, even if its response looks current
+TRIP_MAX_AGE = float(os.environ.get("TRIP_MAX_AGE", 3 * 3600))
+
+
+def first_departure(trip: dict) -> tuple:
+    """(line, planned, estimated) of the departure a journey starts with"""
+    try:
+        leg = trip["legs"][0]
+        number = leg["transportation"]["number"]
+        origin = leg["origin"]
+        return (
+            number,
+            origin["departureTimePlanned"],
+            origin.get("departureTimeEstimated"),
+        )
+    except (KeyError, IndexError, TypeError):
+        # e.g. a footpath first, it is not on the departure board
+        return None
+
+
+class PairTracker:
+    """Latest departure boards and the departures of the last trip responses"""
+
+    def __init__(self, max_age: float = TRIP_MAX_AGE):
+        self.max_age = max_age
+        # station -> {(line, planned): estimated}
+        self.boards: dict[str, dict[tuple, str]] = {}
+        # (origin, destination) -> (fetched at, [first_departure of every trip])
+        self.responses: dict[tuple[str, str], tuple[float, list[tuple]]] = {}
+        self.skipped = 0
+
+    def update_boards(self, departures: list[tuple[str, dict]]):
+        boards = {}
+        for station, departure in departures:
+            row = db.flatten_departure(station, departure)
+            if row is None:
+                continue
+            key = (row["transportation_number"], row["departureTimePlanned"])
+            boards.setdefault(station, {})[key] = row["departureTimeEstimated"]
+        self.boards.update(boards)
+
+    def fetched(self, origin: str, destination: str, trips: list[dict]):
+        departures = [first_departure(trip) for trip in trips]
+        self.responses[(origin, destination)] = (time.time(), departures)
+
+    def is_current(self, origin: str, destination: str) -> bool:
+        """Whether the last response would be returned again"""
+        last = self.responses.get((origin, destination))
+        if last is None:
+            return False
+        fetched, departures = last
+        if time.time() - fetched > self.max_age or None in departures:
+            return False
+        now = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        ahead = [departure for departure in departures if departure[1] > now]
+        board = self.boards.get(origin, {})
+        # a departure missing from the board counts as changed
+        current = bool(ahead) and all(
+            board.get((line, planned), "") == estimated
+            for line, planned, estimated in ahead
+        )
+        if current:
+            self.skipped += 1
+        return current
+
+
+async def every(interval: float, sweep, stop: asyncio.Event):
+    """Run sweep every interval seconds until stop is set"""
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        started = loop.time()
+        try:
+            await sweep()
+        except Exception as err:
+            discord_logging.error(err)
+        try:
+            await asyncio.wait_for(stop.wait(), interval - (loop.time() - started))
+        except asyncio.TimeoutError:
+            pass
+
+
+def export_metrics():
+    try:
+        metrics.export()
+    except OSError as err:
+        discord_logging.warning(f"Could not write metrics: {err}")
+
+
+async def run(stations: list[str]) -> int:
+    """Poll until SIGINT or SIGTERM, returns the number of trips written"""
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    tracker = PairTracker()
+    queue = asyncio.Queue(maxsize=download.QUEUE_SIZE)
+    # trips and departures are written by the same thread, so only one of them
+    # can roll the daily database over
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        writer = asyncio.create_task(download.trip_writer(queue, executor))
+        responses = None
+        try:
+            responses = cache.open_cache()
+            plan = download.plan_trip_queries(stations, responses)
+            proxy_pool = proxies.load_pool()
+            async with crawler.Crawler(proxy_pool=proxy_pool) as client:
+                await proxy_pool.validate(client)
+                discord_logging.info(f"Proxies: {len(proxy_pool)} usable")
+
+                async def departures():
+                    curr_time = datetime.now()
+                    with metrics.timer("mining_stage_seconds", stage="departures"):
+                        boards = await download.fetch_departures(
+                            client, stations, curr_time, responses
+                        )
+                        tracker.update_boards(boards)
+                        error = await loop.run_in_executor(
+                            executor, db.new_departures, boards
+                        )
+                    if error:
+                        discord_logging.error("Could not save departures: " + error)
+                    metrics.inc("mining_departures_total", len(boards))
+
+                async def trips():
+                    if proxies.USE_PROXIES and not len(client.proxy_pool):
+                        # every proxy was evicted, fetch a new list
+                        download.report_proxies(client.proxy_pool)
+                        client.proxy_pool = await loop.run_in_executor(
+                            None, proxies.load_pool
+                        )
+                        await client.proxy_pool.validate(client)
+                    skipped = tracker.skipped
+                    with metrics.timer("mining_stage_seconds", stage="trips"):
+                        await download.sweep_trips(
+                            client, plan, datetime.now(), queue, responses, tracker
+                        )
+                    discord_logging.info(
+                        f"Trip sweep: {tracker.skipped - skipped} current pairs skipped"
+                    )
+                    download.report_sweep(client, responses)
+                    if responses is not None:
+                        await loop.run_in_executor(responses.executor, responses.evict)
+                    export_metrics()
+
+                async def compaction():
+                    # on its own thread, VACUUM of a day takes minutes and
+                    # must not hold up the writes to the next one
+                    error = await loop.run_in_executor(None, db.compact_past_days)
+                    if error:
+                        discord_logging.error(
+                            "Could not compact or archive past days: " + error
+                        )
+
+                sweeps = [
+                    asyncio.create_task(every(DEPARTURE_INTERVAL, departures, stop)),
+                    asyncio.create_task(every(TRIP_INTERVAL, trips, stop)),
+                    asyncio.create_task(every(COMPACT_INTERVAL, compaction, stop)),
+                ]
+                await stop.wait()
+                discord_logging.info("Stopping")
+                for sweep in sweeps:
+                    sweep.cancel()
+                await asyncio.gather(*sweeps, return_exceptions=True)
+        finally:
+            # the cache is closed and the writer task finished even if the
+            # daemon fails
+            if responses is not None:
+                responses.close()
+            await queue.put(None)
+            written = await writer
+    return written
+
+
+if __name__ == "__main__":
+    discord_logging.initialise()
+    discord_logging.info("Starting miner daemon")
+    stations = utils.read_station_ids_csv("vvs_sbahn_haltestellen_2022.csv")
+    if cache.RESPONSE_CACHE_MODE == "replay":
+        raise SystemExit("replay mode runs once, use download.py")
+    if db.compact_past_days():
+        discord_logging.error("Could not compact or archive past days")
+    try:
+        tripCount = asyncio.run(run(stations))
+        db.close()
+        size = db.database_size()
+        metrics.gauge("mining_database_bytes", size)
+        discord_logging.finishLogging(tripCount, size)
+    except Exception as err:
+        discord_logging.error(err)
+        discord_logging.finishLogging(0, 0)
+    export_metrics()
@@ -1,22 +1,88 @@
-from datetime import datetime
+from datetime import datetime, timezone
 import functools
+import hashlib
+import json
+import os
+import sys
+import time
+import columnar
+import metrics
+import utils
 import sqlalchemy.exc
 from sqlalchemy import (
     create_engine,
+    event,
+    func,
+    select,
     Integer,
     Column,
     Sequence,
     Boolean,
     String,
     ForeignKey,
+    UniqueConstraint,
 )
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import sessionmaker, relationship
 from sqlalchemy.ext.declarative import declarative_base
 from pathlib import Path
+from zoneinfo import ZoneInfo
+
+# directory of the daily databases
+DB_DIR = os.environ.get("DB_DIR", "/data/db")
+Path(DB_DIR).mkdir(parents=True, exist_ok=True)
+# write trips with executemany over plain rows instead of the ORM unit of work
+BULK_INSERT = os.environ.get("BULK_INSERT", "1") == "1"
+# number of trips flattened and written per executemany round
+BULK_CHUNK_SIZE = int(os.environ.get("BULK_CHUNK_SIZE", 2000))
+# PRAGMAs applied to every connection of a daily database. page_size only takes
+# effect on new files, which is every file as they are created per day.
+STORAGE_PROFILES = {
+    "default": {},
+    "durable": {
+        "page_size": 4096,
+        "journal_mode": "WAL",
+        "synchronous": "FULL",
+    },
+    "fast": {
+        "page_size": 8192,
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -65536,
+        "mmap_size": 268435456,
+        "temp_store": "MEMORY",
+    },
+}
+# "default" keeps SQLite's rollback journal and full syncs. "fast" trades the
+# durability of the last transactions on power loss for write throughput.
+STORAGE_PROFILE = os.environ.get("STORAGE_PROFILE", "default")
+# "wide" stores every observed trip with all its legs and stops. "normalized"
+# stores stops, lines, trains and texts once per day and only the realtime
+# fields that changed since the last observation. Switch it at midnight, a
+# daily database keeps the layout it was created with.
+STORAGE_LAYOUT = os.environ.get("STORAGE_LAYOUT", "wide")
+
+
+def create_sqlite_engine(path: str, profile: str = STORAGE_PROFILE):
+    engine = create_engine(f"sqlite:///{path}")
+    pragmas = STORAGE_PROFILES[profile]
+
+    @event.listens_for(engine, "connect")
+    def apply_profile(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for key, value in pragmas.items():
+            cursor.execute(f"PRAGMA {key}={value}")
+        cursor.close()
+
+    return engine
+
+
+def daily_db_path(date) -> str:
+    return f"{DB_DIR}/{str(date)}.db"
+
 
-Path("/data/db").mkdir(exist_ok=True)
 CURRENT_DATE = datetime.now().date()
-ENGINE = create_engine(f"sqlite:////data/db/{str(CURRENT_DATE)}.db")
+ENGINE = create_sqlite_engine(daily_db_path(CURRENT_DATE))
 SESSION = sessionmaker(bind=ENGINE)()
 ENTITY_BASE = declarative_base()
 
@@ -168,8 +234,304 @@ class Hint(ENTITY_BASE):
     properties_subnet = Column(String, nullable=True)
 
 
-# Create all tables derived from the EntityBase object
-ENTITY_BASE.metadata.create_all(ENGINE)
+class Departure(ENTITY_BASE):
+    """Train departure of a departure board, one row per stop, trip and time.
+
+    Times are UTC ISO strings like the times of the stops table, a departure
+    seen again by a later run keeps its latest estimate.
+    """
+
+    __tablename__ = "departures"
+    __table_args__ = (UniqueConstraint("stop_id", "trip_code", "departureTimePlanned"),)
+    data_id = Column(Integer, primary_key=True, nullable=False)
+    stop_id = Column(String, nullable=False)
+    stop_name = Column(String, nullable=True)
+    platform = Column(String, nullable=True)
+    transportation_name = Column(String, nullable=True)
+    transportation_number = Column(String, nullable=True)
+    trip_code = Column(String, nullable=False)
+    train_number = Column(String, nullable=True)
+    direction = Column(String, nullable=True)
+    departureTimePlanned = Column(String, nullable=False)
+    departureTimeEstimated = Column(String, nullable=True)
+    realtime = Column(Boolean, nullable=True)
+
+
+# Normalized layout. Dimension tables hold every distinct stop, line, train,
+# stop event and text of the day once, interned by the writer. Fact tables hold
+# the realtime fields of an observation if they changed since the last one.
+NORMALIZED_BASE = declarative_base()
+
+
+class StopPoint(NORMALIZED_BASE):
+    """Static attributes of a stop, interned by their digest"""
+
+    __tablename__ = "stop_points"
+    data_id = Column(Integer, primary_key=True, nullable=False)
+    digest = Column(String, nullable=False, unique=True)
+    isGlobalId = Column(Boolean, nullable=True)
+    id = Column(String, nullable=True)
+    name = Column(String, nullable=True)
+    disassembledName = Column(String, nullable=True)
+    type = Column(String, nullable=True)
+    pointType = Column(String, nullable=True)
+    coord = Column(String, nullable=True)
+    niveau = Column(Integer, nullable=True)
+    parent_isGlobalId = Column(Boolean, nullable=True)
+    parent_id = Column(String, nullable=True)
+    parent_name = Column(String, nullable=True)
+    parent_disassembledName = Column(String, nullable=True)
+    parent_type = Column(String, nullable=True)
+    parent_parent_id = Column(String, nullable=True)
+    parent_parent_name = Column(String, nullable=True)
+    parent_parent_type = Column(String, nullable=True)
+    parent_properties_stopId = Column(String, nullable=True)
+    parent_coord = Column(String, nullable=True)
+    parent_niveau = Column(Integer, nullable=True)
+    productClasses = Column(String, nullable=True)
+    properties_areaNiveauDiva = Column(String, nullable=True)
+    properties_stoppingPointPlanned = Column(String, nullable=True)
+    properties_areaGid = Column(String, nullable=True)
+    properties_area = Column(String, nullable=True)
+    properties_platform = Column(String, nullable=True)
+    properties_platformName = Column(String, nullable=True)
+
+
+class Line(NORMALIZED_BASE):
+    """Transportation attributes shared by the trains of a line and direction"""
+
+    __tablename__ = "lines"
+    data_id = Column(Integer, primary_key=True, nullable=False)
+    digest = Column(String, nullable=False, unique=True)
+    transportation_id = Column(String, nullable=True)
+    transportation_name = Column(String, nullable=True)
+    transportation_disassembledName = Column(String, nullable=True)
+    transportation_number = Column(String, nullable=True)
+    transportation_description = Column(String, nullable=True)
+    transportation_product_id = Column(Integer, nullable=True)
+    transportation_product_class = Column(Integer, nullable=True)
+    transportation_product_name = Column(String, nullable=True)
+    transportation_product_iconId = Column(Integer, nullable=True)
+    transportation_operator_code = Column(String, nullable=True)
+    transportation_operator_id = Column(String, nullable=True)
+    transportation_operator_name = Column(String, nullable=True)
+    transportation_destination_id = Column(String, nullable=True)
+    transportation_destination_name = Column(String, nullable=True)
+    transportation_destination_type = Column(String, nullable=True)
+    transportation_properties_trainName = Column(String, nullable=True)
+    transportation_properties_trainType = Column(String, nullable=True)
+    transportation_properties_isROP = Column(Boolean, nullable=True)
+    transportation_properties_timetablePeriod = Column(String, nullable=True)
+    transportation_properties_lineDisplay = Column(String, nullable=True)
+
+
+class Train(NORMALIZED_BASE):
+    """Run of a train, interned by its line and train attributes"""
+
+    __tablename__ = "trains"
+    data_id = Column(Integer, primary_key=True, nullable=False)
+    line_id = Column(Integer, ForeignKey("lines.data_id"), nullable=False)
+    transportation_properties_trainNumber = Column(String, nullable=True)
+    transportation_properties_tripCode = Column(Integer, nullable=True)
+    transportation_properties_globalId = Column(String, nullable=True)
+    properties_vehicleAccess = Column(String, nullable=True)
+    properties_PlanWheelChairAccess = Column(String, nullable=True)
+
+
+class StopEvent(NORMALIZED_BASE):
+    """Planned stop of a train, interned by train, stop and planned times"""
+
+    __tablename__ = "stop_events"
+    data_id = Column(Integer, primary_key=True, nullable=False)
+    train_id = Column(Integer, ForeignKey("trains.data_id"), nullable=False)
+    stop_point_id = Column(Integer, ForeignKey("stop_points.data_id"), nullable=False)
+    arrivalTimePlanned = Column(String, nullable=True)
+    departureTimePlanned = Column(String, nullable=True)
+
+
+class HintText(NORMALIZED_BASE):
+    __tablename__ = "hint_texts"
+    data_id = Column(Integer, primary_key=True, nullable=False)
+    digest = Column(String, nullable=False, unique=True)
+    content = Column(String, nullable=True)
+    providerCode = Column(String, nullable=True)
+    type = Column(String, nullable=True)
+    properties_subnet = Column(String, nullable=True)
+
+
+class InfoText(NORMALIZED_BASE):
+    __tablename__ = "info_texts"
+    data_id = Column(Integer, primary_key=True, nullable=False)
+    digest = Column(String, nullable=False, unique=True)
+    priority = Column(String, nullable=True)
+    id = Column(String, nullable=True)
+    version = Column(String, nullable=True)
+    type = Column(String, nullable=True)
+    urlText = Column(String, nullable=True)
+    url = Column(String, nullable=True)
+    content = Column(String, nullable=True)
+    subtitle = Column(String, nullable=True)
+    title = Column(String, nullable=True)
+    properties_publisher = Column(String, nullable=True)
+    properties_infoType = Column(String, nullable=True)
+    properties_timetableChange = Column(String, nullable=True)
+    properties_htmlText = Column(String, nullable=True)
+    properties_smsText = Column(String, nullable=True)
+
+
+class Journey(NORMALIZED_BASE):
+    """Distinct combination of trains returned for a trip request"""
+
+    __tablename__ = "journeys"
+    data_id = Column(Integer, primary_key=True, nullable=False)
+    digest = Column(String, nullable=False, unique=True)
+    rating = Column(Integer, nullable=False)
+    isAdditional = Column(Boolean, nullable=True)
+    interchanges = Column(Integer, nullable=True)
+
+
+class JourneyLeg(NORMALIZED_BASE):
+    __tablename__ = "journey_legs"
+    data_id = Column(Integer, primary_key=True, nullable=False)
+    journey_id = Column(Integer, ForeignKey("journeys.data_id"), nullable=False)
+    position = Column(Integer, nullable=False)
+    train_id = Column(Integer, ForeignKey("trains.data_id"), nullable=False)
+    duration = Column(Integer, nullable=True)
+    interchange_desc = Column(String, nullable=True)
+    interchange_type = Column(Integer, nullable=True)
+    interchange_coords = Column(String, nullable=True)
+
+
+class JourneyPath(NORMALIZED_BASE):
+    __tablename__ = "journey_paths"
+    data_id = Column(Integer, primary_key=True, nullable=False)
+    journey_leg_id = Column(Integer, ForeignKey("journey_legs.data_id"))
+    turnDirection = Column(String, nullable=True)
+    manoeuvre = Column(String, nullable=True)
+    name = Column(String, nullable=True)
+    niveau = Column(Integer, nullable=True)
+    coord = Column(String, nullable=True)
+    skyDirection = Column(Integer, nullable=True)
+    duration = Column(Integer, nullable=True)
+    cumDuration = Column(Integer, nullable=True)
+    distance = Column(Integer, nullable=True)
+    cumDistance = Column(Integer, nullable=True)
+    fromCoordsIndex = Column(Integer, nullable=True)
+    toCoordsIndex = Column(Integer, nullable=True)
+    properties_INDOOR_TYPE = Column(String, nullable=True)
+
+
+class TrainObservation(NORMALIZED_BASE):
+    """Realtime status of a train whenever it changed"""
+
+    __tablename__ = "train_observations"
+    data_id = Column(Integer, primary_key=True, nullable=False)
+    train_id = Column(Integer, ForeignKey("trains.data_id"), nullable=False, index=True)
+    observed = Column(String, nullable=False)
+    isRealtimeControlled = Column(Boolean, nullable=True)
+    realtimeStatus = Column(String, nullable=True)
+
+
+class StopObservation(NORMALIZED_BASE):
+    """Estimated times of a stop event whenever they changed"""
+
+    __tablename__ = "stop_observations"
+    data_id = Column(Integer, primary_key=True, nullable=False)
+    stop_event_id = Column(
+        Integer, ForeignKey("stop_events.data_id"), nullable=False, index=True
+    )
+    observed = Column(String, nullable=False)
+    arrivalTimeEstimated = Column(String, nullable=True)
+    departureTimeEstimated = Column(String, nullable=True)
+
+
+class TrainHint(NORMALIZED_BASE):
+    """Hint shown for a train, recorded when it first appeared"""
+
+    __tablename__ = "train_hints"
+    data_id = Column(Integer, primary_key=True, nullable=False)
+    train_id = Column(Integer, ForeignKey("trains.data_id"), nullable=False)
+    hint_text_id = Column(Integer, ForeignKey("hint_texts.data_id"), nullable=False)
+    observed = Column(String, nullable=False)
+
+
+class TrainInfo(NORMALIZED_BASE):
+    """Info shown for a train, recorded when it first appeared"""
+
+    __tablename__ = "train_infos"
+    data_id = Column(Integer, primary_key=True, nullable=False)
+    train_id = Column(Integer, ForeignKey("trains.data_id"), nullable=False)
+    info_text_id = Column(Integer, ForeignKey("info_texts.data_id"), nullable=False)
+    observed = Column(String, nullable=False)
+
+
+def _view_columns(alias: str, model) -> list[str]:
+    return [
+        f"{alias}.{column.name}"
+        for column in model.__table__.columns
+        if column.name not in ("data_id", "digest", "observed")
+        and not column.foreign_keys
+    ]
+
+
+def _latest(alias: str, model, key: str, parent: str) -> str:
+    """Join of the latest observation of every row of the parent"""
+    table = model.__tablename__
+    return (
+        f"LEFT JOIN {table} AS {alias} ON {alias}.data_id = "
+        f"(SELECT max(data_id) FROM {table} WHERE {key} = {parent}.data_id)"
+    )
+
+
+# Views with the table names and columns of the wide layout, so readers of the
+# daily databases and their columnar archives work on both layouts. A leg is a
+# train run and its trip is the run itself, stops carry the latest estimates.
+NORMALIZED_VIEWS = {
+    "trips": "SELECT data_id FROM trains",
+    "legs": f"""SELECT t.data_id, t.data_id AS data_trip_id,
+        {", ".join(_view_columns("o", TrainObservation))},
+        {", ".join(_view_columns("l", Line))},
+        {", ".join(_view_columns("t", Train))}
+        FROM trains AS t
+        INNER JOIN lines AS l ON l.data_id = t.line_id
+        {_latest("o", TrainObservation, "train_id", "t")}""",
+    "stops": f"""SELECT e.data_id, e.train_id AS data_leg_id,
+        {", ".join(_view_columns("p", StopPoint))},
+        e.arrivalTimePlanned, o.arrivalTimeEstimated,
+        e.departureTimePlanned, o.departureTimeEstimated
+        FROM stop_events AS e
+        INNER JOIN stop_points AS p ON p.data_id = e.stop_point_id
+        {_latest("o", StopObservation, "stop_event_id", "e")}""",
+    "hints": f"""SELECT h.data_id, h.train_id AS data_leg_id,
+        {", ".join(_view_columns("x", HintText))}
+        FROM train_hints AS h
+        INNER JOIN hint_texts AS x ON x.data_id = h.hint_text_id""",
+    "infos": f"""SELECT i.data_id, i.train_id AS data_leg_id,
+        {", ".join(_view_columns("x", InfoText))}
+        FROM train_infos AS i
+        INNER JOIN info_texts AS x ON x.data_id = i.info_text_id""",
+}
+
+
+def create_tables(engine, layout: str = STORAGE_LAYOUT):
+    """Tables of the storage layout, the departures table is part of both"""
+    if layout == "wide":
+        ENTITY_BASE.metadata.create_all(engine)
+        return
+    NORMALIZED_BASE.metadata.create_all(engine)
+    ENTITY_BASE.metadata.create_all(engine, tables=[Departure.__table__])
+    with engine.begin() as connection:
+        for name, query in NORMALIZED_VIEWS.items():
+            connection.exec_driver_sql(f"CREATE VIEW IF NOT EXISTS {name} AS {query}")
+
+
+def layout_tables(layout: str = STORAGE_LAYOUT) -> list[str]:
+    base = ENTITY_BASE if layout == "wide" else NORMALIZED_BASE
+    return list(base.metadata.tables)
+
+
+# Create the tables of the configured layout in today's database
+create_tables(ENGINE)
 
 
 def daily_db(func):
@@ -178,328 +540,396 @@ def daily_db(func):
         global CURRENT_DATE
         global ENGINE
         global SESSION
-        global ENTITY_BASE
         new_date = datetime.now().date()
         if new_date > CURRENT_DATE:
-            ENGINE = create_engine(f"sqlite:////data/db/{str(new_date)}.db")
+            # compacting and archiving the finished day would stall this
+            # write, compact_past_days does it off the write path
+            SESSION.close()
+            ENGINE.dispose()
+            ENGINE = create_sqlite_engine(daily_db_path(new_date))
             SESSION = sessionmaker(bind=ENGINE)()
             CURRENT_DATE = new_date
-            ENTITY_BASE.metadata.create_all(ENGINE)
+            create_tables(ENGINE)
         return func(*args, **kwargs)
 
     return wrapper
 
 
-def new_trip(trip: dict):
-    legs = list()
-    for i in trip["legs"]:
-        if "trainType" not in i["transportation"]["properties"]:
-            # skip all other public transit methods except for trains
-            return
-        if "Bus" in str(i["transportation"]["properties"]["trainType"]):
-            # skip possible bus routes on trip
-            return
-        new_leg = Leg()
-        if "duration" in i:
-            new_leg.duration = int(i["duration"])
-        if "isRealtimeControlled" in i:
-            new_leg.isRealtimeControlled = bool(i["isRealtimeControlled"])
-        if "realtimeStatus" in i:
-            new_leg.realtimeStatus = str(i["realtimeStatus"])
-
-        if "transportation" in i:
-            if "id" in i["transportation"]:
-                new_leg.transportation_id = str(i["transportation"]["id"])
-            if "name" in i["transportation"]:
-                new_leg.transportation_name = str(i["transportation"]["name"])
-            if "disassembledName" in i["transportation"]:
-                new_leg.transportation_disassembledName = str(
-                    i["transportation"]["disassembledName"]
-                )
-            if "number" in i["transportation"]:
-                new_leg.transportation_number = str(i["transportation"]["number"])
-            if "description" in i["transportation"]:
-                new_leg.transportation_description = str(
-                    i["transportation"]["description"]
-                )
-            if "product" in i["transportation"]:
-                if "id" in i["transportation"]["product"]:
-                    new_leg.transportation_product_id = int(
-                        i["transportation"]["product"]["id"]
-                    )
-                if "class" in i["transportation"]["product"]:
-                    new_leg.transportation_product_class = int(
-                        i["transportation"]["product"]["class"]
-                    )
-                if "name" in i["transportation"]["product"]:
-                    new_leg.transportation_product_name = str(
-                        i["transportation"]["product"]["name"]
-                    )
-                if "iconId" in i["transportation"]["product"]:
-                    new_leg.transportation_product_iconId = int(
-                        i["transportation"]["product"]["iconId"]
-                    )
+def checkpoint(engine):
+    """Fold the WAL into the database file so it can be copied on its own"""
+    with engine.connect() as connection:
+        connection.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+        connection.exec_driver_sql("PRAGMA optimize")
 
-            if "operator" in i["transportation"]:
-                if "code" in i["transportation"]["operator"]:
-                    new_leg.transportation_operator_code = str(
-                        i["transportation"]["operator"]["code"]
-                    )
-                if "id" in i["transportation"]["operator"]:
-                    new_leg.transportation_operator_id = str(
-                        i["transportation"]["operator"]["id"]
-                    )
-                if "name" in i["transportation"]["operator"]:
-                    new_leg.transportation_operator_name = str(
-                        i["transportation"]["operator"]["name"]
-                    )
 
-            if "destination" in i["transportation"]:
-                if "id" in i["transportation"]["destination"]:
-                    new_leg.transportation_destination_id = str(
-                        i["transportation"]["destination"]["id"]
-                    )
-                if "name" in i["transportation"]["destination"]:
-                    new_leg.transportation_destination_name = str(
-                        i["transportation"]["destination"]["name"]
-                    )
-                if "type" in i["transportation"]["destination"]:
-                    new_leg.transportation_destination_type = str(
-                        i["transportation"]["destination"]["type"]
-                    )
+def compact(engine):
+    """Final pass over a daily database that will not be written to again.
 
-            if "properties" in i["transportation"]:
-                if "trainName" in i["transportation"]["properties"]:
-                    new_leg.transportation_properties_trainName = str(
-                        i["transportation"]["properties"]["trainName"]
-                    )
-                if "trainType" in i["transportation"]["properties"]:
-                    new_leg.transportation_properties_trainType = str(
-                        i["transportation"]["properties"]["trainType"]
-                    )
-                if "trainNumber" in i["transportation"]["properties"]:
-                    new_leg.transportation_properties_trainNumber = str(
-                        i["transportation"]["properties"]["trainNumber"]
-                    )
-                if "isROP" in i["transportation"]["properties"]:
-                    new_leg.transportation_properties_isROP = bool(
-                        i["transportation"]["properties"]["isROP"]
-                    )
-                if "tripCode" in i["transportation"]["properties"]:
-                    new_leg.transportation_properties_tripCode = int(
-                        i["transportation"]["properties"]["tripCode"]
-                    )
-                if "timetablePeriod" in i["transportation"]["properties"]:
-                    new_leg.transportation_properties_timetablePeriod = str(
-                        i["transportation"]["properties"]["timetablePeriod"]
-                    )
-                if "lineDisplay" in i["transportation"]["properties"]:
-                    new_leg.transportation_properties_lineDisplay = str(
-                        i["transportation"]["properties"]["lineDisplay"]
-                    )
-                if "globalId" in i["transportation"]["properties"]:
-                    new_leg.transportation_properties_globalId = str(
-                        i["transportation"]["properties"]["globalId"]
-                    )
+    Refreshes the query planner statistics, drops free pages and leaves a
+    single rollback-journal file behind, which keeps the zstd archive small.
+    user_version marks the file as compacted.
+    """
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+        connection.exec_driver_sql("ANALYZE")
+        connection.exec_driver_sql("VACUUM")
+        connection.exec_driver_sql("PRAGMA journal_mode=DELETE")
+        connection.exec_driver_sql("PRAGMA user_version=1")
+    engine.dispose()
 
-        if "hints" in i:
-            hint_list = list()
-            for hint in i["hints"]:
-                new_hint = Hint()
-                if "content" in hint:
-                    new_hint.content = str(hint["content"])
-                if "providerCode" in hint:
-                    new_hint.providerCode = str(hint["providerCode"])
-                if "type" in hint:
-                    new_hint.type = str(hint["type"])
-                if "subnet" in hint:
-                    new_hint.properties_subnet = str(hint["properties"]["subnet"])
-                hint_list.append(new_hint)
-            new_leg.hints = hint_list
-
-        if "stopSequence" in i:
-            stops = list()
-            for stop in i["stopSequence"]:
-                new_stop = Stop()
-                if "isGlobalId" in stop:
-                    new_stop.isGlobalId = bool(stop["isGlobalId"])
-                if "id" in stop:
-                    new_stop.id = str(stop["id"])
-                if "name" in stop:
-                    new_stop.name = str(stop["name"])
-                if "disassembledName" in stop:
-                    new_stop.disassembledName = str(stop["disassembledName"])
-                if "type" in stop:
-                    new_stop.type = str(stop["type"])
-                if "pointType" in stop:
-                    new_stop.pointType = str(stop["pointType"])
-                if "coord" in stop:
-                    new_stop.coord = str(stop["coord"])
-                if "niveau" in stop:
-                    new_stop.niveau = int(stop["niveau"])
-                if "isGlobalId" in stop["parent"]:
-                    new_stop.parent_isGlobalId = bool(stop["parent"]["isGlobalId"])
-                if "id" in stop["parent"]:
-                    new_stop.parent_id = str(stop["parent"]["id"])
-                if "name" in stop["parent"]:
-                    new_stop.parent_name = str(stop["parent"]["name"])
-                if "disassembledName" in stop["parent"]:
-                    new_stop.parent_disassembledName = str(
-                        stop["parent"]["disassembledName"]
-                    )
-                if "type" in stop["parent"]:
-                    new_stop.parent_type = str(stop["parent"]["type"])
-                if "parent" in stop["parent"]:
-                    new_stop.parent_parent_id = str(stop["parent"]["parent"]["id"])
-                    new_stop.parent_parent_name = str(stop["parent"]["parent"]["name"])
-                    new_stop.parent_parent_type = str(stop["parent"]["parent"]["type"])
-                if "properties" in stop["parent"]:
-                    if "stopId" in stop["parent"]["properties"]:
-                        new_stop.parent_properties_stopId = str(
-                            stop["parent"]["properties"]["stopId"]
-                        )
-                if "coord" in stop["parent"]:
-                    new_stop.parent_coord = str(stop["parent"]["coord"])
-                if "niveau" in stop["parent"]:
-                    new_stop.parent_niveau = int(stop["parent"]["niveau"])
-                if "productClass" in stop:
-                    new_stop.productClasses = str(stop["productClasses"])
-                if "departureTimePlanned" in stop:
-                    new_stop.departureTimePlanned = str(stop["departureTimePlanned"])
-                if "departureTimeEstimated" in stop:
-                    new_stop.departureTimeEstimated = str(
-                        stop["departureTimeEstimated"]
-                    )
-                if "arrivalTimePlanned" in stop:
-                    new_stop.arrivalTimePlanned = str(stop["arrivalTimePlanned"])
-                if "arrivalTimeEstimated" in stop:
-                    new_stop.arrivalTimeEstimated = str(stop["arrivalTimeEstimated"])
-                if "AREA_NIVEAU_DIVA" in stop["properties"]:
-                    new_stop.properties_areaNiveauDiva = str(
-                        stop["properties"]["AREA_NIVEAU_DIVA"]
-                    )
-                if "stoppingPointPlanned" in stop["properties"]:
-                    new_stop.properties_stoppingPointPlanned = str(
-                        stop["properties"]["stoppingPointPlanned"]
-                    )
-                if "areaGrid" in stop["properties"]:
-                    new_stop.properties_areaGid = str(stop["properties"]["areaGid"])
-                if "area" in stop["properties"]:
-                    new_stop.properties_area = str(stop["properties"]["area"])
-                if "platform" in stop["properties"]:
-                    new_stop.properties_platform = str(stop["properties"]["platform"])
-                if "platformName" in stop["properties"]:
-                    new_stop.properties_platformName = str(
-                        stop["properties"]["platformName"]
-                    )
-                stops.append(new_stop)
-
-            new_leg.stopSequence.extend(stops)
-
-        if "infos" in i:
-            info_list = list()
-            for info in i["infos"]:
-                new_info = Info()
-                if "priority" in info:
-                    new_info.priority = str(info["priority"])
-                if "id" in info:
-                    new_info.id = str(info["id"])
-                if "version" in info:
-                    new_info.version = str(info["version"])
-                if "type" in info:
-                    new_info.type = str(info["type"])
-                if "urlText" in info:
-                    new_info.urlText = str(info["urlText"])
-                if "url" in info:
-                    new_info.url = str(info["url"])
-                if "content" in info:
-                    new_info.content = str(info["content"])
-                if "subtitle" in info:
-                    new_info.subtitle = str(info["subtitle"])
-                if "title" in info:
-                    new_info.title = str(info["title"])
-                if "publisher" in info["properties"]:
-                    new_info.properties_publisher = str(info["properties"]["publisher"])
-                if "infoType" in info["properties"]:
-                    new_info.properties_infoType = str(info["properties"]["infoType"])
-                if "timetableChange" in info["properties"]:
-                    new_info.properties_timetableChange = str(
-                        info["properties"]["timetableChange"]
-                    )
-                if "htmlText" in info["properties"]:
-                    new_info.properties_htmlText = str(info["properties"]["htmlText"])
-                if "smsText" in info["properties"]:
-                    new_info.properties_smsText = str(info["properties"]["smsText"])
-                info_list.append(new_info)
-
-            new_leg.infos.extend(info_list)
-
-        if "pathDescriptions" in i:
-            pathDescriptions = list()
-            for desc in i["pathDescriptions"]:
-                new_desc = PathDescription()
-                if "turnDirection" in desc:
-                    new_desc.turnDirection = str(desc["turnDirection"])
-                if "manoeuvre" in desc:
-                    new_desc.manoeuvre = str(desc["manoeuvre"])
-                if "name" in desc:
-                    new_desc.name = str(desc["name"])
-                if "niveau" in desc:
-                    new_desc.niveau = int(desc["niveau"])
-                if "coord" in desc:
-                    new_desc.coord = str(desc["coord"])
-                if "skyDirection" in desc:
-                    new_desc.skyDirection = int(desc["skyDirection"])
-                if "duration" in desc:
-                    new_desc.duration = int(desc["duration"])
-                if "cumDuration" in desc:
-                    new_desc.cumDuration = int(desc["cumDuration"])
-                if "distance" in desc:
-                    new_desc.distance = int(desc["distance"])
-                if "cumDistance" in desc:
-                    new_desc.cumDistance = int(desc["cumDistance"])
-                if "fromCoordsIndex" in desc:
-                    new_desc.fromCoordsIndex = int(desc["fromCoordsIndex"])
-                if "toCoordsIndex" in desc:
-                    new_desc.toCoordsIndex = int(desc["toCoordsIndex"])
-                if "properties" in desc:
-                    new_desc.properties_INDOOR_TYPE = str(
-                        desc["properties"]["INDOOR_TYPE"]
-                    )
 
-                pathDescriptions.append(new_desc)
+def archive_columnar(path: str):
+    """Columnar copy of a finished daily database, unless disabled or present"""
+    if columnar.COLUMNAR_ARCHIVE and not columnar.has_archive(path):
+        columnar.write_archive(path)
 
-            new_leg.pathDescriptions.extend(pathDescriptions)
 
-        if "interchange" in i:
-            if "desc" in i["interchange"]:
-                new_leg.interchange_desc = str(i["interchange"]["desc"])
-            if "type" in i["interchange"]:
-                new_leg.interchange_type = int(i["interchange"]["type"])
-            if "coords" in i["interchange"]:
-                new_leg.interchange_coords = str(i["interchange"]["coords"])
+def compact_day(path: str):
+    """Compact and archive a finished daily database unless that is done already"""
+    engine = create_sqlite_engine(path, "default")
+    try:
+        with engine.connect() as connection:
+            compacted = connection.exec_driver_sql("PRAGMA user_version").scalar()
+        if not compacted:
+            compact(engine)
+        archive_columnar(path)
+    finally:
+        engine.dispose()
 
-        if "properties" in i:
-            if "vehicleAccess" in i["properties"]:
-                new_leg.properties_vehicleAccess = str(i["properties"]["vehicleAccess"])
-            if "PlanWheelChairAccess" in i["properties"]:
-                new_leg.properties_PlanWheelChairAccess = str(
-                    i["properties"]["PlanWheelChairAccess"]
-                )
-        legs.append(new_leg)
-
-    new_trip = Trip()
-    new_trip.rating = int(trip["rating"])
-    if "isAdditional" in trip:
-        new_trip.isAdditional = bool(trip["isAdditional"])
-    if "interchanges" in trip:
-        new_trip.interchanges = int(trip["interchanges"])
-    new_trip.legs = legs
+
+def compact_past_days():
+    """Compact and archive every daily database before today's.
+
+    Days the miner missed, e.g. after being down over midnight, are caught up
+    as well. Run at startup and, by the daemon, periodically in the
+    background, as the rollover of daily_db leaves the finished database as
+    it is. Returns the errors of the days that failed, None if none did.
+    """
+    errors = []
+    for path in sorted(Path(DB_DIR).glob("*.db")):
+        try:
+            day = datetime.strptime(path.stem, "%Y-%m-%d").date()
+        except ValueError:
+            continue
+        if day >= CURRENT_DATE:
+            continue
+        try:
+            compact_day(str(path))
+        except (sqlalchemy.exc.SQLAlchemyError, *columnar.ARCHIVE_ERRORS) as e:
+            errors.append(f"{path.name}: {e}")
+    if errors:
+        return "\n".join(errors)
+
+
+def close():
+    SESSION.close()
+    checkpoint(ENGINE)
+    ENGINE.dispose()
+
+
+def database_size() -> int:
+    """Bytes of the current daily database on disk, including its WAL"""
+    path = Path(daily_db_path(CURRENT_DATE))
+    return sum(
+        file.stat().st_size
+        for file in (path, path.with_name(path.name + "-wal"))
+        if file.exists()
+    )
+
+
+# Field mapping of the raw trip dicts: column, path in the dict, converter.
+# Missing keys and JSON nulls are stored as NULL.
+TRIP_FIELDS = [
+    # isAdditional is not stored, the crawler always dropped it from responses
+    ("rating", ("rating",), int),
+    ("interchanges", ("interchanges",), int),
+]
+
+LEG_FIELDS = [
+    ("duration", ("duration",), int),
+    ("isRealtimeControlled", ("isRealtimeControlled",), bool),
+    ("realtimeStatus", ("realtimeStatus",), str),
+    ("transportation_id", ("transportation", "id"), str),
+    ("transportation_name", ("transportation", "name"), str),
+    (
+        "transportation_disassembledName",
+        ("transportation", "disassembledName"),
+        str,
+    ),
+    ("transportation_number", ("transportation", "number"), str),
+    ("transportation_description", ("transportation", "description"), str),
+    ("transportation_product_id", ("transportation", "product", "id"), int),
+    ("transportation_product_class", ("transportation", "product", "class"), int),
+    ("transportation_product_name", ("transportation", "product", "name"), str),
+    ("transportation_product_iconId", ("transportation", "product", "iconId"), int),
+    ("transportation_operator_code", ("transportation", "operator", "code"), str),
+    ("transportation_operator_id", ("transportation", "operator", "id"), str),
+    ("transportation_operator_name", ("transportation", "operator", "name"), str),
+    (
+        "transportation_destination_id",
+        ("transportation", "destination", "id"),
+        str,
+    ),
+    (
+        "transportation_destination_name",
+        ("transportation", "destination", "name"),
+        str,
+    ),
+    (
+        "transportation_destination_type",
+        ("transportation", "destination", "type"),
+        str,
+    ),
+    (
+        "transportation_properties_trainName",
+        ("transportation", "properties", "trainName"),
+        str,
+    ),
+    (
+        "transportation_properties_trainType",
+        ("transportation", "properties", "trainType"),
+        str,
+    ),
+    (
+        "transportation_properties_trainNumber",
+        ("transportation", "properties", "trainNumber"),
+        str,
+    ),
+    (
+        "transportation_properties_isROP",
+        ("transportation", "properties", "isROP"),
+        bool,
+    ),
+    (
+        "transportation_properties_tripCode",
+        ("transportation", "properties", "tripCode"),
+        int,
+    ),
+    (
+        "transportation_properties_timetablePeriod",
+        ("transportation", "properties", "timetablePeriod"),
+        str,
+    ),
+    (
+        "transportation_properties_lineDisplay",
+        ("transportation", "properties", "lineDisplay"),
+        str,
+    ),
+    (
+        "transportation_properties_globalId",
+        ("transportation", "properties", "globalId"),
+        str,
+    ),
+    ("interchange_desc", ("interchange", "desc"), str),
+    ("interchange_type", ("interchange", "type"), int),
+    ("interchange_coords", ("interchange", "coords"), str),
+    ("properties_vehicleAccess", ("properties", "vehicleAccess"), str),
+    ("properties_PlanWheelChairAccess", ("properties", "PlanWheelChairAccess"), str),
+]
+
+STOP_FIELDS = [
+    ("isGlobalId", ("isGlobalId",), bool),
+    ("id", ("id",), str),
+    ("name", ("name",), str),
+    ("disassembledName", ("disassembledName",), str),
+    ("type", ("type",), str),
+    ("pointType", ("pointType",), str),
+    ("coord", ("coord",), str),
+    ("niveau", ("niveau",), int),
+    ("parent_isGlobalId", ("parent", "isGlobalId"), bool),
+    ("parent_id", ("parent", "id"), str),
+    ("parent_name", ("parent", "name"), str),
+    ("parent_disassembledName", ("parent", "disassembledName"), str),
+    ("parent_type", ("parent", "type"), str),
+    ("parent_parent_id", ("parent", "parent", "id"), str),
+    ("parent_parent_name", ("parent", "parent", "name"), str),
+    ("parent_parent_type", ("parent", "parent", "type"), str),
+    ("parent_properties_stopId", ("parent", "properties", "stopId"), str),
+    ("parent_coord", ("parent", "coord"), str),
+    ("parent_niveau", ("parent", "niveau"), int),
+    ("productClasses", ("productClasses",), str),
+    ("arrivalTimePlanned", ("arrivalTimePlanned",), str),
+    ("arrivalTimeEstimated", ("arrivalTimeEstimated",), str),
+    ("departureTimePlanned", ("departureTimePlanned",), str),
+    ("departureTimeEstimated", ("departureTimeEstimated",), str),
+    ("properties_areaNiveauDiva", ("properties", "AREA_NIVEAU_DIVA"), str),
+    (
+        "properties_stoppingPointPlanned",
+        ("properties", "stoppingPointPlanned"),
+        str,
+    ),
+    ("properties_areaGid", ("properties", "areaGid"), str),
+    ("properties_area", ("properties", "area"), str),
+    ("properties_platform", ("properties", "platform"), str),
+    ("properties_platformName", ("properties", "platformName"), str),
+]
+
+PATH_DESCRIPTION_FIELDS = [
+    ("turnDirection", ("turnDirection",), str),
+    ("manoeuvre", ("manoeuvre",), str),
+    ("name", ("name",), str),
+    ("niveau", ("niveau",), int),
+    ("coord", ("coord",), str),
+    ("skyDirection", ("skyDirection",), int),
+    ("duration", ("duration",), int),
+    ("cumDuration", ("cumDuration",), int),
+    ("distance", ("distance",), int),
+    ("cumDistance", ("cumDistance",), int),
+    ("fromCoordsIndex", ("fromCoordsIndex",), int),
+    ("toCoordsIndex", ("toCoordsIndex",), int),
+    ("properties_INDOOR_TYPE", ("properties", "INDOOR_TYPE"), str),
+]
+
+INFO_FIELDS = [
+    ("priority", ("priority",), str),
+    ("id", ("id",), str),
+    ("version", ("version",), str),
+    ("type", ("type",), str),
+    ("urlText", ("urlText",), str),
+    ("url", ("url",), str),
+    ("content", ("content",), str),
+    ("subtitle", ("subtitle",), str),
+    ("title", ("title",), str),
+    ("properties_publisher", ("properties", "publisher"), str),
+    ("properties_infoType", ("properties", "infoType"), str),
+    ("properties_timetableChange", ("properties", "timetableChange"), str),
+    ("properties_htmlText", ("properties", "htmlText"), str),
+    ("properties_smsText", ("properties", "smsText"), str),
+]
+
+HINT_FIELDS = [
+    ("content", ("content",), str),
+    ("providerCode", ("providerCode",), str),
+    ("type", ("type",), str),
+    ("properties_subnet", ("properties", "subnet"), str),
+]
+
+
+def text(value) -> str:
+    """Interned str of a value, the same ids, names and lines repeat a lot"""
+    return sys.intern(str(value))
+
+
+def _compile(fields: list[tuple]):
+    """Build a function turning one raw dict into a row tuple of the fields"""
+    getters = [
+        (path, text if convert is str else convert) for _, path, convert in fields
+    ]
+
+    def flatten(raw: dict) -> tuple:
+        row = []
+        for path, convert in getters:
+            value = raw
+            try:
+                for key in path:
+                    value = value[key]
+            except (KeyError, TypeError, IndexError):
+                value = None
+            row.append(None if value is None else convert(value))
+        return tuple(row)
+
+    return flatten
+
+
+TABLE_FIELDS = {
+    Trip: TRIP_FIELDS,
+    Leg: LEG_FIELDS,
+    Stop: STOP_FIELDS,
+    PathDescription: PATH_DESCRIPTION_FIELDS,
+    Info: INFO_FIELDS,
+    Hint: HINT_FIELDS,
+}
+COLUMNS = {
+    model: tuple(column for column, _, _ in fields)
+    for model, fields in TABLE_FIELDS.items()
+}
+FLATTEN = {model: _compile(fields) for model, fields in TABLE_FIELDS.items()}
+# children of a leg: key in the raw leg, which is also the relationship name,
+# and the column referencing the leg
+LEG_CHILDREN = {
+    Stop: ("stopSequence", "data_leg_id"),
+    Hint: ("hints", "data_leg_id"),
+    Info: ("infos", "data_leg_id"),
+    PathDescription: ("pathDescriptions", "data_pathDescription_id"),
+}
+
+
+def is_train_leg(leg: dict) -> bool:
+    train_type = leg.get("transportation", {}).get("properties", {})
+    train_type = train_type.get("trainType")
+    if train_type is None:
+        # skip all other public transit methods except for trains
+        return False
+    if "Bus" in str(train_type):
+        # skip possible bus routes on trip
+        return False
+    return True
+
+
+def flatten_trip(trip: dict) -> tuple:
+    """Flatten a trip dict in one pass into (trip_row, ((leg_row, children), ...)).
+
+    children holds the row tuples of every LEG_CHILDREN model, in that order.
+    Returns None for trips that are not made of trains only.
+    """
+    legs = []
+    for leg in trip["legs"]:
+        if not is_train_leg(leg):
+            return None
+        children = tuple(
+            tuple(FLATTEN[model](raw) for raw in leg.get(key) or ())
+            for model, (key, _) in LEG_CHILDREN.items()
+        )
+        legs.append((FLATTEN[Leg](leg), children))
+    return FLATTEN[Trip](trip), tuple(legs)
+
+
+def parse_trips(trips: list[dict]) -> list[tuple]:
+    """Flattened train trips of a response, what the writers take.
+
+    Holds a fraction of the memory of the raw dicts, so the crawler parses a
+    response right away and drops it. Malformed journeys, e.g. without legs,
+    are counted and skipped, the other trips of the response are kept.
+    """
+    parsed = []
+    with metrics.timer("mining_parse_seconds"):
+        for trip in trips:
+            try:
+                flat = flatten_trip(trip)
+            except (KeyError, TypeError, AttributeError):
+                metrics.inc("mining_malformed_trips_total")
+                continue
+            if flat is not None:
+                parsed.append(flat)
+    return parsed
+
+
+def new_trip(trip) -> Trip:
+    """ORM object of a trip dict or of a row tuple of parse_trips.
+
+    Trip dicts that are not made of trains only give None, like they always
+    did. The writers take the tuples, which hold less memory.
+    """
+    if isinstance(trip, dict):
+        trip = flatten_trip(trip)
+        if trip is None:
+            return None
+    trip_row, legs = trip
+    new_trip = Trip(**dict(zip(COLUMNS[Trip], trip_row)))
+    for leg_row, children in legs:
+        new_leg = Leg(**dict(zip(COLUMNS[Leg], leg_row)))
+        for (model, (key, _)), rows in zip(LEG_CHILDREN.items(), children):
+            setattr(
+                new_leg,
+                key,
+                [model(**dict(zip(COLUMNS[model], row))) for row in rows],
+            )
+        new_trip.legs.append(new_leg)
     return new_trip
 
 
 @daily_db
-def new_entry(trip: dict):
+def new_entry(trip):
     try:
         SESSION.add(new_trip(trip))
         SESSION.commit()
@@ -508,15 +938,500 @@ def new_entry(trip: dict):
         return error
 
 
+def count_rows(trip: Trip, rows: dict):
+    """Add the rows a new trip object writes per table to rows"""
+    rows[Trip.__tablename__] = rows.get(Trip.__tablename__, 0) + 1
+    for leg in trip.legs:
+        rows[Leg.__tablename__] = rows.get(Leg.__tablename__, 0) + 1
+        for model, (key, _) in LEG_CHILDREN.items():
+            table = model.__tablename__
+            rows[table] = rows.get(table, 0) + len(getattr(leg, key))
+
+
+def record_rows(rows: dict):
+    for table, count in rows.items():
+        metrics.inc("mining_rows_written_total", count, table=table)
+
+
 @daily_db
-def new_entries(trips: list[dict]):
+def new_entries(trips: list):
+    """Write trip dicts or row tuples of parse_trips through the ORM"""
     try:
+        rows = {}
+        started = time.perf_counter()
         for i in trips:
             j = new_trip(i)
             if not j:
                 continue
+            count_rows(j, rows)
             SESSION.add(j)
-        SESSION.commit()
+        metrics.observe("mining_flatten_seconds", time.perf_counter() - started)
+        with metrics.timer("mining_commit_seconds"):
+            SESSION.commit()
+        record_rows(rows)
+    except sqlalchemy.exc.SQLAlchemyError as e:
+        error = str(e)
+        return error
+
+
+def _next_ids(connection) -> dict:
+    """First free primary key of every table, keys are assigned client-side"""
+    return {
+        table: (connection.execute(select(func.max(table.c.data_id))).scalar() or 0) + 1
+        for table in ENTITY_BASE.metadata.sorted_tables
+    }
+
+
+def flatten_trips(trips: list[tuple], next_ids: dict) -> dict:
+    """Insertable rows per table of trips from parse_trips.
+
+    Primary and foreign keys are taken from next_ids, which is advanced for
+    every row.
+    """
+    rows = {model.__table__: [] for model in TABLE_FIELDS}
+    keys = {model: ("data_id",) + COLUMNS[model] for model in (Trip,)}
+    keys[Leg] = ("data_id", "data_trip_id") + COLUMNS[Leg]
+    for model, (_, foreign_key) in LEG_CHILDREN.items():
+        keys[model] = ("data_id", foreign_key) + COLUMNS[model]
+
+    def add(model, row: tuple) -> int:
+        table = model.__table__
+        data_id = next_ids[table]
+        next_ids[table] += 1
+        rows[table].append(dict(zip(keys[model], (data_id,) + row)))
+        return data_id
+
+    for trip_row, legs in trips:
+        trip_id = add(Trip, trip_row)
+        for leg_row, children in legs:
+            leg_id = add(Leg, (trip_id,) + leg_row)
+            for model, child_rows in zip(LEG_CHILDREN, children):
+                for row in child_rows:
+                    add(model, (leg_id,) + row)
+    return rows
+
+
+def insert_bulk(engine, trips: list[tuple]):
+    written = {}
+    flatten = 0.0
+    started = time.perf_counter()
+    with engine.begin() as connection:
+        next_ids = _next_ids(connection)
+        for start in range(0, len(trips), BULK_CHUNK_SIZE):
+            end = start + BULK_CHUNK_SIZE
+            flattened = time.perf_counter()
+            rows = flatten_trips(trips[start:end], next_ids)
+            flatten += time.perf_counter() - flattened
+            for table, table_rows in rows.items():
+                if table_rows:
+                    connection.execute(table.insert(), table_rows)
+                    written[table.name] = written.get(table.name, 0) + len(table_rows)
+        committed = time.perf_counter()
+    metrics.observe("mining_flatten_seconds", flatten)
+    metrics.observe("mining_insert_seconds", committed - started - flatten)
+    metrics.observe("mining_commit_seconds", time.perf_counter() - committed)
+    record_rows(written)
+
+
+@daily_db
+def new_entries_bulk(trips: list[tuple]):
+    try:
+        insert_bulk(ENGINE, trips)
+    except sqlalchemy.exc.SQLAlchemyError as e:
+        error = str(e)
+        return error
+
+
+def _picker(source: tuple[str, ...], columns: tuple[str, ...]):
+    """Build a function picking the columns out of a row tuple of source"""
+    indexes = [source.index(column) for column in columns]
+
+    def pick(row: tuple) -> tuple:
+        return tuple(row[i] for i in indexes)
+
+    return pick
+
+
+# table of the wide layout whose parsed rows hold the fields of a normalized table
+NORMALIZED_SOURCES = {
+    StopPoint: Stop,
+    Line: Leg,
+    Train: Leg,
+    TrainObservation: Leg,
+    JourneyLeg: Leg,
+    Journey: Trip,
+    JourneyPath: PathDescription,
+    HintText: Hint,
+    InfoText: Info,
+}
+NORMALIZED_COLUMNS = {
+    model: tuple(column for column in COLUMNS[source] if column in model.__table__.c)
+    for model, source in NORMALIZED_SOURCES.items()
+}
+PICK = {
+    model: _picker(COLUMNS[source], NORMALIZED_COLUMNS[model])
+    for model, source in NORMALIZED_SOURCES.items()
+}
+# planned and estimated times of a stop, in this order
+STOP_TIMES = (
+    "arrivalTimePlanned",
+    "arrivalTimeEstimated",
+    "departureTimePlanned",
+    "departureTimeEstimated",
+)
+PICK_STOP_TIMES = _picker(COLUMNS[Stop], STOP_TIMES)
+# fact tables, the writer assigns their keys like flatten_trips
+NORMALIZED_FACTS = [
+    TrainObservation,
+    StopObservation,
+    TrainHint,
+    TrainInfo,
+    JourneyLeg,
+    JourneyPath,
+]
+
+
+def content_digest(row) -> str:
+    return hashlib.blake2b(json.dumps(row).encode(), digest_size=16).hexdigest()
+
+
+class Interner:
+    """Ids of the rows of a dimension table by key.
+
+    Loads the keys already stored, new rows get the next free id and are kept
+    until they are flushed.
+    """
+
+    def __init__(self, connection, model, key: tuple[str, ...]):
+        self.table = model.__table__
+        columns = [self.table.c.data_id] + [self.table.c[name] for name in key]
+        self.ids = {
+            tuple(row[1:]): row[0] for row in connection.execute(select(*columns))
+        }
+        self.next_id = max(self.ids.values(), default=0) + 1
+        self.pending = []
+
+    def __contains__(self, key: tuple) -> bool:
+        return key in self.ids
+
+    def get(self, key: tuple, row: dict) -> int:
+        data_id = self.ids.get(key)
+        if data_id is None:
+            data_id = self.ids[key] = self.next_id
+            self.next_id += 1
+            self.pending.append({"data_id": data_id, **row})
+        return data_id
+
+    def flush(self, connection) -> int:
+        if self.pending:
+            connection.execute(self.table.insert(), self.pending)
+        count = len(self.pending)
+        self.pending = []
+        return count
+
+
+class NormalizedState:
+    """What the normalized tables of a daily database already hold.
+
+    Kept between batches, so the writer only reads the database once per day.
+    """
+
+    def __init__(self, engine, connection):
+        self.engine = engine
+        self.dimensions = {
+            model: Interner(connection, model, ("digest",))
+            for model in (Line, StopPoint, HintText, InfoText, Journey)
+        }
+        self.dimensions[Train] = Interner(
+            connection, Train, ("line_id",) + NORMALIZED_COLUMNS[Train]
+        )
+        self.dimensions[StopEvent] = Interner(
+            connection,
+            StopEvent,
+            ("train_id", "stop_point_id", "arrivalTimePlanned", "departureTimePlanned"),
+        )
+        # last recorded realtime fields, later observations overwrite earlier ones
+        self.statuses = {
+            row[0]: tuple(row[1:])
+            for row in connection.execute(
+                select(
+                    TrainObservation.train_id,
+                    TrainObservation.isRealtimeControlled,
+                    TrainObservation.realtimeStatus,
+                ).order_by(TrainObservation.data_id)
+            )
+        }
+        self.estimates = {
+            row[0]: tuple(row[1:])
+            for row in connection.execute(
+                select(
+                    StopObservation.stop_event_id,
+                    StopObservation.arrivalTimeEstimated,
+                    StopObservation.departureTimeEstimated,
+                ).order_by(StopObservation.data_id)
+            )
+        }
+        self.texts = {
+            (TrainHint, row[0], row[1])
+            for row in connection.execute(
+                select(TrainHint.train_id, TrainHint.hint_text_id)
+            )
+        } | {
+            (TrainInfo, row[0], row[1])
+            for row in connection.execute(
+                select(TrainInfo.train_id, TrainInfo.info_text_id)
+            )
+        }
+        self.next_ids = {
+            model: (connection.execute(select(func.max(model.data_id))).scalar() or 0)
+            + 1
+            for model in NORMALIZED_FACTS
+        }
+
+    def intern(self, model, row: tuple) -> int:
+        """Id of a dimension row identified by the digest of its fields"""
+        row = PICK[model](row)
+        digest = content_digest(row)
+        return self.dimensions[model].get(
+            (digest,), {"digest": digest, **dict(zip(NORMALIZED_COLUMNS[model], row))}
+        )
+
+    def observe(self, trips: list[tuple], observed: str) -> dict:
+        """Intern the trips and return the fact rows of what changed per table"""
+        facts = {model.__table__: [] for model in NORMALIZED_FACTS}
+
+        def add(model, row: dict) -> int:
+            data_id = self.next_ids[model]
+            self.next_ids[model] += 1
+            facts[model.__table__].append({"data_id": data_id, **row})
+            return data_id
+
+        for trip_row, legs in trips:
+            journey_legs = []
+            for leg, (stops, hints, infos, paths) in legs:
+                train_row = PICK[Train](leg)
+                line_id = self.intern(Line, leg)
+                train_id = self.dimensions[Train].get(
+                    (line_id,) + train_row,
+                    {
+                        "line_id": line_id,
+                        **dict(zip(NORMALIZED_COLUMNS[Train], train_row)),
+                    },
+                )
+                status = PICK[TrainObservation](leg)
+                if self.statuses.get(train_id) != status:
+                    self.statuses[train_id] = status
+                    add(
+                        TrainObservation,
+                        {
+                            "train_id": train_id,
+                            "observed": observed,
+                            **dict(zip(NORMALIZED_COLUMNS[TrainObservation], status)),
+                        },
+                    )
+                for stop in stops:
+                    stop_point_id = self.intern(StopPoint, stop)
+                    (
+                        arrival,
+                        arrival_estimate,
+                        departure,
+                        departure_estimate,
+                    ) = PICK_STOP_TIMES(stop)
+                    event_id = self.dimensions[StopEvent].get(
+                        (train_id, stop_point_id, arrival, departure),
+                        {
+                            "train_id": train_id,
+                            "stop_point_id": stop_point_id,
+                            "arrivalTimePlanned": arrival,
+                            "departureTimePlanned": departure,
+                        },
+                    )
+                    estimate = (arrival_estimate, departure_estimate)
+                    # stops without realtime data need no observation
+                    if self.estimates.get(event_id, (None, None)) != estimate:
+                        self.estimates[event_id] = estimate
+                        add(
+                            StopObservation,
+                            {
+                                "stop_event_id": event_id,
+                                "observed": observed,
+                                "arrivalTimeEstimated": arrival_estimate,
+                                "departureTimeEstimated": departure_estimate,
+                            },
+                        )
+                for model, rows, text_model, column in (
+                    (TrainHint, hints, HintText, "hint_text_id"),
+                    (TrainInfo, infos, InfoText, "info_text_id"),
+                ):
+                    for row in rows:
+                        text_id = self.intern(text_model, row)
+                        if (model, train_id, text_id) not in self.texts:
+                            self.texts.add((model, train_id, text_id))
+                            add(
+                                model,
+                                {
+                                    "train_id": train_id,
+                                    column: text_id,
+                                    "observed": observed,
+                                },
+                            )
+                journey_legs.append(
+                    (
+                        train_id,
+                        PICK[JourneyLeg](leg),
+                        [PICK[JourneyPath](row) for row in paths],
+                    )
+                )
+            trip_row = PICK[Journey](trip_row)
+            digest = content_digest([trip_row, journey_legs])
+            if (digest,) in self.dimensions[Journey]:
+                continue
+            journey_id = self.dimensions[Journey].get(
+                (digest,),
+                {"digest": digest, **dict(zip(NORMALIZED_COLUMNS[Journey], trip_row))},
+            )
+            for position, (train_id, leg_row, paths) in enumerate(journey_legs):
+                journey_leg_id = add(
+                    JourneyLeg,
+                    {
+                        "journey_id": journey_id,
+                        "position": position,
+                        "train_id": train_id,
+                        **dict(zip(NORMALIZED_COLUMNS[JourneyLeg], leg_row)),
+                    },
+                )
+                for path_row in paths:
+                    add(
+                        JourneyPath,
+                        {
+                            "journey_leg_id": journey_leg_id,
+                            **dict(zip(NORMALIZED_COLUMNS[JourneyPath], path_row)),
+                        },
+                    )
+        return facts
+
+
+NORMALIZED_STATE: NormalizedState = None
+
+
+def insert_normalized(engine, trips: list[tuple], observed: str = None):
+    """Write trips in the normalized layout, only what changed is inserted"""
+    global NORMALIZED_STATE
+    if observed is None:
+        observed = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    written = {}
+    started = time.perf_counter()
+    try:
+        with engine.begin() as connection:
+            if NORMALIZED_STATE is None or NORMALIZED_STATE.engine is not engine:
+                NORMALIZED_STATE = NormalizedState(engine, connection)
+            state = NORMALIZED_STATE
+            facts = state.observe(trips, observed)
+            flattened = time.perf_counter()
+            # dimensions first, in the order they reference each other
+            for model in (Line, Train, StopPoint, StopEvent, HintText, InfoText):
+                dimension = state.dimensions[model]
+                written[model.__tablename__] = dimension.flush(connection)
+            written[Journey.__tablename__] = state.dimensions[Journey].flush(connection)
+            for table, rows in facts.items():
+                if rows:
+                    connection.execute(table.insert(), rows)
+                written[table.name] = len(rows)
+            committed = time.perf_counter()
+    except Exception:
+        # the state may hold rows that were never written, read it again
+        NORMALIZED_STATE = None
+        raise
+    metrics.observe("mining_flatten_seconds", flattened - started)
+    metrics.observe("mining_insert_seconds", committed - flattened)
+    metrics.observe("mining_commit_seconds", time.perf_counter() - committed)
+    record_rows({table: count for table, count in written.items() if count})
+
+
+@daily_db
+def new_entries_normalized(trips: list[tuple]):
+    try:
+        insert_normalized(ENGINE, trips)
+    except sqlalchemy.exc.SQLAlchemyError as e:
+        error = str(e)
+        return error
+
+
+# motType of S-Bahn and regional trains, buses, U-Bahn and trams are skipped
+TRAIN_MOT_TYPES = {"0", "1"}
+# departure boards give local times
+LOCAL_TIMEZONE = ZoneInfo("Europe/Berlin")
+
+
+def efa_time(value: dict) -> str:
+    """UTC ISO time of an EFA dateTime dict, None if it is incomplete"""
+    try:
+        local = datetime(
+            int(value["year"]),
+            int(value["month"]),
+            int(value["day"]),
+            int(value["hour"]),
+            int(value["minute"]),
+            tzinfo=LOCAL_TIMEZONE,
+        )
+    except (KeyError, TypeError, ValueError):
+        return None
+    return local.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def flatten_departure(station: str, departure: dict) -> dict:
+    """Row of the departures table, None for anything but a train"""
+    line = departure.get("servingLine") or {}
+    if str(line.get("motType")) not in TRAIN_MOT_TYPES:
+        return None
+    planned = efa_time(departure.get("dateTime"))
+    if planned is None or line.get("key") is None:
+        # neither deduplicated nor usable for delays
+        return None
+    name = " ".join(part for part in (line.get("name"), line.get("number")) if part)
+    return {
+        "stop_id": station,
+        "stop_name": departure.get("stopName") or utils.registry.name(station),
+        "platform": departure.get("platform"),
+        "transportation_name": name or None,
+        "transportation_number": line.get("number"),
+        "trip_code": str(line["key"]),
+        "train_number": line.get("trainNum"),
+        "direction": line.get("direction"),
+        "departureTimePlanned": planned,
+        "departureTimeEstimated": efa_time(departure.get("realDateTime")),
+        "realtime": str(line.get("realtime")) == "1",
+    }
+
+
+def insert_departures(engine, rows: list[dict]):
+    table = Departure.__table__
+    statement = sqlite_insert(table)
+    statement = statement.on_conflict_do_update(
+        index_elements=["stop_id", "trip_code", "departureTimePlanned"],
+        set_={
+            # a later board without realtime data keeps the last estimate
+            "departureTimeEstimated": func.coalesce(
+                statement.excluded.departureTimeEstimated,
+                table.c.departureTimeEstimated,
+            ),
+            "realtime": statement.excluded.realtime,
+            "platform": statement.excluded.platform,
+        },
+    )
+    with engine.begin() as connection:
+        for start in range(0, len(rows), BULK_CHUNK_SIZE):
+            end = start + BULK_CHUNK_SIZE
+            connection.execute(statement, rows[start:end])
+    record_rows({table.name: len(rows)})
+
+
+@daily_db
+def new_departures(departures: list[tuple[str, dict]]):
+    """Upsert raw departures given as (station, departure) pairs"""
+    rows = [flatten_departure(station, departure) for station, departure in departures]
+    try:
+        insert_departures(ENGINE, [row for row in rows if row is not None])
     except sqlalchemy.exc.SQLAlchemyError as e:
         error = str(e)
         return error
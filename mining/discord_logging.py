@@ -1,18 +1,20 @@
+import json
 import logging
 import os
+import queue
+import threading
+import time
+import urllib.request
 from discord import SyncWebhook, File
 from datetime import datetime
 from pathlib import Path
 
-infoCount = 0
-errorCount = 0
-warningCount = 0
-
 # webhook.send("<@&1020311126313009233> Hello there!") #Mention Role
 # webhook.send("<#1020308171140628480> Hello there!") #Mention Channel
 # k.send("<@> Hello there!") #Mention Person
 
-
+# Discord webhook URLs. Other http(s) URLs get the same JSON posts, e.g. a local
+# stand-in for tests, file: URLs append the messages to a local file.
 WEBHOOK_LOGGING_URL = os.environ.get(
     "WEBHOOK_LOGGING_URL",
     "",
@@ -21,22 +23,224 @@ WEBHOOK_ERROR_URL = os.environ.get(
     "WEBHOOK_ERROR_URL",
     "",
 )
+ERROR_MENTION = "<@&1020311126313009233>"
 
-WEBHOOK_ERROR_ENABLED = True
-WEBHOOK_LOGGING_ENABLED = True
-
-WEBHOOK_ERROR: SyncWebhook
-WEBHOOK_LOGGING: SyncWebhook
+# messages arriving within that many seconds are sent together
+BATCH_INTERVAL = 2.0
+# at most MAX_POSTS posts per batch, Discord allows 5 per 2 seconds per webhook
+MAX_POSTS = 3
+# Discord rejects messages above 2000 characters
+MAX_MESSAGE_LENGTH = 1900
+# messages waiting for a channel, more are dropped and counted
+MAX_PENDING = 10000
 
 LOG_FILENAME = f'/data/logs/mining_log {str(datetime.now()).replace(" ", "_")}.log'
 
 
+class Counters:
+    """Message counts per level, incremented from any thread"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {"info": 0, "warning": 0, "error": 0}
+
+    def increment(self, level: str):
+        with self.lock:
+            self.counts[level] += 1
+
+    def get(self, level: str) -> int:
+        with self.lock:
+            return self.counts[level]
+
+
+COUNTERS = Counters()
+
+
+class WebhookSink:
+    def __init__(self, url: str):
+        self.webhook = SyncWebhook.from_url(url)
+
+    def send(self, content: str, file: str = None):
+        if file is None:
+            self.webhook.send(content)
+            return
+        with open(file, "rb") as f:
+            self.webhook.send(content, file=File(f))
+
+
+class HttpSink:
+    """Posts webhook style JSON, for stand-in servers"""
+
+    def __init__(self, url: str):
+        self.url = url
+
+    def send(self, content: str, file: str = None):
+        payload = {"content": content}
+        if file is not None:
+            payload["file"] = str(file)
+        request = urllib.request.Request(
+            self.url,
+            data=json.dumps(payload).encode(),
+            headers={"Content-Type": "application/json"},
+        )
+        with urllib.request.urlopen(request, timeout=10):
+            pass
+
+
+class FileSink:
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def send(self, content: str, file: str = None):
+        if file is not None:
+            content += f"\n[attachment {file}]"
+        with self.lock, open(self.path, "a") as f:
+            f.write(content + "\n")
+
+
+def sink_from_url(url: str):
+    if url.startswith("file:"):
+        return FileSink(url.removeprefix("file:"))
+    if url.startswith("https://discord.com/") or url.startswith(
+        "https://discordapp.com/"
+    ):
+        return WebhookSink(url)
+    return HttpSink(url)
+
+
+def coalesce(messages: list[tuple[str, bool]]) -> list[tuple[str, bool]]:
+    """Repeated messages once, with their count, in order of first appearance.
+
+    A repeated message is mentioned if any of its copies is.
+    """
+    counts: dict[str, int] = {}
+    mentioned: dict[str, bool] = {}
+    for message, mention in messages:
+        counts[message] = counts.get(message, 0) + 1
+        mentioned[message] = mentioned.get(message, False) or mention
+    return [
+        (message if count == 1 else f"{message} (x{count})", mentioned[message])
+        for message, count in counts.items()
+    ]
+
+
+def chunk(lines: list[tuple[str, bool]], mention: str = "") -> list[str]:
+    """Lines packed into at most MAX_POSTS messages of MAX_MESSAGE_LENGTH.
+
+    Only the posts holding a line to be mentioned start with the mention.
+    """
+    limit = MAX_MESSAGE_LENGTH - len(mention) - 1 if mention else MAX_MESSAGE_LENGTH
+    posts = []
+    current = ""
+    mentioned = False
+    for i, (line, flag) in enumerate(lines):
+        line = line[:limit]
+        if current and len(current) + len(line) + 1 > limit:
+            if len(posts) == MAX_POSTS - 1:
+                current += f"\n... and {len(lines) - i} more messages"
+                mentioned = mentioned or any(flag for _, flag in lines[i:])
+                break
+            posts.append((current, mentioned))
+            current = ""
+            mentioned = False
+        current = f"{current}\n{line}" if current else line
+        mentioned = mentioned or flag
+    if current:
+        posts.append((current, mentioned))
+    return [
+        f"{mention}\n{post}" if mention and mentioned else post
+        for post, mentioned in posts
+    ]
+
+
+class Channel:
+    """Sends messages to a sink from a background thread.
+
+    Callers only enqueue, so the crawl never waits on a webhook. Messages are
+    collected for BATCH_INTERVAL seconds, repeated ones are coalesced and the
+    batch is sent as at most MAX_POSTS posts, which also bounds the post rate.
+    """
+
+    def __init__(self, sink, mention: str = ""):
+        self.sink = sink
+        self.mention = mention
+        self.queue = queue.Queue(maxsize=MAX_PENDING)
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def send(self, message: str, file: str = None, mention: bool = False):
+        """Queue a message, mention the channel's mention with it if set"""
+        try:
+            self.queue.put_nowait((str(message), file, mention))
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+
+    def close(self, timeout: float = 30):
+        """Send what is pending and stop, waiting at most timeout seconds"""
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self.thread.join(timeout)
+
+    def _run(self):
+        done = False
+        while not done:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + BATCH_INTERVAL
+            while batch[-1] is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                done = True
+                batch.pop()
+            self._send(batch)
+
+    def _send(self, batch: list[tuple[str, str, bool]]):
+        messages = [
+            (message, mention) for message, file, mention in batch if file is None
+        ]
+        with self.lock:
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            messages.append(
+                (f"{dropped} messages dropped, logging queue was full", False)
+            )
+        posts = [(post, None) for post in chunk(coalesce(messages), self.mention)]
+        posts += [(message, file) for message, file, _ in batch if file is not None]
+        for content, file in posts:
+            try:
+                self.sink.send(content, file)
+            except Exception as err:
+                # only the local log, logging through the channel could loop
+                logging.getLogger("mining_logger").warning(err)
+
+
+ERROR_CHANNEL: Channel = None
+LOGGING_CHANNEL: Channel = None
+
+
+def open_channel(url: str, mention: str = "") -> Channel:
+    logger = logging.getLogger("mining_logger")
+    try:
+        return Channel(sink_from_url(url), mention)
+    except Exception as err:
+        logger.warning(err)
+    return None
+
+
 def initialise():
-    global WEBHOOK_ERROR
-    global WEBHOOK_ERROR_ENABLED
-    global WEBHOOK_LOGGING_ENABLED
-    global WEBHOOK_LOGGING
-    global LOG_FILENAME
+    global ERROR_CHANNEL
+    global LOGGING_CHANNEL
     Path("/data/logs").mkdir(exist_ok=True)
 
     logging.basicConfig(
@@ -50,73 +254,62 @@ def initialise():
     # if url is not present disable the logging
     if WEBHOOK_ERROR_URL == "":
         logger.warning("WEBHOOK_ERROR_URL is not set, deactivating error logging")
-        WEBHOOK_ERROR_ENABLED = False
     else:
-        try:
-            WEBHOOK_ERROR = SyncWebhook.from_url(WEBHOOK_ERROR_URL)
-        except Exception as err:
-            logger.warning(err)
+        ERROR_CHANNEL = open_channel(WEBHOOK_ERROR_URL, ERROR_MENTION)
 
     if WEBHOOK_LOGGING_URL == "":
         logger.warning("WEBHOOK_LOGGING_URL is not set, deactivating info logging")
-        WEBHOOK_LOGGING_ENABLED = False
     else:
-        try:
-            WEBHOOK_LOGGING = SyncWebhook.from_url(WEBHOOK_LOGGING_URL)
-        except Exception as err:
-            logger.warning(err)
+        LOGGING_CHANNEL = open_channel(WEBHOOK_LOGGING_URL)
 
 
 def finishLogging(numberOfTrips: int, numberOfBytes: int):
-    global LOG_FILENAME
-    global WEBHOOK_LOGGING
-    global WEBHOOK_LOGGING_ENABLED
-    global WEBHOOK_ERROR
-    global WEBHOOK_ERROR_ENABLED
-    global errorCount
-    global warningCount
-    global infoCount
+    """Send the summary and wait until both channels are drained"""
+    global ERROR_CHANNEL
+    global LOGGING_CHANNEL
     # send basic information about result
-    if WEBHOOK_LOGGING_ENABLED:
-        WEBHOOK_LOGGING.send("Import has finished")
-        WEBHOOK_LOGGING.send("Number of trips: " + str(numberOfTrips))
-        WEBHOOK_LOGGING.send("Size in bytes: " + str(numberOfBytes))
-        message = f"There were {warningCount} Warnings and {infoCount} Infos"
+    if LOGGING_CHANNEL is not None:
+        LOGGING_CHANNEL.send("Import has finished")
+        LOGGING_CHANNEL.send("Number of trips: " + str(numberOfTrips))
+        LOGGING_CHANNEL.send("Size in bytes: " + str(numberOfBytes))
+        message = (
+            f"There were {COUNTERS.get('warning')} Warnings "
+            f"and {COUNTERS.get('info')} Infos"
+        )
         # send log file
+        if Path(LOG_FILENAME).exists():
+            LOGGING_CHANNEL.send(message, file=LOG_FILENAME)
+        else:
+            LOGGING_CHANNEL.send(message)
+        LOGGING_CHANNEL.close()
+        LOGGING_CHANNEL = None
+
+    if ERROR_CHANNEL is not None:
+        ERROR_CHANNEL.close()
+        # after the errors, the summary should not be coalesced into them
+        sink = ERROR_CHANNEL.sink
+        ERROR_CHANNEL = None
         try:
-            with open(file=LOG_FILENAME, mode="rb") as f:
-                file = File(f)
+            sink.send(f"There were {COUNTERS.get('error')} Errors")
         except Exception as err:
-            logger = logging.getLogger("mining_logger")
-            logger.warning(err)
-        WEBHOOK_LOGGING.send(message, file=file)
-
-    if WEBHOOK_ERROR_ENABLED:
-        message = f"There were {errorCount} Errors"
-        WEBHOOK_ERROR.send(message)
+            logging.getLogger("mining_logger").warning(err)
 
 
 def info(message):
-    global infoCount
     logger = logging.getLogger("mining_logger")
     logger.info(message)
-    infoCount += 1
+    COUNTERS.increment("info")
 
 
 def warning(message):
-    global warningCount
     logger = logging.getLogger("mining_logger")
     logger.warning(message)
-    warningCount += 1
+    COUNTERS.increment("warning")
 
 
 def error(message):
-    global WEBHOOK_ERROR
-    global errorCount
     logger = logging.getLogger("mining_logger")
     logger.exception(message)
-    errorCount += 1
-    if WEBHOOK_ERROR_ENABLED:
-        WEBHOOK_ERROR.send(
-            "<@&1020311126313009233> " + "ERROR: " + str(message),
-        )
+    COUNTERS.increment("error")
+    if ERROR_CHANNEL is not None:
+        ERROR_CHANNEL.send("ERROR: " + str(message), mention=True)
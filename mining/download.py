@@ -1,104 +1,300 @@
-import sys
-import vvspy
+import asyncio
+import os
 import concurrent.futures
-import requests
+import cache
+import crawler
+import planner
+import proxies
 import utils
 import db
 import discord_logging
+import metrics
 
 from datetime import datetime
-from retry import retry
 
+# trips waiting for the writer, crawlers block once the queue is full
+QUEUE_SIZE = int(os.environ.get("QUEUE_SIZE", 2000))
+FLUSH_SIZE = int(os.environ.get("FLUSH_SIZE", 500))
+FLUSH_INTERVAL = float(os.environ.get("FLUSH_INTERVAL", 10))
 
-@retry(TypeError, delay=2, tries=3)
-def get_trips_with_retries(
-    start: str, destination: str, time: datetime, session: requests.Session
+
+async def get_all_trips_from_station(
+    start: str,
+    destinations: list[str],
+    time: datetime,
+    client: crawler.Crawler,
+    queue: asyncio.Queue,
+    responses: cache.ResponseCache = None,
+    tracker=None,
 ):
-    try:
-        trips = vvspy.get_trips(
-            start,
-            destination,
-            time,
-            session=session,
-            limit=5,
-            timeout=(3.05, 6.1),
-        )
+    destinations = [destination for destination in destinations if destination != start]
 
-    except Exception as err:
-        discord_logging.warning(err)
-    if trips is None:
-        discord_logging.info("trips was null in retry function")
-        raise TypeError("trips was null")
-    return trips
+    async def request(destination: str) -> list[dict]:
+        """Raw journeys of a pair, None if it was skipped or every try failed"""
+        if tracker is not None and tracker.is_current(start, destination):
+            metrics.inc("mining_skipped_pairs_total")
+            return None
+        trips = None
+        if responses is not None:
+            trips = await responses.lookup(start, destination, time)
+        if trips is None and (responses is None or not responses.replay):
+            trips = await client.get_trips(start, destination, time)
+            if trips is not None and responses is not None:
+                await responses.store(start, destination, time, trips)
+        if trips is None:
+            discord_logging.info(
+                "trips is None for:"
+                + utils.station_id_to_name(start)
+                + " "
+                + utils.station_id_to_name(destination)
+            )
+        elif tracker is not None:
+            tracker.fetched(start, destination, trips)
+        return trips
 
+    async def fetch(destination: str):
+        # the raw response is dropped once parsed, only the rows wait in the
+        # queue while it is full
+        for trip in db.parse_trips(await request(destination) or []):
+            await queue.put(trip)
 
-def get_all_trips_from_station(start: str, stations: list[str], time: datetime):
-    results = []
-    session = requests.Session()
-    session.proxies.update(utils.get_random_proxy())
-    for destination in stations:
-        if start is not destination:
-            try:
-                trips = get_trips_with_retries(
-                    start, destination, time, session=session
-                )
-                if trips is not None:
-                    for i in trips:
-                        if isinstance(i, vvspy.obj.Trip):
-                            trip = i.raw
-                            del trip["fare"]
-                            del trip["isAdditional"]
-                            del trip["daysOfService"]
-                            for leg in range(len(trip["legs"])):
-                                if "coords" in trip["legs"][leg]:
-                                    del trip["legs"][leg]["coords"]
-                            results.append(trip)
+    results = await asyncio.gather(
+        *(fetch(destination) for destination in destinations),
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            discord_logging.warning(result)
+
+
+def write_trips(trips: list[tuple]):
+    if db.STORAGE_LAYOUT == "normalized":
+        return db.new_entries_normalized(trips)
+    if db.BULK_INSERT:
+        return db.new_entries_bulk(trips)
+    return db.new_entries(trips)
+
+
+async def trip_writer(
+    queue: asyncio.Queue, executor: concurrent.futures.Executor = None
+) -> int:
+    """Drain the queue into the daily db, one transaction per flushed batch.
+
+    A batch is flushed once it holds FLUSH_SIZE trips or FLUSH_INTERVAL seconds
+    have passed. A None on the queue flushes the rest and stops the writer.
+    Writes run on the given single thread executor, or on an own one.
+    Returns the number of trips written.
+    """
+    if executor is None:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            return await trip_writer(queue, executor)
+    loop = asyncio.get_running_loop()
+    written = 0
+    batch = []
+    deadline = loop.time() + FLUSH_INTERVAL
+    done = False
+    while not done:
+        try:
+            timeout = max(0, deadline - loop.time())
+            trip = await asyncio.wait_for(queue.get(), timeout)
+            if trip is None:
+                done = True
+            else:
+                batch.append(trip)
+        except asyncio.TimeoutError:
+            pass
+        if loop.time() >= deadline or len(batch) >= FLUSH_SIZE or done:
+            if batch:
+                started = loop.time()
+                try:
+                    error = await loop.run_in_executor(executor, write_trips, batch)
+                except Exception as err:
+                    # keep draining, crawlers would block on a full queue
+                    error = str(err)
+                metrics.observe("mining_flush_seconds", loop.time() - started)
+                metrics.inc("mining_flushed_trips_total", len(batch))
+                if error:
+                    discord_logging.error("Could not save trips: " + error)
                 else:
-                    discord_logging.info(
-                        "trips is None for:"
-                        + utils.station_id_to_name(start)
-                        + " "
-                        + utils.station_id_to_name(destination)
-                    )
-            except Exception as err:
-                discord_logging.warning(err)
-    return results
-
-
-def get_station_departures(station: str, time: datetime):
-    return vvspy.get_departures(station, time)
-
-
-def get_all_trips(stations: list[str], curr_time: datetime):
-    trips = []
-    with concurrent.futures.ThreadPoolExecutor(max_workers=len(stations)) as executor:
-        future_to_trip = {
-            executor.submit(
-                get_all_trips_from_station, start, stations, curr_time
-            ): start
-            for start in stations
-        }
-        for future in concurrent.futures.as_completed(future_to_trip):
-            try:
-                trips.extend(future.result())
-            except Exception as err:
-                discord_logging.error(err)
-        return trips
+                    written += len(batch)
+                batch = []
+            deadline = loop.time() + FLUSH_INTERVAL
+    return written
+
+
+def plan_trip_queries(
+    stations: list[str], responses: cache.ResponseCache = None
+) -> dict[str, list[str]]:
+    """Planned queries if QUERY_PLANNER is set, the full sweep otherwise.
+
+    Either way the queries and the observation coverage of the planner on the
+    recorded responses are logged and exported as mining_planner_* gauges, so
+    the coverage is known before the planner is switched on.
+    """
+    registry = utils.registry.subset(stations)
+    recorded = responses.latest_trips() if responses is not None else {}
+    # queries and coverage of the planner, whether it is used or not
+    report = planner.recorded_coverage(recorded, registry)
+    if planner.QUERY_PLANNER:
+        plan = planner.plan_queries(registry)
+    else:
+        plan = planner.full_sweep(stations)
+    report["planner"] = planner.QUERY_PLANNER
+    report["sweep_queries"] = planner.query_count(plan)
+    discord_logging.info(f"Query plan: {report}")
+    metrics.gauge_all("mining_planner", report)
+    return plan
+
+
+async def sweep_trips(
+    client: crawler.Crawler,
+    plan: dict[str, list[str]],
+    curr_time: datetime,
+    queue: asyncio.Queue,
+    responses: cache.ResponseCache = None,
+    tracker=None,
+):
+    """Queue the trips of all planned pairs but the ones the tracker holds current"""
+    results = await asyncio.gather(
+        *(
+            get_all_trips_from_station(
+                start, destinations, curr_time, client, queue, responses, tracker
+            )
+            for start, destinations in plan.items()
+        ),
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            discord_logging.error(result)
+
+
+def report_proxies(proxy_pool: proxies.ProxyPool):
+    """Record the stats of every proxy, the final ones of the evicted proxies"""
+    retired, proxy_pool.retired = proxy_pool.retired, {}
+    for url, stats in [*retired.items(), *proxy_pool.stats.items()]:
+        metrics.gauge("mining_proxy_requests", stats.requests, proxy=url)
+        metrics.gauge("mining_proxy_success_rate", 1 - stats.failure_rate, proxy=url)
+        metrics.gauge("mining_proxy_latency_seconds", stats.latency, proxy=url)
+
+
+def report_sweep(client: crawler.Crawler, responses: cache.ResponseCache = None):
+    """Log and record the crawler, cache and proxy stats and cache the proxies"""
+    proxy_pool = client.proxy_pool
+    discord_logging.info(f"Crawler: {client.report()}")
+    metrics.gauge_all("mining_crawler", client.report())
+    if responses is not None:
+        discord_logging.info(f"Response cache: {responses.report()}")
+        metrics.gauge_all("mining_response_cache", responses.report())
+    discord_logging.info(f"Proxy pool: {proxy_pool.report()}")
+    metrics.gauge_all("mining_proxy_pool", proxy_pool.report())
+    report_proxies(proxy_pool)
+    if len(proxy_pool):
+        try:
+            proxy_pool.save()
+        except OSError as err:
+            discord_logging.warning(f"Could not cache proxies: {err}")
+
+
+async def fetch_departures(
+    client: crawler.Crawler,
+    stations: list[str],
+    curr_time: datetime,
+    responses: cache.ResponseCache = None,
+) -> list[tuple[str, dict]]:
+    """Departure boards of all stations as (station, departure) pairs"""
+
+    async def board(station: str) -> list[dict]:
+        departures = None
+        if responses is not None:
+            departures = await responses.lookup(
+                station, cache.DEPARTURE_BOARD, curr_time
+            )
+        if departures is None and (responses is None or not responses.replay):
+            departures = await client.get_departures(station, curr_time)
+            if departures is not None and responses is not None:
+                await responses.store(
+                    station, cache.DEPARTURE_BOARD, curr_time, departures
+                )
+        return departures
 
+    results = await asyncio.gather(
+        *(board(station) for station in stations),
+        return_exceptions=True,
+    )
+    departures = []
+    for station, result in zip(stations, results):
+        if isinstance(result, Exception):
+            discord_logging.error(result)
+        elif result is None:
+            discord_logging.info(
+                "departures is None for:" + utils.station_id_to_name(station)
+            )
+        else:
+            departures.extend((station, departure) for departure in result)
+    return departures
 
-def get_all_station_departures(stations: list[str], curr_time: datetime):
-    station_delays = []
-    with concurrent.futures.ThreadPoolExecutor(max_workers=len(stations)) as executor:
-        future_to_trip = {
-            executor.submit(get_station_departures, start, curr_time): start
-            for start in stations
-        }
-        for future in concurrent.futures.as_completed(future_to_trip):
-            try:
-                station_delays.extend(future.result())
-            except Exception as err:
-                discord_logging.error(err)
-    return station_delays
+
+async def crawl(
+    stations: list[str], curr_time: datetime, departures: bool = True
+) -> tuple[int, int]:
+    """Crawl and persist all trips, then the departure boards.
+
+    Both use the same client and validated proxies, and write through the same
+    thread, so only one of them can roll the daily database over. Returns the
+    number of trips written and of departures fetched.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        writer = asyncio.create_task(trip_writer(queue, executor))
+        responses = None
+        boards = []
+        try:
+            responses = cache.open_cache()
+            plan = plan_trip_queries(stations, responses)
+            if responses is not None and responses.replay:
+                # offline, no proxy list to fetch or validate
+                proxy_pool = proxies.ProxyPool()
+            else:
+                proxy_pool = proxies.load_pool()
+            async with crawler.Crawler(proxy_pool=proxy_pool) as client:
+                await proxy_pool.validate(client)
+                discord_logging.info(f"Proxies: {len(proxy_pool)} usable")
+                with metrics.timer("mining_stage_seconds", stage="trips"):
+                    await sweep_trips(client, plan, curr_time, queue, responses)
+                if departures:
+                    with metrics.timer("mining_stage_seconds", stage="departures"):
+                        boards = await fetch_departures(
+                            client, stations, curr_time, responses
+                        )
+                        error = await loop.run_in_executor(
+                            executor, db.new_departures, boards
+                        )
+                    if error:
+                        discord_logging.error("Could not save departures: " + error)
+            report_sweep(client, responses)
+        finally:
+            # the trips crawled so far are still written if the crawl fails,
+            # and the writer task is never left pending
+            if responses is not None:
+                responses.close()
+            await queue.put(None)
+            written = await writer
+        return written, len(boards)
+
+
+def get_all_trips(stations: list[str], curr_time: datetime) -> int:
+    """Crawl all trips and persist them while crawling, returns the trip count"""
+    trips, _ = asyncio.run(crawl(stations, curr_time, departures=False))
+    return trips
+
+
+def get_all_trips_and_departures(
+    stations: list[str], curr_time: datetime
+) -> tuple[int, int]:
+    """Crawl and persist trips and departure boards, returns both counts"""
+    return asyncio.run(crawl(stations, curr_time))
 
 
 if __name__ == "__main__":
@@ -106,17 +302,22 @@ if __name__ == "__main__":
     discord_logging.info("Starting import")
     curr_time = datetime.now()
     stations = utils.read_station_ids_csv("vvs_sbahn_haltestellen_2022.csv")
-    utils.get_proxy_list()
+    if db.compact_past_days():
+        discord_logging.error("Could not compact or archive past days")
     try:
-        trips = get_all_trips(stations, curr_time)
-        tripCount = len(trips)
-        x = db.new_entries(trips)
-        if x:
-            discord_logging.error("Could not save trips")
-        trips = get_all_station_departures(stations, curr_time)
+        tripCount, departureCount = get_all_trips_and_departures(stations, curr_time)
+        metrics.gauge("mining_trips", tripCount)
+        metrics.gauge("mining_departures", departureCount)
         time_for_execute = datetime.now() - curr_time
-        discord_logging.finishLogging(tripCount, sys.getsizeof(trips))
-        del trips
+        db.close()
+        # size of the data on disk, not of the list object
+        size = db.database_size()
+        metrics.gauge("mining_database_bytes", size)
+        discord_logging.finishLogging(tripCount, size)
     except Exception as err:
         discord_logging.error(err)
         discord_logging.finishLogging(0, 0)
+    try:
+        metrics.export()
+    except OSError as err:
+        discord_logging.warning(f"Could not write metrics: {err}")
@@ -0,0 +1,193 @@
+import json
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+from datetime import datetime
+
+# JSON report of every run, "" disables it
+METRICS_REPORT = os.environ.get("METRICS_REPORT", "/data/logs/metrics.json")
+# Prometheus textfile for the node_exporter textfile collector, "" disables it
+METRICS_TEXTFILE = os.environ.get("METRICS_TEXTFILE", "")
+# upper bounds of the histogram buckets in seconds, from a cache hit to a
+# request that ran into every retry
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                break
+        else:
+            i = len(BUCKETS)
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> list[tuple[str, int]]:
+        """(le, count) pairs as Prometheus expects them"""
+        total = 0
+        pairs = []
+        for bound, count in zip(BUCKETS + ("+Inf",), self.counts):
+            total += count
+            pairs.append((str(bound), total))
+        return pairs
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the quantile"""
+        rank = q * self.count
+        for bound, total in self.cumulative():
+            if total >= rank:
+                return float(bound)
+        return float("inf")
+
+
+class Registry:
+    """Counters, gauges and histograms of one run, keyed by name and labels.
+
+    Updated from the event loop and from the writer thread, so every update
+    takes the lock. Updates are cheap, the crawl stays bound by the endpoint.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters: dict[tuple, float] = {}
+        self.gauges: dict[tuple, float] = {}
+        self.histograms: dict[tuple, Histogram] = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def report(self) -> dict:
+        with self.lock:
+            return {
+                "started": datetime.fromtimestamp(self.started).isoformat(),
+                "duration_seconds": round(time.time() - self.started, 3),
+                "counters": {
+                    _series(name, labels): value
+                    for (name, labels), value in sorted(self.counters.items())
+                },
+                "gauges": {
+                    _series(name, labels): value
+                    for (name, labels), value in sorted(self.gauges.items())
+                },
+                "histograms": {
+                    _series(name, labels): {
+                        "count": h.count,
+                        "sum": round(h.sum, 6),
+                        "mean": round(h.sum / h.count, 6) if h.count else 0.0,
+                        "p50": h.quantile(0.5),
+                        "p90": h.quantile(0.9),
+                        "p99": h.quantile(0.99),
+                    }
+                    for (name, labels), h in sorted(self.histograms.items())
+                },
+            }
+
+    def textfile(self) -> str:
+        """Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            typed = set()
+            for kind, series in (("counter", self.counters), ("gauge", self.gauges)):
+                for (name, labels), value in sorted(series.items()):
+                    if name not in typed:
+                        lines.append(f"# TYPE {name} {kind}")
+                        typed.add(name)
+                    lines.append(f"{_series(name, labels)} {value}")
+            for (name, labels), h in sorted(self.histograms.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {name} histogram")
+                    typed.add(name)
+                for le, count in h.cumulative():
+                    bucket = _series(f"{name}_bucket", labels + (("le", le),))
+                    lines.append(f"{bucket} {count}")
+                lines.append(f"{_series(f'{name}_sum', labels)} {h.sum}")
+                lines.append(f"{_series(f'{name}_count', labels)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+
+def _series(name: str, labels: tuple) -> str:
+    if not labels:
+        return name
+    escaped = (
+        str(value).replace("\\", "\\\\").replace('"', '\\"') for _, value in labels
+    )
+    pairs = ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped))
+    return f"{name}{{{pairs}}}"
+
+
+def _write_atomic(path: str, content: str):
+    # the textfile collector must never read a half written file
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+REGISTRY = Registry()
+
+
+def inc(name: str, value: float = 1, **labels):
+    REGISTRY.inc(name, value, **labels)
+
+
+def gauge(name: str, value: float, **labels):
+    REGISTRY.set(name, value, **labels)
+
+
+def observe(name: str, value: float, **labels):
+    REGISTRY.observe(name, value, **labels)
+
+
+def timer(name: str, **labels):
+    return REGISTRY.timer(name, **labels)
+
+
+def gauge_all(prefix: str, values: dict):
+    """Gauges from a report dict like Crawler.report, numbers only"""
+    for key, value in values.items():
+        if isinstance(value, (int, float)):
+            REGISTRY.set(f"{prefix}_{key}", value)
+
+
+def export(report: str = METRICS_REPORT, textfile: str = METRICS_TEXTFILE):
+    """Write the JSON report and the Prometheus textfile, where configured"""
+    REGISTRY.set("mining_run_duration_seconds", time.time() - REGISTRY.started)
+    if report:
+        _write_atomic(report, json.dumps(REGISTRY.report(), indent=2))
+    if textfile:
+        _write_atomic(textfile, REGISTRY.textfile())
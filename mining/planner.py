@@ -0,0 +1,192 @@
+import math
+import os
+import re
+import stations
+import utils
+
+# A trip query from one station returns the next `limit=5` connections, so an
+# origin sees the trains up to roughly five departures upstream of it. Placing
+# one origin every PLANNER_STRIDE stations along a line therefore still
+# observes every train currently running on that line. Whether it does is
+# measured against recorded full sweeps, see recorded_coverage, so the planner
+# stays off until that coverage is known.
+PLANNER_STRIDE = int(os.environ.get("PLANNER_STRIDE", 5))
+QUERY_PLANNER = os.environ.get("QUERY_PLANNER", "0") == "1"
+
+SBAHN_LINE = re.compile(r"^S\d+$")
+
+
+def _distance(a: tuple[float, float], b: tuple[float, float]) -> float:
+    # equirectangular approximation, good enough to order stops along a line
+    x = (b[0] - a[0]) * math.cos(math.radians((a[1] + b[1]) / 2))
+    y = b[1] - a[1]
+    return math.hypot(x, y)
+
+
+def _path_length(path: list[str], coords: dict) -> float:
+    return sum(_distance(coords[a], coords[b]) for a, b in zip(path, path[1:]))
+
+
+def _order_line(stations: list[str], coords: dict) -> list[str]:
+    """Shortest open path through the stations of one line.
+
+    The CSV has no stop order, so the line is approximated by the shortest
+    nearest-neighbour chain over all start stations, refined with 2-opt. Its
+    ends are the termini, even for lines like S60 whose termini lie close to
+    each other.
+    """
+    best = None
+    for first in stations:
+        path = [first]
+        remaining = set(stations) - {first}
+        while remaining:
+            current = path[-1]
+            path.append(
+                min(remaining, key=lambda s: _distance(coords[current], coords[s]))
+            )
+            remaining.remove(path[-1])
+        if best is None or _path_length(path, coords) < _path_length(best, coords):
+            best = path
+
+    improved = True
+    while improved:
+        improved = False
+        for i in range(len(best) - 1):
+            for end in range(i + 2, len(best) + 1):
+                candidate = best[:i] + best[i:end][::-1] + best[end:]
+                if _path_length(candidate, coords) < _path_length(best, coords) - 1e-9:
+                    best = candidate
+                    improved = True
+    return best
+
+
+def read_lines(registry: stations.StationRegistry) -> dict[str, list[str]]:
+    """Map every S-Bahn line to its station ids, ordered from one terminus"""
+    return {
+        line: _order_line(members, registry.coords)
+        for line, members in registry.by_line.items()
+        if SBAHN_LINE.match(line)
+    }
+
+
+def plan_queries(
+    registry: stations.StationRegistry, stride: int = PLANNER_STRIDE
+) -> dict[str, list[str]]:
+    """Minimal set of origin/destination queries covering every S-Bahn line.
+
+    For every line and direction, every `stride`-th station is queried towards
+    the terminus of that direction. Pairs shared by several lines are only
+    queried once. Stations on no S-Bahn line keep the full sweep.
+    """
+    plan: dict[str, set[str]] = {}
+    lines = read_lines(registry)
+    for ordered in lines.values():
+        for direction in (ordered, ordered[::-1]):
+            destination = direction[-1]
+            # the penultimate station sees the trains about to reach the terminus
+            for start in direction[:-1:stride] + direction[-2:-1]:
+                plan.setdefault(start, set()).add(destination)
+
+    on_line = {station for ordered in lines.values() for station in ordered}
+    for start in registry.ids:
+        if start not in on_line:
+            plan[start] = {d for d in registry.ids if d != start}
+    return {start: sorted(destinations) for start, destinations in plan.items()}
+
+
+def full_sweep(stations: list[str]) -> dict[str, list[str]]:
+    """Every ordered station pair, as queried without a planner"""
+    return {start: [d for d in stations if d != start] for start in stations}
+
+
+def query_count(plan: dict[str, list[str]]) -> int:
+    return sum(len(destinations) for destinations in plan.values())
+
+
+def plan_report(stations: list[str], plan: dict[str, list[str]]) -> dict[str, float]:
+    """Queries of a plan compared with the full N² sweep.
+
+    What the plan still observes can only be measured against responses, see
+    observation_coverage and benchmark_pipeline.py.
+    """
+    queries = query_count(plan)
+    full = query_count(full_sweep(stations))
+    return {
+        "queries": queries,
+        "full_sweep_queries": full,
+        "query_reduction": 1 - queries / full if full else 0.0,
+    }
+
+
+def observation_coverage(planned: list[dict], full: list[dict]) -> float:
+    """Share of train/stop/time observations of a full sweep found by a plan.
+
+    Both arguments are raw trip dicts as returned by the crawler, for example
+    from two runs at the same time against recorded responses.
+    """
+
+    def observations(trips: list[dict]) -> set[tuple]:
+        result = set()
+        for trip in trips:
+            for leg in trip.get("legs", []):
+                number = leg.get("transportation", {}).get("properties", {})
+                number = number.get("trainNumber")
+                for stop in leg.get("stopSequence", []):
+                    result.add(
+                        (
+                            number,
+                            stop.get("id"),
+                            stop.get("arrivalTimePlanned"),
+                            stop.get("departureTimePlanned"),
+                        )
+                    )
+        return result
+
+    expected = observations(full)
+    if not expected:
+        return 1.0
+    return len(observations(planned) & expected) / len(expected)
+
+
+def recorded_coverage(
+    responses: dict[tuple[str, str], list[dict]], registry: stations.StationRegistry
+) -> dict:
+    """Observation coverage of the planner on recorded responses.
+
+    responses maps (origin, destination) to the journeys recorded for the pair.
+    The planned queries and the full sweep are both answered from them, so the
+    share of the full sweep's train/stop/time observations the plan finds is not
+    skewed by the time of the requests. Only pairs with a recorded response
+    count, None without any. The figure is only meaningful on responses of full
+    sweeps, a planned run records nothing the plan would miss.
+    """
+    full = full_sweep(registry.ids)
+    planned = plan_queries(registry)
+
+    def trips(plan: dict[str, list[str]]) -> list[dict]:
+        return [
+            trip
+            for start, destinations in plan.items()
+            for destination in destinations
+            for trip in responses.get((start, destination), [])
+        ]
+
+    recorded = sum(
+        (start, destination) in responses
+        for start, destinations in full.items()
+        for destination in destinations
+    )
+    return {
+        "recorded_pairs": recorded,
+        "observation_coverage": (
+            observation_coverage(trips(planned), trips(full)) if recorded else None
+        ),
+        **plan_report(registry.ids, planned),
+    }
+
+
+if __name__ == "__main__":
+    utils.read_station_ids_csv("vvs_sbahn_haltestellen_2022.csv")
+    plan = plan_queries(utils.registry)
+    for key, value in plan_report(utils.registry.ids, plan).items():
+        print(f"{key}: {value}")
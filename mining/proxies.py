@@ -0,0 +1,217 @@
+import asyncio
+import json
+import os
+import random
+import time
+import discord_logging
+import utils
+
+USE_PROXIES = os.environ.get("USE_PROXIES", "1") == "1"
+# local host:port list used instead of downloading the public list
+PROXY_LIST_FILE = os.environ.get("PROXY_LIST_FILE")
+# proxies that worked in the last run, reused while younger than the TTL
+PROXY_CACHE = os.environ.get("PROXY_CACHE", "/data/proxies.json")
+PROXY_CACHE_TTL = int(os.environ.get("PROXY_CACHE_TTL", 6 * 3600))
+# unscored proxies probed before a run, the public list has thousands of them
+PROXY_VALIDATE_LIMIT = int(os.environ.get("PROXY_VALIDATE_LIMIT", 200))
+
+# a proxy is evicted after that many failures in a row, or once more than
+# PROXY_MAX_FAILURE_RATE of at least PROXY_MIN_REQUESTS requests failed
+PROXY_MAX_CONSECUTIVE_FAILURES = 3
+PROXY_MIN_REQUESTS = 5
+PROXY_MAX_FAILURE_RATE = 0.5
+# weight of the newest sample in the moving latency average
+LATENCY_SMOOTHING = 0.3
+# latency assumed for a proxy without samples, in seconds
+DEFAULT_LATENCY = 1.0
+
+# cheap EFA request answered with a small JSON document
+VALIDATION_URL = "https://www3.vvs.de/mngvvs/XML_STOPFINDER_REQUEST"
+VALIDATION_PARAMS = {
+    "outputFormat": "rapidJSON",
+    "type_sf": "any",
+    "name_sf": "de:08111:6118",
+}
+
+
+class ProxyStats:
+    __slots__ = ("latency", "requests", "failures", "consecutive_failures", "in_flight")
+
+    def __init__(
+        self, latency: float = DEFAULT_LATENCY, requests: int = 0, failures: int = 0
+    ):
+        self.latency = latency
+        self.requests = requests
+        self.failures = failures
+        self.consecutive_failures = 0
+        self.in_flight = 0
+
+    @property
+    def failure_rate(self) -> float:
+        return self.failures / self.requests if self.requests else 0.0
+
+    def score(self) -> float:
+        """Expected cost of sending the next request through the proxy"""
+        success = max(1 - self.failure_rate, 0.05)
+        return self.latency * (1 + self.in_flight) / success
+
+    def to_dict(self) -> dict:
+        return {
+            "latency": self.latency,
+            "requests": self.requests,
+            "failures": self.failures,
+        }
+
+
+class ProxyPool:
+    """Health-scored proxies shared by all requests of a run.
+
+    Every request takes the better of two randomly drawn proxies, weighing
+    latency, failure rate and requests in flight. Work therefore moves away
+    from slow, failing or busy proxies during the run, instead of an origin
+    being tied to the proxy it drew first. Proxies failing too often are
+    evicted, without any proxy left requests go out directly.
+
+    The pool is only used from the event loop, so it needs no locking.
+    """
+
+    def __init__(self, proxies: dict[str, ProxyStats] = None):
+        self.stats = dict(proxies or {})
+        self.urls = list(self.stats)
+        self.evicted = 0
+        # final stats of evicted proxies that served requests, until reported
+        self.retired: dict[str, ProxyStats] = {}
+
+    @classmethod
+    def from_list(cls, entries: list[str]) -> "ProxyPool":
+        return cls({f"http://{entry}": ProxyStats() for entry in entries})
+
+    def __len__(self) -> int:
+        return len(self.urls)
+
+    def acquire(self) -> str:
+        """Proxy URL for the next request, None to connect directly"""
+        if not self.urls:
+            return None
+        candidates = random.sample(self.urls, min(2, len(self.urls)))
+        proxy = min(candidates, key=lambda url: self.stats[url].score())
+        self.stats[proxy].in_flight += 1
+        return proxy
+
+    def release(self, proxy: str, latency: float = None, ok: bool = None):
+        """Return a proxy, recording the outcome unless ok is None"""
+        stats = self.stats.get(proxy)
+        if stats is None:
+            # evicted while the request was in flight
+            return
+        stats.in_flight -= 1
+        if ok is None:
+            return
+        stats.requests += 1
+        if ok:
+            stats.latency += LATENCY_SMOOTHING * (latency - stats.latency)
+            stats.consecutive_failures = 0
+        else:
+            stats.failures += 1
+            stats.consecutive_failures += 1
+        if stats.consecutive_failures >= PROXY_MAX_CONSECUTIVE_FAILURES or (
+            stats.requests >= PROXY_MIN_REQUESTS
+            and stats.failure_rate > PROXY_MAX_FAILURE_RATE
+        ):
+            self.evict(proxy)
+
+    def evict(self, proxy: str):
+        stats = self.stats.pop(proxy)
+        if stats.requests:
+            self.retired[proxy] = stats
+        self.urls.remove(proxy)
+        self.evicted += 1
+
+    async def validate(self, client, limit: int = PROXY_VALIDATE_LIMIT):
+        """Probe proxies without samples and evict the ones not answering.
+
+        At most `limit` of them are probed, the rest are dropped. Probing also
+        leaves a warm keep-alive connection to every working proxy in the
+        client's connection pool.
+        """
+        unscored = [url for url in self.urls if not self.stats[url].requests]
+        random.shuffle(unscored)
+        for proxy in unscored[limit:]:
+            self.evict(proxy)
+
+        semaphore = asyncio.Semaphore(client.max_concurrent)
+
+        async def probe(proxy: str):
+            started = time.monotonic()
+            try:
+                async with semaphore:
+                    await client.fetch_json(VALIDATION_URL, VALIDATION_PARAMS, proxy)
+            except Exception:
+                self.evict(proxy)
+                return
+            self.stats[proxy].latency = time.monotonic() - started
+            self.stats[proxy].requests = 1
+
+        await asyncio.gather(*(probe(proxy) for proxy in unscored[:limit]))
+
+    def report(self) -> dict:
+        requests = sum(stats.requests for stats in self.stats.values())
+        failures = sum(stats.failures for stats in self.stats.values())
+        return {
+            "proxies": len(self.urls),
+            "evicted": self.evicted,
+            "requests": requests,
+            "failure_rate": failures / requests if requests else 0.0,
+        }
+
+    def save(self, path: str = PROXY_CACHE):
+        """Cache the proxies that are still in the pool for the next run"""
+        data = {
+            "saved_at": time.time(),
+            "proxies": {url: stats.to_dict() for url, stats in self.stats.items()},
+        }
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+
+def read_cache(path: str = PROXY_CACHE, ttl: int = PROXY_CACHE_TTL) -> dict:
+    """Cached proxy stats by URL, empty if the cache is missing or too old"""
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if ttl is not None and time.time() - data.get("saved_at", 0) > ttl:
+        return {}
+    return {
+        url: ProxyStats(stats["latency"], stats["requests"], stats["failures"])
+        for url, stats in data.get("proxies", {}).items()
+    }
+
+
+def load_pool() -> ProxyPool:
+    """Pool from the local list, the cache or the public list, in that order.
+
+    If the public list cannot be downloaded, a stale cache is used. Without
+    any of them the pool is empty and requests go out directly.
+    """
+    if not USE_PROXIES:
+        return ProxyPool()
+    if PROXY_LIST_FILE:
+        with open(PROXY_LIST_FILE) as f:
+            pool = ProxyPool.from_list(utils.parse_proxy_lines(f))
+        # keep the scores of known proxies
+        for url, stats in read_cache().items():
+            if url in pool.stats:
+                pool.stats[url] = stats
+        return pool
+    cached = read_cache()
+    if cached:
+        return ProxyPool(cached)
+    try:
+        return ProxyPool.from_list(utils.get_proxy_list())
+    except OSError as err:
+        discord_logging.warning(f"Could not download proxy list: {err}")
+    return ProxyPool(read_cache(ttl=None))
@@ -0,0 +1,167 @@
+# Recorded EFA responses and a local stand-in server serving them.
+#
+# A fixture is a JSON lines file, one recorded trip request per line:
+#
+#   {"origin": "de:08111:6118", "destination": "de:08111:6115",
+#    "status": 200, "response": {"journeys": [...]}}
+#
+# `response` is the rapidJSON document of the EFA trip request. Fixtures are
+# exported from the response cache or generated synthetically.
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import sqlite3
+import zlib
+from aiohttp import web
+
+TRIP_PATH = "/mngvvs/XML_TRIP_REQUEST2"
+
+
+def read_fixture(path: str) -> list[dict]:
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def write_fixture(path: str, entries) -> int:
+    count = 0
+    with open(path, "w") as f:
+        for entry in entries:
+            f.write(json.dumps(entry) + "\n")
+            count += 1
+    return count
+
+
+def export_cache(cache_path: str):
+    """Fixture entries of all trip responses in a response cache"""
+    conn = sqlite3.connect(cache_path)
+    try:
+        rows = conn.execute(
+            """SELECT requests.origin, requests.destination, bodies.body
+            FROM requests JOIN bodies ON requests.digest = bodies.digest
+            WHERE requests.destination != ''
+            ORDER BY requests.bucket"""
+        )
+        for origin, destination, body in rows:
+            yield {
+                "origin": origin,
+                "destination": destination,
+                "status": 200,
+                "response": {"journeys": json.loads(zlib.decompress(body))},
+            }
+    finally:
+        conn.close()
+
+
+def synthetic_fixture(pairs: int, trips: int = 5):
+    """Fixture entries with S-Bahn journeys like the ones of benchmark_storage"""
+    import benchmark_storage
+
+    for number in range(pairs):
+        yield {
+            "origin": f"synthetic:{number}",
+            "destination": "synthetic:0",
+            "status": 200,
+            "response": {
+                "journeys": [
+                    benchmark_storage.synthetic_trip(number * trips + i)
+                    for i in range(trips)
+                ]
+            },
+        }
+
+
+def stand_in_app(
+    entries: list[dict],
+    latency: float = 0.0,
+    jitter: float = 0.0,
+    failure_rate: float = 0.0,
+    failure_status: int = 503,
+    timeout_rate: float = 0.0,
+    hang: float = 30.0,
+) -> web.Application:
+    """Trip endpoint answering from a fixture.
+
+    A recorded pair gets its recorded response, any other pair the next
+    recorded response in turn, so a small fixture serves a full sweep. Each
+    answer is delayed by latency ± jitter seconds. With failure_rate it is
+    replaced by failure_status, with timeout_rate the request hangs for
+    `hang` seconds instead. GET /stats returns the counters.
+    """
+    # encoded once, so the stand-in is not the bottleneck of a benchmark
+    answers = [
+        (json.dumps(entry["response"]).encode(), entry.get("status", 200))
+        for entry in entries
+    ]
+    by_pair = {
+        (entry["origin"], entry["destination"]): answer
+        for entry, answer in zip(entries, answers)
+    }
+    rotation = itertools.cycle(answers)
+    counters = {"requests": 0, "failures": 0, "timeouts": 0}
+
+    async def trip(request: web.Request) -> web.Response:
+        counters["requests"] += 1
+        await asyncio.sleep(max(0.0, latency + random.uniform(-jitter, jitter)))
+        draw = random.random()
+        if draw < timeout_rate:
+            counters["timeouts"] += 1
+            await asyncio.sleep(hang)
+        elif draw < timeout_rate + failure_rate:
+            counters["failures"] += 1
+            return web.Response(status=failure_status)
+        pair = (request.query.get("name_origin"), request.query.get("name_destination"))
+        body, status = by_pair.get(pair) or next(rotation)
+        return web.Response(body=body, status=status, content_type="application/json")
+
+    async def stats(request: web.Request) -> web.Response:
+        return web.json_response(counters)
+
+    app = web.Application()
+    app.router.add_get(TRIP_PATH, trip)
+    app.router.add_get("/stats", stats)
+    return app
+
+
+def serve(fixture: str, port: int, **options):
+    web.run_app(
+        stand_in_app(read_fixture(fixture), **options),
+        host="127.0.0.1",
+        port=port,
+        print=None,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Record and serve EFA responses")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export = commands.add_parser("export", help="Fixture from a response cache")
+    export.add_argument("cache")
+    export.add_argument("fixture")
+    synthetic = commands.add_parser("synthetic", help="Synthetic fixture")
+    synthetic.add_argument("fixture")
+    synthetic.add_argument("--pairs", type=int, default=100)
+    server = commands.add_parser("serve", help="Serve a fixture on localhost")
+    server.add_argument("fixture")
+    server.add_argument("--port", type=int, default=8080)
+    server.add_argument("--latency", type=float, default=0.0)
+    server.add_argument("--jitter", type=float, default=0.0)
+    server.add_argument("--failure-rate", type=float, default=0.0)
+    server.add_argument("--failure-status", type=int, default=503)
+    server.add_argument("--timeout-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    if args.command == "export":
+        print(write_fixture(args.fixture, export_cache(args.cache)))
+    elif args.command == "synthetic":
+        print(write_fixture(args.fixture, synthetic_fixture(args.pairs)))
+    else:
+        serve(
+            args.fixture,
+            args.port,
+            latency=args.latency,
+            jitter=args.jitter,
+            failure_rate=args.failure_rate,
+            failure_status=args.failure_status,
+            timeout_rate=args.timeout_rate,
+        )
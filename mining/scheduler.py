@@ -0,0 +1,165 @@
+import asyncio
+import os
+import random
+import time
+
+# upper bound of the request rate, the bucket holds up to REQUEST_BURST tokens
+REQUESTS_PER_SECOND = float(os.environ.get("REQUESTS_PER_SECOND", 50))
+REQUEST_BURST = int(os.environ.get("REQUEST_BURST", 32))
+# concurrency is adapted between these bounds, starting at the lower one
+MIN_CONCURRENT_REQUESTS = int(os.environ.get("MIN_CONCURRENT_REQUESTS", 4))
+# factor applied to the limit on congestion, 0.5 would leave the endpoint idle
+# for a large part of the sawtooth
+DECREASE_FACTOR = 0.7
+# the breaker opens once BREAKER_FAILURE_RATE of the last BREAKER_WINDOW
+# attempts failed with a timeout or 5xx, and stays open for BREAKER_COOLDOWN seconds,
+# doubled after every failed probe up to BREAKER_MAX_COOLDOWN
+BREAKER_WINDOW = 20
+BREAKER_FAILURE_RATE = 0.5
+BREAKER_COOLDOWN = float(os.environ.get("BREAKER_COOLDOWN", 15))
+BREAKER_MAX_COOLDOWN = 300.0
+BREAKER_POLL = 0.5
+
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """Exponential backoff with full jitter, so retries do not line up"""
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+class TokenBucket:
+    """Caps the request rate, allowing bursts of up to `burst` requests"""
+
+    def __init__(self, rate: float = REQUESTS_PER_SECOND, burst: int = REQUEST_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AdaptiveLimiter:
+    """Requests in flight, adapted with additive increase, multiplicative decrease.
+
+    Like TCP congestion control, the limit grows by one per success until the
+    first congestion event (slow start), then by one per window of `limit`
+    successes. Timeouts, 429 and 5xx answers reduce it, but only for requests
+    sent after the last decrease, so a burst of errors counts as one event.
+    """
+
+    def __init__(self, minimum: int = MIN_CONCURRENT_REQUESTS, maximum: int = 32):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.limit = float(minimum)
+        self.threshold = float(self.maximum)
+        self.in_flight = 0
+        self.decreases = 0
+        self.last_decrease = float("-inf")
+        self.condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        return self
+
+    async def __aexit__(self, *exc):
+        async with self.condition:
+            self.in_flight -= 1
+            # waking every queued request on each release would cost O(n)
+            self.condition.notify(max(1, int(self.limit) - self.in_flight))
+
+    def on_success(self):
+        if self.limit < self.threshold:
+            self.limit += 1
+        else:
+            self.limit += 1 / self.limit
+        self.limit = min(self.limit, self.maximum)
+
+    def on_congestion(self, sent: float):
+        """Congestion seen by a request sent at `sent`, a time.monotonic value"""
+        if sent < self.last_decrease:
+            return
+        self.last_decrease = time.monotonic()
+        self.limit = max(self.minimum, self.limit * DECREASE_FACTOR)
+        self.threshold = self.limit
+        self.decreases += 1
+
+
+class CircuitBreaker:
+    """Pauses all requests while the endpoint is overloaded.
+
+    While open, requests wait instead of failing, so no query is dropped.
+    After the cooldown a single probe request is let through. If it succeeds
+    the breaker closes, otherwise it opens again with twice the cooldown.
+    """
+
+    def __init__(self, cooldown: float = BREAKER_COOLDOWN):
+        self.base_cooldown = cooldown
+        self.cooldown = cooldown
+        self.outcomes: list[bool] = []
+        self.open_until: float = None
+        self.probing = False
+        self.openings = 0
+
+    async def wait(self) -> bool:
+        """Wait until requests may be sent, True if the caller is the probe"""
+        while self.open_until is not None:
+            now = time.monotonic()
+            if now < self.open_until:
+                await asyncio.sleep(self.open_until - now)
+            elif not self.probing:
+                self.probing = True
+                return True
+            else:
+                await asyncio.sleep(BREAKER_POLL)
+        return False
+
+    def on_success(self):
+        self.probing = False
+        if self.open_until is not None:
+            self.open_until = None
+            self.cooldown = self.base_cooldown
+            self.outcomes.clear()
+        self._record(False)
+
+    def on_congestion(self, probe: bool = False):
+        if probe:
+            self.probing = False
+            self.cooldown = min(self.cooldown * 2, BREAKER_MAX_COOLDOWN)
+            self._open()
+            return
+        self._record(True)
+        if (
+            self.open_until is None
+            and len(self.outcomes) == BREAKER_WINDOW
+            and sum(self.outcomes) >= BREAKER_FAILURE_RATE * BREAKER_WINDOW
+        ):
+            self._open()
+
+    def on_error(self, probe: bool = False):
+        """Outcome telling nothing about the endpoint, e.g. a broken proxy"""
+        if probe:
+            self.probing = False
+
+    def _record(self, congested: bool):
+        self.outcomes.append(congested)
+        if len(self.outcomes) > BREAKER_WINDOW:
+            del self.outcomes[0]
+
+    def _open(self):
+        self.open_until = time.monotonic() + self.cooldown
+        self.outcomes.clear()
+        self.openings += 1
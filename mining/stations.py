@@ -0,0 +1,152 @@
+# Registry of the VVS station file, e.g. vvs_sbahn_haltestellen_2022.csv:
+#
+#   name;name;number;global id;...;locality;...;lines;...;lon;lat
+#
+# Only depends on the standard library. mining/stations.py and
+# extraction/stations.py are kept identical, so both tools match stations the
+# same way without importing each other's source tree.
+import csv
+import functools
+import math
+import re
+
+# columns of the VVS station file
+NAME_COLUMNS = (0, 1)
+ID_COLUMN = 3
+LINES_COLUMN = 10
+LON_COLUMN = 14
+LAT_COLUMN = 15
+# edge of a cell of the coordinate index, in degrees
+GRID_CELL = 0.01
+# kilometres per degree of latitude
+KM_PER_DEGREE = 111.32
+
+NON_WORD = re.compile(r"\W+")
+
+
+def normalize_name(name: str) -> str:
+    """Lower case words of a name, e.g. "Wernau (N)" becomes "wernau n" """
+    return " ".join(NON_WORD.sub(" ", name.casefold()).split())
+
+
+def global_station_id(stop_id: str) -> str:
+    """Station part of a global stop id, e.g. de:08111:6118 of de:08111:6118:3:3"""
+    return ":".join(stop_id.split(":")[:3])
+
+
+def station_coord(row: list[str]) -> tuple[float, float]:
+    """(lon, lat) of a station row, the file uses decimal commas"""
+    return (
+        float(row[LON_COLUMN].replace(",", ".")),
+        float(row[LAT_COLUMN].replace(",", ".")),
+    )
+
+
+class StationRegistry:
+    """Stations of a VVS station file, indexed by id, name, line and location.
+
+    Built once and only read afterwards, so the crawler, the db layer, the
+    planner and the extraction share it without locks and no lookup scans the
+    rows. Names are compared normalized, as whole words.
+    """
+
+    def __init__(self, rows: list[list[str]] = ()):
+        self.rows = [tuple(row) for row in rows]
+        self.ids = [row[ID_COLUMN] for row in self.rows]
+        self.by_id = {row[ID_COLUMN]: row for row in self.rows}
+        self.by_name: dict[str, list[str]] = {}
+        self.by_line: dict[str, list[str]] = {}
+        self.coords: dict[str, tuple[float, float]] = {}
+        self.cells: dict[tuple[int, int], list[str]] = {}
+        for row in self.rows:
+            station_id = row[ID_COLUMN]
+            names = {normalize_name(row[column]) for column in NAME_COLUMNS}
+            for name in names - {""}:
+                self.by_name.setdefault(name, []).append(station_id)
+            for line in row[LINES_COLUMN].split(","):
+                if line:
+                    self.by_line.setdefault(line, []).append(station_id)
+            try:
+                coord = station_coord(row)
+            except (IndexError, ValueError):
+                continue
+            self.coords[station_id] = coord
+            self.cells.setdefault(self.cell(coord), []).append(station_id)
+        # words of the longest name, bounds the phrases mentioned looks up
+        self.max_words = max((len(name.split()) for name in self.by_name), default=0)
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __contains__(self, station_id: str) -> bool:
+        return station_id in self.by_id
+
+    def subset(self, station_ids: list[str]) -> "StationRegistry":
+        """Registry of the given stations, in that order, unknown ids are left out"""
+        return StationRegistry(
+            [self.by_id[station_id] for station_id in station_ids if station_id in self]
+        )
+
+    @staticmethod
+    def cell(coord: tuple[float, float]) -> tuple[int, int]:
+        return math.floor(coord[0] / GRID_CELL), math.floor(coord[1] / GRID_CELL)
+
+    def name(self, station_id: str) -> str:
+        row = self.by_id.get(station_id)
+        return None if row is None else row[NAME_COLUMNS[0]]
+
+    def find(self, name: str) -> list[str]:
+        """Ids of the stations of a name, ignoring case and punctuation"""
+        return self.by_name.get(normalize_name(name), [])
+
+    def on_line(self, line: str) -> list[str]:
+        """Ids of the stations served by a line, in file order"""
+        return self.by_line.get(line, [])
+
+    def resolve(self, stop_ids: tuple = (), name: str = None) -> str:
+        """Station of a stop, by the first of its ids in the registry.
+
+        Stops without a known id are resolved by name, if only one station has
+        it. None if the stop is not a station of the registry.
+        """
+        for stop_id in stop_ids:
+            if stop_id:
+                station_id = global_station_id(stop_id)
+                if station_id in self.by_id:
+                    return station_id
+        stations = self.find(name) if name else []
+        return stations[0] if len(stations) == 1 else None
+
+    def mentioned(self, text: str) -> set[str]:
+        """Ids of the stations whose names occur in a text as whole words"""
+        words = normalize_name(text or "").split()
+        found = set()
+        for i in range(len(words)):
+            for end in range(i + 1, min(i + self.max_words, len(words)) + 1):
+                found.update(self.by_name.get(" ".join(words[i:end]), ()))
+        return found
+
+    def near(self, coord: tuple[float, float], km: float) -> list[str]:
+        """Ids of the stations within km of a (lon, lat), nearest first"""
+        lat_cells = math.ceil(km / KM_PER_DEGREE / GRID_CELL)
+        scale = max(math.cos(math.radians(coord[1])), 0.01)
+        lon_cells = math.ceil(km / (KM_PER_DEGREE * scale) / GRID_CELL)
+        x, y = self.cell(coord)
+        found = []
+        for i in range(x - lon_cells, x + lon_cells + 1):
+            for j in range(y - lat_cells, y + lat_cells + 1):
+                for station_id in self.cells.get((i, j), ()):
+                    lon, lat = self.coords[station_id]
+                    distance = KM_PER_DEGREE * math.hypot(
+                        (lon - coord[0]) * scale, lat - coord[1]
+                    )
+                    if distance <= km:
+                        found.append((distance, station_id))
+        return [station_id for _, station_id in sorted(found)]
+
+
+@functools.lru_cache(maxsize=None)
+def load_stations(file: str) -> StationRegistry:
+    """Registry of a VVS station file, read once per file"""
+    with open(file, "r") as f:
+        return StationRegistry(csv.reader(f, delimiter=";"))
@@ -0,0 +1,31 @@
+# The miner's modules import each other by name, as scripts run from mining/.
+# Everything they write goes to a temporary directory instead of /data.
+import os
+import sys
+import tempfile
+
+from pathlib import Path
+
+import pytest
+
+DATA_DIR = Path(tempfile.mkdtemp(prefix="mining-tests-"))
+os.environ["DB_DIR"] = str(DATA_DIR / "db")
+os.environ["COLUMNAR_DIR"] = str(DATA_DIR / "parquet")
+os.environ["RESPONSE_CACHE"] = str(DATA_DIR / "responses.db")
+os.environ["PROXY_CACHE"] = str(DATA_DIR / "proxies.json")
+os.environ["METRICS_REPORT"] = ""
+os.environ["METRICS_TEXTFILE"] = ""
+os.environ["WEBHOOK_LOGGING_URL"] = ""
+os.environ["WEBHOOK_ERROR_URL"] = ""
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import metrics  # noqa: E402
+
+
+@pytest.fixture
+def registry(monkeypatch) -> metrics.Registry:
+    """Fresh metrics registry, so a test only sees its own series"""
+    fresh = metrics.Registry()
+    monkeypatch.setattr(metrics, "REGISTRY", fresh)
+    return fresh
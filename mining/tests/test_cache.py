@@ -0,0 +1,105 @@
+import asyncio
+import cache
+import pytest
+import threading
+
+from datetime import datetime, timedelta
+
+ORIGIN = "de:08111:6118"
+DESTINATION = "de:08116:4241"
+NOW = datetime(2022, 11, 1, 10, 0)
+JOURNEYS = [{"legs": [{"transportation": {"name": "S-Bahn S1"}}]}]
+
+
+@pytest.fixture
+def clock(monkeypatch) -> list[float]:
+    """Time of the cache, a test moves it by changing its only element"""
+    now = [NOW.timestamp()]
+    monkeypatch.setattr(cache, "_now", lambda: now[0])
+    return now
+
+
+def test_queries_share_a_response_within_their_bucket(tmp_path, clock):
+    responses = cache.ResponseCache(str(tmp_path / "responses.db"))
+    responses.put(ORIGIN, DESTINATION, NOW, JOURNEYS)
+    later = NOW + timedelta(seconds=cache.CACHE_BUCKET - 1)
+    assert responses.get(ORIGIN, DESTINATION, later) == JOURNEYS
+    next_bucket = NOW + timedelta(seconds=cache.CACHE_BUCKET)
+    assert responses.get(ORIGIN, DESTINATION, next_bucket) is None
+    assert responses.get(DESTINATION, ORIGIN, NOW) is None
+    assert responses.report() == {"hits": 1, "misses": 2, "hit_rate": 1 / 3}
+    responses.close()
+
+
+def test_responses_expire_after_the_ttl_unless_replayed(tmp_path, clock):
+    path = str(tmp_path / "responses.db")
+    responses = cache.ResponseCache(path)
+    responses.put(ORIGIN, DESTINATION, NOW, JOURNEYS)
+    responses.conn.commit()
+    clock[0] += cache.CACHE_TTL + 1
+    assert responses.get(ORIGIN, DESTINATION, NOW) is None
+    replaying = cache.ResponseCache(path, replay=True)
+    assert replaying.get(ORIGIN, DESTINATION, NOW) == JOURNEYS
+    # a pair without a response in the bucket falls back to its latest one
+    tomorrow = NOW + timedelta(days=1)
+    assert replaying.get(ORIGIN, DESTINATION, tomorrow) == JOURNEYS
+    assert replaying.get(DESTINATION, ORIGIN, tomorrow) is None
+    replaying.close()
+    responses.close()
+
+
+def test_identical_responses_are_stored_once(tmp_path, clock):
+    responses = cache.ResponseCache(str(tmp_path / "responses.db"))
+    responses.put(ORIGIN, DESTINATION, NOW, [])
+    responses.put(DESTINATION, ORIGIN, NOW, [])
+    responses.put(ORIGIN, DESTINATION, NOW + timedelta(hours=1), JOURNEYS)
+    count = responses.conn.execute("SELECT count(*) FROM bodies").fetchone()[0]
+    assert count == 2
+    assert responses.get(DESTINATION, ORIGIN, NOW) == []
+    responses.close()
+
+
+def test_evict_drops_old_responses_then_any_above_the_size(tmp_path, clock):
+    responses = cache.ResponseCache(str(tmp_path / "responses.db"))
+    responses.put(ORIGIN, DESTINATION, NOW, JOURNEYS)
+    clock[0] += 3600
+    responses.put(DESTINATION, ORIGIN, NOW, [])
+    responses.evict(max_age=1800)
+    keys = responses.conn.execute("SELECT origin FROM requests").fetchall()
+    assert keys == [(DESTINATION,)]
+    assert responses.conn.execute("SELECT count(*) FROM bodies").fetchone()[0] == 1
+
+    clock[0] += 60
+    responses.put(ORIGIN, DESTINATION, NOW, JOURNEYS)
+    responses.evict(max_mb=0)
+    assert responses.conn.execute("SELECT count(*) FROM requests").fetchone()[0] == 0
+    assert responses.conn.execute("SELECT count(*) FROM bodies").fetchone()[0] == 0
+    responses.close()
+
+
+def test_replay_falls_back_to_the_nearest_bucket(tmp_path, clock):
+    path = str(tmp_path / "responses.db")
+    responses = cache.ResponseCache(path)
+    for hour in (8, 10, 20):
+        responses.put(ORIGIN, DESTINATION, NOW.replace(hour=hour), [{"hour": hour}])
+    responses.close()
+    replaying = cache.ResponseCache(path, replay=True)
+    assert replaying.get(ORIGIN, DESTINATION, NOW.replace(hour=11)) == [{"hour": 10}]
+    assert replaying.get(ORIGIN, DESTINATION, NOW.replace(hour=7)) == [{"hour": 8}]
+    assert replaying.get(ORIGIN, DESTINATION, NOW.replace(hour=23)) == [{"hour": 20}]
+    replaying.close()
+
+
+def test_the_event_loop_does_not_run_the_sqlite_calls(tmp_path, clock):
+    responses = cache.ResponseCache(str(tmp_path / "responses.db"))
+    threads = []
+    get = responses.get
+    responses.get = lambda *args: threads.append(threading.get_ident()) or get(*args)
+
+    async def run():
+        await responses.store(ORIGIN, DESTINATION, NOW, JOURNEYS)
+        return await responses.lookup(ORIGIN, DESTINATION, NOW)
+
+    assert asyncio.run(run()) == JOURNEYS
+    assert threads and threading.get_ident() not in threads
+    responses.close()
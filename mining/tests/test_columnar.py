@@ -0,0 +1,92 @@
+import columnar
+import datetime
+import sqlite3
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+UTC = datetime.timezone.utc
+STOPS = [
+    (1, "Nord", 1, "2022-11-01T10:00:00Z", "[9.18, 48.8]", "[[9.1, 48.7]]"),
+    (2, "Nordbahnhof", 0, "2022-11-01T10:05:00Z", None, "[]"),
+    (3, "Station X", None, None, "not a coordinate", None),
+]
+
+
+def write_database(path):
+    conn = sqlite3.connect(path)
+    conn.execute(
+        """CREATE TABLE stops (
+            data_id INTEGER PRIMARY KEY AUTOINCREMENT, name VARCHAR,
+            isRealtimeControlled BOOLEAN, departureTimePlanned VARCHAR,
+            coord VARCHAR, interchange_coords VARCHAR
+        )"""
+    )
+    conn.executemany("INSERT INTO stops VALUES (?, ?, ?, ?, ?, ?)", STOPS)
+    conn.execute("CREATE VIEW named AS SELECT data_id, name FROM stops")
+    conn.commit()
+    conn.close()
+
+
+def test_columns_are_typed_from_the_declared_types(tmp_path, monkeypatch):
+    # several row groups per file
+    monkeypatch.setattr(columnar, "ROW_GROUP_SIZE", 2)
+    db_path = tmp_path / "2022-11-01.db"
+    write_database(db_path)
+    archive = columnar.write_archive(db_path, tmp_path / "parquet")
+
+    assert archive == tmp_path / "parquet" / "2022-11-01"
+    assert columnar.has_archive(db_path, tmp_path / "parquet")
+    # views are written like tables, SQLite's own tables are skipped
+    assert sorted(path.name for path in archive.iterdir()) == [
+        "named.parquet",
+        "stops.parquet",
+    ]
+    stops = pq.read_table(archive / "stops.parquet")
+    assert pq.ParquetFile(archive / "stops.parquet").num_row_groups == 2
+    assert stops.schema.field("data_id").type == pa.int64()
+    assert stops.schema.field("isRealtimeControlled").type == pa.bool_()
+    # Parquet has no seconds unit, the times are read back in milliseconds
+    assert stops.schema.field("departureTimePlanned").type == pa.timestamp(
+        "ms", tz="UTC"
+    )
+    assert stops.column("isRealtimeControlled").to_pylist() == [True, False, None]
+    assert stops.column("departureTimePlanned").to_pylist() == [
+        datetime.datetime(2022, 11, 1, 10, 0, tzinfo=UTC),
+        datetime.datetime(2022, 11, 1, 10, 5, tzinfo=UTC),
+        None,
+    ]
+    assert stops.column("coord").to_pylist() == [[9.18, 48.8], None, None]
+    assert stops.column("interchange_coords").to_pylist() == [[[9.1, 48.7]], [], None]
+    assert pq.read_table(archive / "named.parquet").num_rows == 3
+
+
+def test_times_not_in_the_efa_format_are_parsed_one_by_one():
+    array = columnar.to_array(
+        ["2022-11-01T10:00:00+01:00", "garbage", None], columnar.TIME_TYPE
+    )
+    assert array.to_pylist() == [
+        datetime.datetime(2022, 11, 1, 9, 0, tzinfo=UTC),
+        None,
+        None,
+    ]
+
+
+def test_archives_are_replaced_whole(tmp_path):
+    db_path = tmp_path / "2022-11-01.db"
+    write_database(db_path)
+    out_dir = tmp_path / "parquet"
+    archive = columnar.write_archive(db_path, out_dir)
+    (archive / "stale.parquet").write_bytes(b"")
+    assert columnar.write_archive(db_path, out_dir) == archive
+    assert not (archive / "stale.parquet").exists()
+    # no temporary directory is left next to the archive
+    assert list(out_dir.iterdir()) == [archive]
+
+
+def test_coordinates_of_the_wrong_shape_are_nulled_one_by_one():
+    values = ["[9.18, 48.8]", '["north", 48.8]', "[[9.1, 48.7]]", None]
+    array = columnar.to_array(values, columnar.COORD_TYPE)
+    assert array.to_pylist() == [[9.18, 48.8], None, None, None]
+    values = ["[[9.1, 48.7]]", "[9.1, 48.7]", "[]"]
+    array = columnar.to_array(values, columnar.COORD_TYPES["interchange_coords"])
+    assert array.to_pylist() == [[[9.1, 48.7]], None, []]
@@ -0,0 +1,79 @@
+import asyncio
+import time
+import pytest
+import crawler
+
+
+class FailingPool:
+    """Proxy pool whose acquire raises, like a bug in the pool would"""
+
+    def acquire(self):
+        raise RuntimeError("pool broken")
+
+    def release(self, proxy, latency=None, ok=None):
+        pass
+
+
+def open_breaker(client: crawler.Crawler):
+    # cooldown over, the next request is the probe
+    client.breaker.open_until = time.monotonic() - 1
+
+
+def test_probe_raising_an_unexpected_error_releases_the_breaker(registry):
+    client = crawler.Crawler(proxy_pool=FailingPool())
+    open_breaker(client)
+
+    async def run():
+        with pytest.raises(RuntimeError):
+            await client.get_scheduled("http://efa.invalid", {})
+        assert not client.breaker.probing
+        client.proxy_pool = None
+
+        async def fetch_json(url, params, proxy=None):
+            return {"journeys": []}
+
+        client.fetch_json = fetch_json
+        return await asyncio.wait_for(
+            client.get_scheduled("http://efa.invalid", {}), timeout=2
+        )
+
+    assert asyncio.run(run()) == {"journeys": []}
+    assert client.breaker.open_until is None
+
+
+def test_cancelled_probe_releases_the_breaker(registry):
+    client = crawler.Crawler()
+    open_breaker(client)
+    started = asyncio.Event()
+
+    async def hang(url, params, proxy=None):
+        started.set()
+        await asyncio.sleep(60)
+
+    client.fetch_json = hang
+
+    async def run():
+        probe = asyncio.create_task(client.get_scheduled("http://efa.invalid", {}))
+        await started.wait()
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+
+    asyncio.run(run())
+    assert not client.breaker.probing
+    assert client.limiter.in_flight == 0
+
+
+def test_failed_tries_are_retried_and_counted(registry, monkeypatch):
+    monkeypatch.setattr(crawler, "RETRY_TRIES", 3)
+    monkeypatch.setattr(crawler, "RETRY_DELAY", 0)
+    client = crawler.Crawler()
+
+    async def timeout(url, params, proxy=None):
+        raise asyncio.TimeoutError()
+
+    client.fetch_json = timeout
+    assert asyncio.run(client.get_scheduled("http://efa.invalid", {})) is None
+    assert client.retries == 2 and client.failed == 1
+    key = ("mining_requests_total", (("outcome", "timeout"),))
+    assert registry.counters[key] == 3
@@ -0,0 +1,95 @@
+import asyncio
+import daemon
+
+ORIGIN = "de:08111:6118"
+DESTINATION = "de:08116:4241"
+
+
+def board(year: int, minute: int, estimated: int = None) -> dict:
+    """Departure board entry of the S1 at 11:<minute> local time, 10:<minute>Z"""
+
+    def efa(minute: int) -> dict:
+        return {
+            "year": str(year),
+            "month": "11",
+            "day": "1",
+            "hour": "11",
+            "minute": str(minute),
+        }
+
+    departure = {
+        "dateTime": efa(minute),
+        "servingLine": {"key": str(minute), "motType": "1", "number": "S1"},
+    }
+    if estimated is not None:
+        departure["realDateTime"] = efa(estimated)
+    return departure
+
+
+def trip(year: int, minute: int, estimated: int = None) -> dict:
+    origin = {"departureTimePlanned": f"{year}-11-01T10:{minute:02d}:00Z"}
+    if estimated is not None:
+        origin["departureTimeEstimated"] = f"{year}-11-01T10:{estimated:02d}:00Z"
+    return {"legs": [{"transportation": {"number": "S1"}, "origin": origin}]}
+
+
+def tracker(boards: list[dict], trips: list[dict], **options) -> daemon.PairTracker:
+    pairs = daemon.PairTracker(**options)
+    pairs.update_boards([(ORIGIN, departure) for departure in boards])
+    pairs.fetched(ORIGIN, DESTINATION, trips)
+    return pairs
+
+
+def test_unchanged_departures_skip_the_pair():
+    pairs = tracker([board(2099, 5, 7), board(2099, 20)], [trip(2099, 5, 7)])
+    assert pairs.is_current(ORIGIN, DESTINATION)
+    assert not pairs.is_current(DESTINATION, ORIGIN)
+    assert pairs.skipped == 1
+
+
+def test_changed_or_missing_departures_fetch_the_pair():
+    # the estimate moved since the response
+    assert not tracker([board(2099, 5, 9)], [trip(2099, 5, 7)]).is_current(
+        ORIGIN, DESTINATION
+    )
+    # a realtime estimate appeared
+    assert not tracker([board(2099, 5, 6)], [trip(2099, 5)]).is_current(
+        ORIGIN, DESTINATION
+    )
+    # the departure is not on the board
+    assert not tracker([board(2099, 20)], [trip(2099, 5)]).is_current(
+        ORIGIN, DESTINATION
+    )
+
+
+def test_old_past_or_unknown_departures_fetch_the_pair():
+    pairs = tracker([board(2099, 5)], [trip(2099, 5)], max_age=-1)
+    assert not pairs.is_current(ORIGIN, DESTINATION)
+    # every departure of the response has left
+    pairs = tracker([board(2000, 5)], [trip(2000, 5)])
+    assert not pairs.is_current(ORIGIN, DESTINATION)
+    # a journey starting with a footpath has no departure on the board
+    footpath = {"legs": [{"transportation": {}, "origin": {}}]}
+    pairs = tracker([board(2099, 5)], [trip(2099, 5), footpath])
+    assert not pairs.is_current(ORIGIN, DESTINATION)
+    assert pairs.skipped == 0
+
+
+def test_the_cache_is_closed_when_the_daemon_fails(monkeypatch):
+    closed = []
+
+    class Cache:
+        def close(self):
+            closed.append(True)
+
+    def no_proxies():
+        raise OSError
+
+    monkeypatch.setattr(daemon.cache, "open_cache", Cache)
+    monkeypatch.setattr(daemon.download, "plan_trip_queries", lambda *args: [])
+    monkeypatch.setattr(daemon.proxies, "load_pool", no_proxies)
+    try:
+        asyncio.run(daemon.run([]))
+    except OSError:
+        pass
+    assert closed == [True]
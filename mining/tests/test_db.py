@@ -0,0 +1,293 @@
+import copy
+import sqlite3
+import tempfile
+import benchmark_storage
+import columnar
+import db
+
+from datetime import date, timedelta
+from pathlib import Path
+
+
+def bus_trip(number: int) -> dict:
+    trip = benchmark_storage.synthetic_trip(number)
+    trip["legs"][0]["transportation"]["properties"]["trainType"] = "Bus"
+    return trip
+
+
+def wide_engine(directory: str):
+    engine = db.create_sqlite_engine(str(Path(directory) / "test.db"), "default")
+    db.create_tables(engine, "wide")
+    return engine
+
+
+def test_parse_trips_keeps_train_trips_as_rows():
+    trips = [benchmark_storage.synthetic_trip(1), bus_trip(2)]
+    parsed = db.parse_trips(trips)
+    assert len(parsed) == 1
+    trip_row, legs = parsed[0]
+    assert isinstance(trip_row, tuple) and len(legs) == 1
+    leg_row, (stops, hints, infos, paths) = legs[0]
+    assert len(stops) == 12 and len(hints) == 1 and infos == () and paths == ()
+
+
+def test_parse_trips_skips_malformed_journeys(registry):
+    trips = [
+        benchmark_storage.synthetic_trip(1),
+        {"rating": 0},
+        {"legs": None},
+        benchmark_storage.synthetic_trip(2),
+    ]
+    assert len(db.parse_trips(trips)) == 2
+    assert registry.counters[("mining_malformed_trips_total", ())] == 2
+
+
+def test_parse_trips_interns_repeated_strings():
+    first, second = db.parse_trips(
+        [benchmark_storage.synthetic_trip(1), benchmark_storage.synthetic_trip(2)]
+    )
+    name = db.COLUMNS[db.Stop].index("name")
+    assert first[1][0][1][0][0][name] is second[1][0][1][0][0][name]
+
+
+def test_parse_time_is_recorded_where_trips_are_parsed(registry):
+    trips = db.parse_trips([benchmark_storage.synthetic_trip(i) for i in range(3)])
+    assert registry.histograms[("mining_parse_seconds", ())].count == 1
+    with tempfile.TemporaryDirectory() as directory:
+        engine = wide_engine(directory)
+        db.insert_bulk(engine, trips)
+        engine.dispose()
+    assert registry.histograms[("mining_parse_seconds", ())].count == 1
+    assert registry.histograms[("mining_flatten_seconds", ())].count == 1
+
+
+def test_parse_trips_leaves_the_response_untouched():
+    trip = benchmark_storage.synthetic_trip(1)
+    raw = copy.deepcopy(trip)
+    db.parse_trips([trip])
+    assert trip == raw
+
+
+def user_version(path: str) -> int:
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_rollover_leaves_compaction_to_compact_past_days(monkeypatch):
+    yesterday = date.today() - timedelta(days=1)
+    path = db.daily_db_path(yesterday)
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    engine = db.create_sqlite_engine(path)
+    db.create_tables(engine)
+    monkeypatch.setattr(db, "CURRENT_DATE", yesterday)
+    monkeypatch.setattr(db, "ENGINE", engine)
+    monkeypatch.setattr(db, "SESSION", db.sessionmaker(bind=engine)())
+    assert db.new_departures([]) is None
+    assert db.CURRENT_DATE == date.today()
+    assert user_version(path) == 0 and not columnar.has_archive(path)
+
+    assert db.compact_past_days() is None
+    assert user_version(path) == 1 and columnar.has_archive(path)
+    db.close()
+
+
+def test_days_the_miner_missed_are_compacted():
+    paths = []
+    for days in (3, 2):
+        path = db.daily_db_path(date.today() - timedelta(days=days))
+        engine = db.create_sqlite_engine(path)
+        db.create_tables(engine)
+        engine.dispose()
+        paths.append(path)
+    (Path(db.DB_DIR) / "notes.db").write_bytes(b"not a database")
+    today = db.daily_db_path(date.today())
+    assert db.compact_past_days() is None
+    for path in paths:
+        assert user_version(path) == 1 and columnar.has_archive(path)
+    assert not columnar.has_archive(today)
+
+
+def detailed_trip(number: int) -> dict:
+    """Synthetic trip with an info, a path description and missing fields"""
+    trip = benchmark_storage.synthetic_trip(number)
+    del trip["interchanges"]
+    leg = trip["legs"][0]
+    leg["transportation"]["properties"]["trainNumber"] = None
+    leg["infos"] = [
+        {
+            "id": f"info-{number}",
+            "priority": "normal",
+            "content": "Aufzug defekt",
+            "properties": {"publisher": "VVS"},
+        }
+    ]
+    leg["pathDescriptions"] = [
+        {"name": "Gleis 1", "niveau": 0, "coord": [48.7, 9.1], "duration": 30}
+    ]
+    return trip
+
+
+def table_rows(path: Path) -> dict:
+    with sqlite3.connect(path) as conn:
+        rows = {
+            table.name: conn.execute(
+                f"SELECT * FROM {table.name} ORDER BY data_id"
+            ).fetchall()
+            for table in db.ENTITY_BASE.metadata.sorted_tables
+        }
+    conn.close()
+    return rows
+
+
+def test_bulk_insert_writes_the_rows_of_the_orm():
+    trips = db.parse_trips([detailed_trip(i) for i in range(3)])
+    with tempfile.TemporaryDirectory() as directory:
+        orm = db.create_sqlite_engine(str(Path(directory) / "orm.db"), "default")
+        db.create_tables(orm, "wide")
+        session = db.sessionmaker(bind=orm)()
+        session.add_all([db.new_trip(trip) for trip in trips])
+        session.commit()
+        session.close()
+        orm.dispose()
+        bulk = wide_engine(directory)
+        # two batches, keys continue after the rows already written
+        db.insert_bulk(bulk, trips[:1])
+        db.insert_bulk(bulk, trips[1:])
+        bulk.dispose()
+        expected = table_rows(Path(directory) / "orm.db")
+        assert table_rows(Path(directory) / "test.db") == expected
+    assert all(expected[table] for table in ("trips", "legs", "stops", "infos"))
+    assert expected["pathDescriptions"]
+
+
+def test_orm_entry_points_still_take_trip_dicts():
+    trip = detailed_trip(1)
+    trip["isAdditional"] = True
+    assert db.new_trip(bus_trip(2)) is None
+    with tempfile.TemporaryDirectory() as directory:
+        rows = {}
+        for name, trips in (
+            ("dicts", [trip, bus_trip(2)]),
+            ("tuples", db.parse_trips([trip])),
+        ):
+            engine = db.create_sqlite_engine(str(Path(directory) / f"{name}.db"))
+            db.create_tables(engine, "wide")
+            session = db.sessionmaker(bind=engine)()
+            session.add_all(
+                [entry for entry in map(db.new_trip, trips) if entry is not None]
+            )
+            session.commit()
+            session.close()
+            engine.dispose()
+            rows[name] = table_rows(Path(directory) / f"{name}.db")
+        conn = sqlite3.connect(Path(directory) / "dicts.db")
+        assert conn.execute("SELECT isAdditional FROM trips").fetchall() == [(None,)]
+        conn.close()
+    assert rows["dicts"] == rows["tuples"]
+
+
+def test_flatten_trip_maps_the_fields_of_the_tables():
+    trip_row, ((leg_row, (stops, hints, infos, paths)),) = db.flatten_trip(
+        detailed_trip(7)
+    )
+    trip = dict(zip(db.COLUMNS[db.Trip], trip_row))
+    assert trip["rating"] == 0 and trip["interchanges"] is None
+    leg = dict(zip(db.COLUMNS[db.Leg], leg_row))
+    assert leg["transportation_name"] == "S-Bahn S1"
+    assert leg["isRealtimeControlled"] is True
+    # lists are stored as their text, missing and null values as NULL
+    assert leg["realtimeStatus"] == "['MONITORED']"
+    assert leg["transportation_properties_trainNumber"] is None
+    stop = dict(zip(db.COLUMNS[db.Stop], stops[0]))
+    assert stop["parent_id"] == "de:08111:6000" and stop["niveau"] == 0
+    info = dict(zip(db.COLUMNS[db.Info], infos[0]))
+    assert info["properties_publisher"] == "VVS" and info["title"] is None
+    path = dict(zip(db.COLUMNS[db.PathDescription], paths[0]))
+    assert path["coord"] == "[48.7, 9.1]" and path["duration"] == 30
+    assert len(hints) == 1
+
+
+def test_flatten_trip_skips_trips_with_other_legs():
+    trip = benchmark_storage.synthetic_trip(1)
+    trip["legs"].append(bus_trip(2)["legs"][0])
+    assert db.flatten_trip(trip) is None
+    footpath = benchmark_storage.synthetic_trip(3)
+    del footpath["legs"][0]["transportation"]["properties"]["trainType"]
+    assert db.flatten_trip(footpath) is None
+
+
+def normalized_counts(path: Path) -> dict:
+    with sqlite3.connect(path) as conn:
+        counts = {
+            table: conn.execute(f"SELECT count(*) FROM {table}").fetchone()[0]
+            for table in db.layout_tables("normalized")
+        }
+    conn.close()
+    return counts
+
+
+def view_rows(path: Path, table: str, columns: list[str] = None) -> tuple:
+    """(columns, sorted rows) of a table or view, without its keys"""
+    with sqlite3.connect(path) as conn:
+        if columns is None:
+            cur = conn.execute(f"SELECT * FROM {table} LIMIT 0")
+            columns = [
+                column[0]
+                for column in cur.description
+                if column[0] not in ("data_id", "data_trip_id", "data_leg_id")
+            ]
+        names = ", ".join(f'"{column}"' for column in columns)
+        rows = conn.execute(f"SELECT {names} FROM {table}").fetchall()
+    conn.close()
+    return columns, sorted(rows, key=repr)
+
+
+def test_normalized_layout_stores_only_changes(monkeypatch):
+    monkeypatch.setattr(db, "NORMALIZED_STATE", None)
+    first = db.parse_trips([detailed_trip(i) for i in range(3)])
+    delayed = detailed_trip(1)
+    delayed["legs"][0]["stopSequence"] = benchmark_storage.synthetic_trip(1, delay=5)[
+        "legs"
+    ][0]["stopSequence"]
+    later = db.parse_trips([delayed])
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory) / "normalized.db"
+        engine = db.create_sqlite_engine(str(path), "default")
+        db.create_tables(engine, "normalized")
+        db.insert_normalized(engine, first, "2022-11-01T10:00:00Z")
+        counts = normalized_counts(path)
+        db.insert_normalized(engine, first, "2022-11-01T10:05:00Z")
+        assert normalized_counts(path) == counts
+        db.insert_normalized(engine, later, "2022-11-01T10:10:00Z")
+        changed = normalized_counts(path)
+        engine.dispose()
+        assert changed["stop_observations"] == counts["stop_observations"] + 12
+        for table in ("trains", "stop_events", "stop_points", "train_hints"):
+            assert changed[table] == counts[table], table
+    assert counts["stop_observations"] == counts["stop_events"] == 36
+    # the hint every train shows is stored once
+    assert counts["train_hints"] == 3 and counts["hint_texts"] == 1
+
+
+def test_normalized_views_show_the_latest_observation(monkeypatch):
+    monkeypatch.setattr(db, "NORMALIZED_STATE", None)
+    trips = [benchmark_storage.synthetic_trip(i) for i in range(3)]
+    latest = trips[:1] + [benchmark_storage.synthetic_trip(1, delay=5)] + trips[2:]
+    with tempfile.TemporaryDirectory() as directory:
+        engine = db.create_sqlite_engine(str(Path(directory) / "view.db"), "default")
+        db.create_tables(engine, "normalized")
+        db.insert_normalized(engine, db.parse_trips(trips), "2022-11-01T10:00:00Z")
+        db.insert_normalized(engine, db.parse_trips(latest), "2022-11-01T10:05:00Z")
+        engine.dispose()
+        wide = wide_engine(directory)
+        db.insert_bulk(wide, db.parse_trips(latest))
+        wide.dispose()
+        for table in ("legs", "stops", "hints"):
+            columns, rows = view_rows(Path(directory) / "view.db", table)
+            assert rows and columns, table
+            assert (columns, rows) == view_rows(
+                Path(directory) / "test.db", table, columns
+            ), table
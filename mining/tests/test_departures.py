@@ -0,0 +1,117 @@
+import asyncio
+import sqlite3
+import tempfile
+import cache
+import db
+import download
+
+from datetime import datetime
+from pathlib import Path
+
+STATION = "de:08111:6118"
+NOW = datetime(2022, 11, 1, 10, 0)
+
+
+def departure(key: str, hour: int, mot: str = "1", estimated: int = None) -> dict:
+    def efa(hour: int, month: int = 11) -> dict:
+        return {"year": "2022", "month": str(month), "day": "1", "hour": str(hour)}
+
+    board = {
+        "stopName": "Hauptbahnhof (tief)",
+        "platform": "101",
+        "dateTime": {**efa(hour), "minute": "5"},
+        "servingLine": {
+            "key": key,
+            "motType": mot,
+            "name": "S-Bahn",
+            "number": "S1",
+            "trainNum": "8001",
+            "direction": "Kirchheim (T)",
+            "realtime": "1" if estimated is not None else "0",
+        },
+    }
+    if estimated is not None:
+        board["realDateTime"] = {**efa(hour), "minute": str(estimated)}
+    return board
+
+
+def test_flatten_departure_keeps_trains_with_a_key():
+    assert db.flatten_departure(STATION, departure("1", 10, mot="5")) is None
+    without_key = departure("1", 10)
+    del without_key["servingLine"]["key"]
+    assert db.flatten_departure(STATION, without_key) is None
+    incomplete = departure("1", 10)
+    del incomplete["dateTime"]["hour"]
+    assert db.flatten_departure(STATION, incomplete) is None
+    row = db.flatten_departure(STATION, departure("1", 10, estimated=9))
+    assert row["transportation_name"] == "S-Bahn S1" and row["trip_code"] == "1"
+    assert row["realtime"] is True
+
+
+def test_flatten_departure_converts_local_time_to_utc():
+    row = db.flatten_departure(STATION, departure("1", 10, estimated=9))
+    # CET in November, CEST in July
+    assert row["departureTimePlanned"] == "2022-11-01T09:05:00Z"
+    assert row["departureTimeEstimated"] == "2022-11-01T09:09:00Z"
+    summer = departure("1", 10)
+    summer["dateTime"]["month"] = "7"
+    assert db.flatten_departure(STATION, summer)["departureTimePlanned"] == (
+        "2022-07-01T08:05:00Z"
+    )
+
+
+def test_departure_upsert_keeps_the_last_estimate():
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory) / "test.db"
+        engine = db.create_sqlite_engine(str(path), "default")
+        db.create_tables(engine, "wide")
+        first = [departure("1", 10, estimated=9), departure("2", 11)]
+        db.insert_departures(engine, [db.flatten_departure(STATION, d) for d in first])
+        later = [departure("1", 10), departure("2", 11, estimated=12)]
+        db.insert_departures(engine, [db.flatten_departure(STATION, d) for d in later])
+        engine.dispose()
+        with sqlite3.connect(path) as conn:
+            rows = conn.execute(
+                "SELECT trip_code, departureTimeEstimated, realtime "
+                "FROM departures ORDER BY trip_code"
+            ).fetchall()
+    assert rows == [
+        ("1", "2022-11-01T09:09:00Z", 0),
+        ("2", "2022-11-01T10:12:00Z", 1),
+    ]
+
+
+class BoardClient:
+    """Crawler stand-in answering departure requests from a dict"""
+
+    def __init__(self, boards: dict):
+        self.boards = boards
+        self.requests = 0
+
+    async def get_departures(self, station: str, time: datetime) -> list[dict]:
+        self.requests += 1
+        return self.boards.get(station)
+
+
+def test_departure_boards_are_recorded_and_replayed():
+    boards = {STATION: [departure("1", 10), departure("2", 11)]}
+    with tempfile.TemporaryDirectory() as directory:
+        path = str(Path(directory) / "responses.db")
+        recording = cache.ResponseCache(path)
+        client = BoardClient(boards)
+        recorded = asyncio.run(
+            download.fetch_departures(client, [STATION], NOW, recording)
+        )
+        recording.close()
+        assert client.requests == 1 and len(recorded) == 2
+
+        replaying = cache.ResponseCache(path, replay=True)
+        offline = BoardClient({})
+        replayed = asyncio.run(
+            download.fetch_departures(offline, [STATION], NOW, replaying)
+        )
+        # trip pairs never answer a departure board request
+        assert replaying.get(STATION, "de:08111:6115", NOW) is None
+        replaying.close()
+    assert offline.requests == 0
+    assert replayed == recorded == [(STATION, d) for d in boards[STATION]]
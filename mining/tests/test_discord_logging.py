@@ -0,0 +1,54 @@
+import discord_logging
+
+MENTION = "<@&1>"
+
+
+class ListSink:
+    def __init__(self):
+        self.posts = []
+
+    def send(self, content: str, file: str = None):
+        self.posts.append((content, file))
+
+
+def test_only_posts_with_an_error_mention():
+    lines = [("a" * 1000, False), ("ERROR: b", True), ("c" * 1000, False)]
+    assert discord_logging.chunk(lines, MENTION) == [
+        f"{MENTION}\n" + "a" * 1000 + "\nERROR: b",
+        "c" * 1000,
+    ]
+    assert discord_logging.chunk([("info", False)], MENTION) == ["info"]
+
+
+def test_mentioned_posts_stay_below_the_limit():
+    lines = [("x" * 5000, True)]
+    (post,) = discord_logging.chunk(lines, MENTION)
+    assert post.startswith(MENTION + "\n")
+    assert len(post) == discord_logging.MAX_MESSAGE_LENGTH
+
+
+def test_hidden_errors_mention_the_last_post(monkeypatch):
+    monkeypatch.setattr(discord_logging, "MAX_POSTS", 1)
+    lines = [("a" * 1500, False), ("b" * 1500, False), ("ERROR: c", True)]
+    (post,) = discord_logging.chunk(lines, MENTION)
+    assert post.startswith(MENTION) and post.endswith("... and 2 more messages")
+
+
+def test_repeated_messages_are_coalesced():
+    messages = [("x", False), ("y", True), ("x", True), ("x", False)]
+    assert discord_logging.coalesce(messages) == [("x (x3)", True), ("y", True)]
+
+
+def test_channel_mentions_errors_but_not_dropped_counts(monkeypatch):
+    monkeypatch.setattr(discord_logging, "BATCH_INTERVAL", 0.05)
+    sink = ListSink()
+    channel = discord_logging.Channel(sink, MENTION)
+    channel.dropped = 2
+    channel.close()
+    channel = discord_logging.Channel(sink, MENTION)
+    channel.send("ERROR: broken", mention=True)
+    channel.close()
+    assert sink.posts == [
+        ("2 messages dropped, logging queue was full", None),
+        (f"{MENTION}\nERROR: broken", None),
+    ]
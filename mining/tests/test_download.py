@@ -0,0 +1,101 @@
+import asyncio
+import pytest
+import cache
+import download
+import proxies
+
+from datetime import datetime
+
+
+class Writes:
+    """write_trips stand-in recording the batches, failing as told"""
+
+    def __init__(self, fail: dict = None):
+        self.batches = []
+        self.fail = fail or {}
+
+    def __call__(self, trips: list) -> str:
+        outcome = self.fail.get(len(self.batches))
+        self.batches.append(list(trips))
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+def drain(trips: list, writes: Writes) -> int:
+    async def run():
+        queue = asyncio.Queue()
+        writer = asyncio.create_task(download.trip_writer(queue))
+        for trip in trips:
+            await queue.put(trip)
+        await queue.put(None)
+        return await writer
+
+    return asyncio.run(run())
+
+
+def test_trip_writer_flushes_full_batches_and_the_rest(monkeypatch, registry):
+    monkeypatch.setattr(download, "FLUSH_SIZE", 3)
+    writes = Writes()
+    monkeypatch.setattr(download, "write_trips", writes)
+    assert drain(list(range(7)), writes) == 7
+    assert writes.batches == [[0, 1, 2], [3, 4, 5], [6]]
+    assert registry.counters[("mining_flushed_trips_total", ())] == 7
+
+
+def test_trip_writer_flushes_after_the_interval(monkeypatch, registry):
+    monkeypatch.setattr(download, "FLUSH_INTERVAL", 0.05)
+    writes = Writes()
+    monkeypatch.setattr(download, "write_trips", writes)
+
+    async def run():
+        queue = asyncio.Queue()
+        writer = asyncio.create_task(download.trip_writer(queue))
+        await queue.put(1)
+        await asyncio.sleep(0.2)
+        flushed = list(writes.batches)
+        await queue.put(None)
+        return flushed, await writer
+
+    assert asyncio.run(run()) == ([[1]], 1)
+
+
+def test_trip_writer_keeps_draining_after_failed_writes(monkeypatch, registry):
+    monkeypatch.setattr(download, "FLUSH_SIZE", 2)
+    writes = Writes(fail={0: "database is locked", 1: RuntimeError("disk full")})
+    monkeypatch.setattr(download, "write_trips", writes)
+    errors = []
+    monkeypatch.setattr(download.discord_logging, "error", errors.append)
+    # only the last batch is written
+    assert drain(list(range(5)), writes) == 1
+    assert len(writes.batches) == 3
+    assert errors == [
+        "Could not save trips: database is locked",
+        "Could not save trips: disk full",
+    ]
+
+
+def test_crawl_writes_the_queued_trips_if_the_sweep_fails(monkeypatch, registry):
+    writes = Writes()
+    monkeypatch.setattr(download, "write_trips", writes)
+    monkeypatch.setattr(download, "plan_trip_queries", lambda stations, responses: {})
+    monkeypatch.setattr(cache, "RESPONSE_CACHE_MODE", "off")
+    monkeypatch.setattr(proxies, "load_pool", proxies.ProxyPool)
+
+    async def sweep_trips(client, plan, curr_time, queue, responses):
+        for trip in range(3):
+            await queue.put(trip)
+        raise RuntimeError("sweep failed")
+
+    monkeypatch.setattr(download, "sweep_trips", sweep_trips)
+
+    async def run():
+        with pytest.raises(RuntimeError):
+            await asyncio.wait_for(
+                download.crawl([], datetime.now(), departures=False), timeout=5
+            )
+        # the writer finished instead of being left pending
+        assert len(asyncio.all_tasks()) == 1
+
+    asyncio.run(run())
+    assert writes.batches == [[0, 1, 2]]
@@ -0,0 +1,63 @@
+import json
+import metrics
+
+
+def test_histogram_buckets_and_quantiles():
+    histogram = metrics.Histogram()
+    for value in (0.001, 0.02, 0.02, 0.3, 100):
+        histogram.observe(value)
+    cumulative = dict(histogram.cumulative())
+    assert cumulative["0.001"] == 1
+    assert cumulative["0.025"] == 3
+    assert cumulative["0.5"] == 4
+    assert cumulative["60"] == 4 and cumulative["+Inf"] == 5
+    assert histogram.quantile(0.5) == 0.025
+    assert histogram.quantile(0.99) == float("inf")
+    assert histogram.count == 5 and abs(histogram.sum - 100.341) < 1e-9
+
+
+def test_series_are_keyed_by_sorted_labels(registry):
+    metrics.inc("mining_requests_total", outcome="ok", proxy="direct")
+    metrics.inc("mining_requests_total", 2, proxy="direct", outcome="ok")
+    metrics.gauge("mining_proxies", 3)
+    metrics.gauge("mining_proxies", 4)
+    metrics.gauge_all("mining_cache", {"hits": 5, "mode": "on"})
+    key = ("mining_requests_total", (("outcome", "ok"), ("proxy", "direct")))
+    assert registry.counters == {key: 3}
+    assert registry.gauges == {
+        ("mining_proxies", ()): 4,
+        ("mining_cache_hits", ()): 5,
+    }
+
+
+def test_timer_observes_even_on_errors(registry):
+    try:
+        with metrics.timer("mining_stage_seconds", stage="write"):
+            raise ValueError
+    except ValueError:
+        pass
+    histogram = registry.histograms[("mining_stage_seconds", (("stage", "write"),))]
+    assert histogram.count == 1
+
+
+def test_export_writes_the_report_and_the_textfile(registry, tmp_path):
+    metrics.inc("mining_requests_total", outcome="ok")
+    metrics.gauge("mining_proxy_success_rate", 0.5, proxy='http://"a"')
+    metrics.observe("mining_request_seconds", 0.2, outcome="ok")
+    report, textfile = tmp_path / "metrics.json", tmp_path / "metrics.prom"
+    metrics.export(str(report), str(textfile))
+
+    data = json.loads(report.read_text())
+    assert data["counters"] == {'mining_requests_total{outcome="ok"}': 1}
+    histogram = data["histograms"]['mining_request_seconds{outcome="ok"}']
+    assert histogram["count"] == 1 and histogram["p50"] == 0.25
+    assert "mining_run_duration_seconds" in data["gauges"]
+
+    lines = textfile.read_text().splitlines()
+    assert "# TYPE mining_requests_total counter" in lines
+    assert 'mining_proxy_success_rate{proxy="http://\\"a\\""} 0.5' in lines
+    assert "# TYPE mining_request_seconds histogram" in lines
+    assert 'mining_request_seconds_bucket{outcome="ok",le="+Inf"} 1' in lines
+    assert 'mining_request_seconds_count{outcome="ok"} 1' in lines
+    # no temporary files are left behind
+    assert sorted(tmp_path.iterdir()) == sorted([report, textfile])
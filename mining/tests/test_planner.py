@@ -0,0 +1,101 @@
+import benchmark_pipeline
+import cache
+import download
+import planner
+import stations
+import utils
+
+from datetime import datetime
+
+from pathlib import Path
+
+STATION_FILE = Path(stations.__file__).with_name("vvs_sbahn_haltestellen_2022.csv")
+
+
+def trip(number: str, *stops: str) -> dict:
+    return {
+        "legs": [
+            {
+                "transportation": {"properties": {"trainNumber": number}},
+                "stopSequence": [
+                    {"id": stop, "departureTimePlanned": "2022-11-01T10:00:00Z"}
+                    for stop in stops
+                ],
+            }
+        ]
+    }
+
+
+def entry(origin: str, destination: str, *trips: dict) -> dict:
+    return {
+        "origin": origin,
+        "destination": destination,
+        "status": 200,
+        "response": {"journeys": list(trips)},
+    }
+
+
+def test_observation_coverage_counts_train_stop_pairs():
+    full = [trip("1", "a", "b"), trip("2", "b", "c")]
+    assert planner.observation_coverage(full, full) == 1.0
+    assert planner.observation_coverage([trip("1", "a", "b", "x")], full) == 0.5
+    assert planner.observation_coverage([], []) == 1.0
+
+
+def test_plan_report_compares_query_counts():
+    report = planner.plan_report(["a", "b", "c"], {"a": ["c"], "b": ["c"]})
+    assert report == {
+        "queries": 2,
+        "full_sweep_queries": 6,
+        "query_reduction": 1 - 2 / 6,
+    }
+
+
+def test_recorded_coverage_replays_plan_and_full_sweep():
+    rows = stations.load_stations(str(STATION_FILE)).rows
+    plan = planner.plan_queries(stations.load_stations(str(STATION_FILE)))
+    start = next(iter(plan))
+    planned = entry(start, plan[start][0], trip("1", "a", "b"))
+    # a pair only the full sweep queries, seeing another train
+    skipped = next(
+        (origin, destination)
+        for origin, destinations in planner.full_sweep([row[3] for row in rows]).items()
+        for destination in destinations
+        if destination not in plan.get(origin, [])
+    )
+    unplanned = entry(*skipped, trip("1", "b"), trip("2", "c", "d"))
+    failed = {**entry(*skipped, trip("3", "e")), "status": 503}
+
+    report = benchmark_pipeline.recorded_coverage([entry("x", "y")], rows)
+    assert report["recorded_pairs"] == 0 and report["observation_coverage"] is None
+    report = benchmark_pipeline.recorded_coverage([planned], rows)
+    assert report["recorded_pairs"] == 1 and report["observation_coverage"] == 1.0
+    report = benchmark_pipeline.recorded_coverage([planned, unplanned, failed], rows)
+    assert report["recorded_pairs"] == 2
+    assert report["observation_coverage"] == 0.5
+    assert report["queries"] == planner.query_count(plan)
+
+
+def test_sweeps_log_the_coverage_of_the_planner(tmp_path, monkeypatch, registry):
+    ids = utils.read_station_ids_csv(str(STATION_FILE))
+    plan = planner.plan_queries(utils.registry)
+    start = next(iter(plan))
+    responses = cache.ResponseCache(str(tmp_path / "responses.db"))
+    now = datetime(2022, 11, 1, 10, 0)
+    responses.put(start, plan[start][0], now, [trip("1", "a", "b")])
+    # the departure board of a station is no trip response
+    responses.put(start, cache.DEPARTURE_BOARD, now, [{"stopName": "x"}])
+
+    monkeypatch.setattr(planner, "QUERY_PLANNER", False)
+    assert download.plan_trip_queries(ids, responses) == planner.full_sweep(ids)
+    gauges = {name: value for (name, _), value in registry.gauges.items()}
+    assert gauges["mining_planner_sweep_queries"] == len(ids) * (len(ids) - 1)
+    assert gauges["mining_planner_queries"] == planner.query_count(plan)
+    assert gauges["mining_planner_recorded_pairs"] == 1
+    assert gauges["mining_planner_observation_coverage"] == 1.0
+
+    monkeypatch.setattr(planner, "QUERY_PLANNER", True)
+    assert download.plan_trip_queries(ids) == plan
+    sweep = registry.gauges[("mining_planner_sweep_queries", ())]
+    assert sweep == planner.query_count(plan)
+    responses.close()
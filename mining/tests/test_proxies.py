@@ -0,0 +1,78 @@
+import download
+import proxies
+
+GOOD = "http://10.0.0.1:8080"
+BAD = "http://10.0.0.2:8080"
+
+
+def served(pool: proxies.ProxyPool, proxy: str, ok: bool):
+    pool.stats[proxy].in_flight += 1
+    pool.release(proxy, 0.2, ok)
+
+
+def test_failing_proxies_are_evicted():
+    pool = proxies.ProxyPool.from_list(["10.0.0.1:8080", "10.0.0.2:8080"])
+    served(pool, GOOD, True)
+    for _ in range(proxies.PROXY_MAX_CONSECUTIVE_FAILURES):
+        served(pool, BAD, False)
+    assert pool.urls == [GOOD] and pool.evicted == 1
+    assert pool.acquire() == GOOD
+    # a request in flight while its proxy was evicted is ignored
+    pool.release(BAD, 0.2, True)
+    assert pool.report()["failure_rate"] == 0.0
+
+
+def test_evicted_proxies_get_their_final_gauges(registry):
+    pool = proxies.ProxyPool.from_list(["10.0.0.1:8080", "10.0.0.2:8080"])
+    served(pool, GOOD, True)
+    served(pool, BAD, True)
+    for _ in range(proxies.PROXY_MAX_CONSECUTIVE_FAILURES):
+        served(pool, BAD, False)
+    download.report_proxies(pool)
+    success = {
+        labels[0][1]: value
+        for (name, labels), value in registry.gauges.items()
+        if name == "mining_proxy_success_rate"
+    }
+    assert success == {GOOD: 1.0, BAD: 0.25}
+    assert registry.gauges[("mining_proxy_requests", (("proxy", BAD),))] == 4
+    assert pool.retired == {}
+
+
+def test_proxies_evicted_unused_are_not_retired():
+    pool = proxies.ProxyPool.from_list(["10.0.0.1:8080", "10.0.0.2:8080"])
+    pool.evict(BAD)
+    assert pool.retired == {} and len(pool) == 1
+
+
+def test_acquire_takes_the_cheaper_of_two():
+    pool = proxies.ProxyPool(
+        {
+            GOOD: proxies.ProxyStats(latency=0.2, requests=10, failures=0),
+            BAD: proxies.ProxyStats(latency=0.2, requests=10, failures=6),
+        }
+    )
+    assert pool.stats[GOOD].score() < pool.stats[BAD].score()
+    # with two proxies both are drawn every time
+    assert [pool.acquire() for _ in range(2)] == [GOOD] * 2
+    # two requests in flight make the good proxy the costlier one
+    assert pool.stats[GOOD].score() > pool.stats[BAD].score()
+    assert pool.acquire() == BAD
+    assert pool.stats[GOOD].in_flight == 2 and pool.stats[BAD].in_flight == 1
+
+
+def test_release_averages_latency():
+    pool = proxies.ProxyPool.from_list(["10.0.0.1:8080"])
+    served(pool, GOOD, True)
+    expected = proxies.DEFAULT_LATENCY + proxies.LATENCY_SMOOTHING * (
+        0.2 - proxies.DEFAULT_LATENCY
+    )
+    assert abs(pool.stats[GOOD].latency - expected) < 1e-9
+    # a request given up on is not counted
+    pool.stats[GOOD].in_flight += 1
+    pool.release(GOOD)
+    assert pool.stats[GOOD].requests == 1 and pool.stats[GOOD].in_flight == 0
+
+
+def test_empty_pools_connect_directly():
+    assert proxies.ProxyPool().acquire() is None
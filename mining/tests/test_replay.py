@@ -0,0 +1,86 @@
+import asyncio
+import cache
+import crawler
+import replay
+
+from aiohttp.test_utils import TestServer
+from datetime import datetime
+
+NOW = datetime(2022, 11, 1, 10, 0)
+ENTRIES = [
+    {
+        "origin": "de:08111:6118",
+        "destination": "de:08116:4241",
+        "status": 200,
+        "response": {"journeys": [{"legs": [], "rating": number}]},
+    }
+    for number in range(3)
+]
+ENTRIES[1]["origin"] = "de:08111:6115"
+ENTRIES[2]["origin"] = "de:08111:6056"
+
+
+def get_trips(monkeypatch, app, pairs: list[tuple[str, str]], **options) -> list:
+    """Trips of the pairs, requested by a crawler from the stand-in app"""
+
+    async def run():
+        async with TestServer(app) as server:
+            url = server.make_url(replay.TRIP_PATH)
+            monkeypatch.setattr(crawler, "TRIP_API_URL", str(url))
+            async with crawler.Crawler(**options) as client:
+                trips = [
+                    await client.get_trips(origin, destination, NOW)
+                    for origin, destination in pairs
+                ]
+                async with client.session.get(server.make_url("/stats")) as r:
+                    stats = await r.json()
+        return trips, stats
+
+    return asyncio.run(run())
+
+
+def test_recorded_pairs_get_their_response(monkeypatch, registry):
+    pairs = [(entry["origin"], entry["destination"]) for entry in ENTRIES]
+    trips, stats = get_trips(monkeypatch, replay.stand_in_app(ENTRIES), pairs)
+    assert trips == [entry["response"]["journeys"] for entry in ENTRIES]
+    assert stats == {"requests": 3, "failures": 0, "timeouts": 0}
+
+
+def test_other_pairs_get_the_recorded_responses_in_turn(monkeypatch, registry):
+    pairs = [(f"de:08111:{number}", "de:08111:1") for number in range(4)]
+    trips, _ = get_trips(monkeypatch, replay.stand_in_app(ENTRIES), pairs)
+    ratings = [journeys[0]["rating"] for journeys in trips]
+    assert ratings == [0, 1, 2, 0]
+
+
+def test_failures_are_retried_then_given_up(monkeypatch, registry):
+    monkeypatch.setattr(crawler, "RETRY_TRIES", 2)
+    monkeypatch.setattr(crawler, "RETRY_DELAY", 0)
+    app = replay.stand_in_app(ENTRIES, failure_rate=1.0)
+    pair = (ENTRIES[0]["origin"], ENTRIES[0]["destination"])
+    trips, stats = get_trips(monkeypatch, app, [pair])
+    assert trips == [None]
+    assert stats == {"requests": 2, "failures": 2, "timeouts": 0}
+    assert (
+        registry.counters[("mining_requests_total", (("outcome", "server_error"),))]
+        == 2
+    )
+
+
+def test_export_cache_skips_departure_boards(tmp_path):
+    path = str(tmp_path / "responses.db")
+    responses = cache.ResponseCache(path)
+    for entry in ENTRIES:
+        journeys = entry["response"]["journeys"]
+        responses.put(entry["origin"], entry["destination"], NOW, journeys)
+    responses.put("de:08111:6118", cache.DEPARTURE_BOARD, NOW, [{"stopName": "X"}])
+    responses.close()
+    fixture = str(tmp_path / "fixture.jsonl")
+    assert replay.write_fixture(fixture, replay.export_cache(path)) == 3
+    assert sorted(replay.read_fixture(fixture), key=str) == sorted(ENTRIES, key=str)
+
+
+def test_synthetic_fixtures_are_trip_responses():
+    entries = list(replay.synthetic_fixture(2, trips=3))
+    assert [entry["origin"] for entry in entries] == ["synthetic:0", "synthetic:1"]
+    assert all(len(entry["response"]["journeys"]) == 3 for entry in entries)
@@ -0,0 +1,102 @@
+import asyncio
+import time
+import pytest
+import scheduler
+
+
+def test_limiter_slow_start_then_additive_increase():
+    limiter = scheduler.AdaptiveLimiter(minimum=2, maximum=10)
+    for _ in range(3):
+        limiter.on_success()
+    assert limiter.limit == 5
+    limiter.on_congestion(time.monotonic())
+    assert limiter.limit == pytest.approx(3.5)
+    assert limiter.threshold == limiter.limit and limiter.decreases == 1
+    limiter.on_success()
+    assert limiter.limit == pytest.approx(3.5 + 1 / 3.5)
+
+
+def test_limiter_counts_a_burst_of_congestion_once():
+    limiter = scheduler.AdaptiveLimiter(minimum=1, maximum=32)
+    limiter.limit = 20.0
+    sent = time.monotonic()
+    limiter.on_congestion(sent)
+    limiter.on_congestion(sent)
+    assert limiter.decreases == 1 and limiter.limit == pytest.approx(14)
+    limiter.on_congestion(time.monotonic())
+    assert limiter.decreases == 2
+
+
+def test_limiter_stays_within_bounds():
+    limiter = scheduler.AdaptiveLimiter(minimum=2, maximum=4)
+    for _ in range(10):
+        limiter.on_success()
+    assert limiter.limit == 4
+    for _ in range(10):
+        limiter.on_congestion(time.monotonic())
+    assert limiter.limit == 2
+
+
+def test_limiter_bounds_requests_in_flight():
+    limiter = scheduler.AdaptiveLimiter(minimum=2, maximum=2)
+    peak = 0
+
+    async def request():
+        nonlocal peak
+        async with limiter:
+            peak = max(peak, limiter.in_flight)
+            await asyncio.sleep(0.01)
+
+    async def run():
+        await asyncio.gather(*(request() for _ in range(8)))
+
+    asyncio.run(run())
+    assert peak == 2 and limiter.in_flight == 0
+
+
+def test_token_bucket_caps_the_rate():
+    bucket = scheduler.TokenBucket(rate=100, burst=5)
+
+    async def run():
+        for _ in range(15):
+            await bucket.acquire()
+
+    started = time.monotonic()
+    asyncio.run(run())
+    # the burst is free, the other ten wait for their tokens
+    assert time.monotonic() - started >= 0.09
+
+
+def test_breaker_opens_on_congestion_and_closes_after_a_probe(monkeypatch):
+    monkeypatch.setattr(scheduler, "BREAKER_WINDOW", 4)
+    breaker = scheduler.CircuitBreaker(cooldown=0.01)
+    for _ in range(2):
+        breaker.on_success()
+    for _ in range(2):
+        breaker.on_congestion()
+    assert breaker.open_until is not None and breaker.openings == 1
+
+    async def run():
+        return await breaker.wait()
+
+    assert asyncio.run(run()) is True
+    assert breaker.probing
+    breaker.on_congestion(probe=True)
+    assert breaker.cooldown == 0.02 and breaker.openings == 2
+    assert asyncio.run(run()) is True
+    breaker.on_success()
+    assert breaker.open_until is None and breaker.cooldown == 0.01
+    assert asyncio.run(run()) is False
+
+
+def test_breaker_ignores_errors_that_are_not_congestion(monkeypatch):
+    monkeypatch.setattr(scheduler, "BREAKER_WINDOW", 4)
+    breaker = scheduler.CircuitBreaker()
+    for _ in range(10):
+        breaker.on_error()
+    assert breaker.open_until is None
+
+
+def test_backoff_delay_is_capped():
+    for attempt in range(10):
+        assert 0 <= scheduler.backoff_delay(attempt, 1, 30) <= min(30, 2**attempt)
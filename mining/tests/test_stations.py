@@ -0,0 +1,79 @@
+import math
+import stations
+import utils
+
+from pathlib import Path
+
+STATION_FILE = Path(stations.__file__).with_name("vvs_sbahn_haltestellen_2022.csv")
+
+
+def station_row(name: str, station_id: str, lines: str, lon: float, lat: float):
+    row = [""] * 16
+    row[0] = row[1] = name
+    row[3] = station_id
+    row[6] = "Stuttgart"
+    row[10] = lines
+    row[14] = str(lon).replace(".", ",")
+    row[15] = str(lat).replace(".", ",")
+    return row
+
+
+REGISTRY = stations.StationRegistry(
+    [
+        station_row("Nord", "de:08111:1", "S1", 9.18, 48.80),
+        station_row("Nordbahnhof", "de:08111:2", "S4,S5", 9.19, 48.80),
+        station_row("Wernau (N)", "de:08116:3", "S1", 9.42, 48.69),
+        station_row("Bad Cannstatt", "de:08111:4", "S1,S2,S3", 9.22, 48.80),
+    ]
+)
+
+
+def test_lookups_by_id_name_and_line():
+    assert REGISTRY.name("de:08116:3") == "Wernau (N)"
+    assert REGISTRY.name("de:08111:99") is None
+    assert REGISTRY.find("WERNAU (N)") == ["de:08116:3"]
+    assert REGISTRY.find("wernau n") == ["de:08116:3"]
+    assert REGISTRY.find("Stuttgart") == []
+    assert REGISTRY.on_line("S1") == ["de:08111:1", "de:08116:3", "de:08111:4"]
+    assert "de:08111:2" in REGISTRY and len(REGISTRY) == 4
+
+
+def test_resolve_by_stop_id_then_name():
+    assert REGISTRY.resolve(("de:08111:2:3:3",)) == "de:08111:2"
+    assert REGISTRY.resolve((None, "de:08111:4")) == "de:08111:4"
+    assert REGISTRY.resolve(("de:08111:99:1:1",), "Bad Cannstatt") == "de:08111:4"
+    assert REGISTRY.resolve((), "Hauptbahnhof") is None
+
+
+def test_mentioned_matches_whole_names_only():
+    assert REGISTRY.mentioned("Aufzug in Stuttgart Nordbahnhof defekt") == {
+        "de:08111:2"
+    }
+    assert REGISTRY.mentioned("Halt in Nord entfällt") == {"de:08111:1"}
+    assert REGISTRY.mentioned("Bauarbeiten zwischen Wernau (N) und Bad Cannstatt") == {
+        "de:08116:3",
+        "de:08111:4",
+    }
+    assert REGISTRY.mentioned(None) == set()
+
+
+def test_near_matches_a_scan_of_all_stations():
+    registry = stations.load_stations(str(STATION_FILE))
+    for station_id in registry.ids[:20]:
+        lon, lat = registry.coords[station_id]
+        expected = {
+            other
+            for other, (x, y) in registry.coords.items()
+            if 111.32 * math.hypot((x - lon) * math.cos(math.radians(lat)), y - lat)
+            <= 8
+        }
+        near = registry.near((lon, lat), 8)
+        assert set(near) == expected
+        assert near[0] == station_id
+
+
+def test_read_station_ids_csv_does_not_grow():
+    ids = utils.read_station_ids_csv(str(STATION_FILE))
+    assert utils.read_station_ids_csv(str(STATION_FILE)) == ids
+    assert len(utils.registry) == len(ids) == 84
+    assert utils.station_id_to_name("de:08116:4241") == "Wernau (N)"
@@ -1,34 +1,45 @@
-import csv
 import random
-import urllib
+import urllib.request
 import json
+import stations
 
-full_station_file = []
 proxy_list = []
 
+# stations of the file last read by read_station_ids_csv
+registry = stations.StationRegistry()
+
 
 def read_station_ids_csv(file: str) -> list[str]:
-    """Read csv file with VVS stations line-by-line"""
-    stations: list[str] = []
-    with open(file, "r") as f:
-        reader = csv.reader(f, delimiter=";")
-        for line in reader:
-            full_station_file.append(line)
-            stations.append(line[3])
-    return stations
+    """Read csv file with VVS stations and make it the shared registry"""
+    global registry
+    registry = stations.load_stations(file)
+    return list(registry.ids)
 
 
 def station_id_to_name(station_id: str) -> str:
-    for line in full_station_file:
-        if line[3] == station_id:
-            return line[0]
+    return registry.name(station_id)
+
+
+PROXY_LIST_URL = (
+    "https://raw.githubusercontent.com/shiftytr/proxy-list/master/https.txt"
+)
+
+
+def parse_proxy_lines(lines) -> list[str]:
+    """host:port entries from a proxy list, as bytes or str lines"""
+    proxies = []
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode()
+        line = line.strip()
+        if line and not line.startswith("#"):
+            proxies.append(line)
+    return proxies
 
 
 def get_proxy_list() -> list[str]:
-    for line in urllib.request.urlopen(
-        "https://raw.githubusercontent.com/shiftytr/proxy-list/master/https.txt"
-    ):
-        proxy_list.append(line)
+    with urllib.request.urlopen(PROXY_LIST_URL, timeout=10) as response:
+        proxy_list.extend(parse_proxy_lines(response))
     return proxy_list
 
 